@@ -3,19 +3,58 @@
 ИСПРАВЛЕННЫЙ API сервер с правильными CORS настройками для agentflow-marketing-hub.vercel.app
 """
 
+import time
+
+# Отсчет холодного старта: длительность импорта приложения попадает в /health
+IMPORT_STARTED = time.perf_counter()
+
 import os
-import sqlite3
 import json
 import uuid
-import base64
+import hashlib
+import mimetypes
+import threading
 from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, send_file
 from flask_cors import CORS
-import tempfile
-import subprocess
-from PIL import Image, ImageDraw, ImageFont
-import cairosvg
-import io
+import logging
+from concurrent.futures import as_completed
+from flask import g, has_request_context
+from render_queue import QueueFull, RenderQueue
+from render_pool import RenderPool
+from renderer import (
+    render_variants, render_fallback_bytes, output_options, supported_formats,
+    svg_dimensions, variant_names, plan_variants, VARIANT_PRESETS, PRIMARY_VARIANT,
+    warm_up as warm_up_renderer
+)
+from render_cache import CACHE_PREFIX, RenderCache
+from storage import create_storage
+from template_compiler import get_compiled_template, content_hash, stats as compiled_template_stats
+from template_catalog import MAX_PAGE_SIZE, CursorError, TemplateCatalog, bump_version
+from db import (
+    get_db_connection, release_db_connection, close_db_connection, transaction, query_one, query_all,
+    observe_queries, stats as db_stats
+)
+from migrations import migrate
+from http_cache import conditional_json, conditional_json_body, compress_json_response, is_content_hashed, set_immutable
+from archive import iter_zip
+from events import EventBroker, format_sse, format_ndjson
+from previews import PreviewStore, PREVIEW_SIZES, DEFAULT_PREVIEW_SIZE
+from remote_images import RemoteImages
+from janitor import Janitor, update_output_bytes
+from idempotency import (
+    KEY_HEADER, MAX_KEY_LENGTH, IdempotencyConflict, find_carousel, remember, request_hash, request_keys
+)
+from integration_endpoints import integration_api
+from logs import configure_logging
+from metrics import (
+    RENDER_SECONDS, ENCODE_SECONDS, SUBSTITUTION_SECONDS, DB_QUERY_SECONDS, HTTP_REQUEST_SECONDS,
+    OUTPUT_BYTES, FALLBACK_RENDERS, register_stats, render_latest
+)
+
+# Структурированные логи (LOG_LEVEL, LOG_FORMAT) до любых сообщений
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # Создаем Flask приложение
 app = Flask(__name__)
@@ -29,73 +68,86 @@ CORS(app,
          'https://vahgmyuowsilbxqdjjii.supabase.co'
      ],
      methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
-     allow_headers=['Content-Type', 'Accept', 'Authorization', 'apikey'],
+     allow_headers=['Content-Type', 'Accept', 'Authorization', 'apikey', 'Idempotency-Key'],
+     expose_headers=['Idempotent-Replayed', 'Retry-After'],
      supports_credentials=True
 )
 
 # Конфигурация
-DATABASE_PATH = 'templates.db'
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'output'
-
-# Создаем необходимые папки
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+PREVIEW_FOLDER = 'previews'
+# Дисковый кэш картинок из плейсхолдеров-URL (оригиналы и уменьшенные копии)
+IMAGE_CACHE_FOLDER = os.environ.get('IMAGE_CACHE_FOLDER', 'image_cache')
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 2))
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', os.cpu_count() or 1))
+# Хранилище слайдов: local (папка output), memory или s3
+OUTPUT_STORAGE = os.environ.get('OUTPUT_STORAGE', 'local')
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', 'https://svg-template-api-server.onrender.com').rstrip('/')
+# Базовый URL файлов слайдов (например, CDN перед бакетом); по умолчанию /output этого сервера
+OUTPUT_PUBLIC_URL = os.environ.get('OUTPUT_PUBLIC_URL', f'{PUBLIC_BASE_URL}/output').rstrip('/')
+RENDER_CACHE_BYTES = int(os.environ.get('RENDER_CACHE_BYTES', 256 * 1024 * 1024))
+# Сколько архив карусели ждет слайды, которые еще рендерятся
+ARCHIVE_WAIT_TIMEOUT = float(os.environ.get('ARCHIVE_WAIT_TIMEOUT', 300))
+# Интервал комментариев keep-alive в потоке событий, секунды
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', 15))
+# Через сколько миллисекунд EventSource переподключается после обрыва
+SSE_RETRY_MS = 3000
+# Пачка /api/carousel/batch: сколько каруселей можно прислать за раз и сколько
+# секунд поток ждет их готовности (после этого отдает текущий статус)
+BATCH_MAX_CAROUSELS = int(os.environ.get('BATCH_MAX_CAROUSELS', 1000))
+BATCH_WAIT_TIMEOUT = float(os.environ.get('BATCH_WAIT_TIMEOUT', 900))
+# Допуск в очередь генерации: сколько слайдов может ждать и рендериться всего
+# и у одного клиента (API ключ или origin); сверх - 429 с Retry-After. 0 - без предела
+RENDER_MAX_PENDING_SLIDES = int(os.environ.get('RENDER_MAX_PENDING_SLIDES', 1000))
+RENDER_MAX_CLIENT_SLIDES = int(os.environ.get('RENDER_MAX_CLIENT_SLIDES', RENDER_MAX_PENDING_SLIDES // 2))
+# Аренда слайда в работе, секунды: слайд, который столько не продлевался
+# (процесс остановился), возвращается в очередь. Должна быть больше времени
+# рендеринга одного слайда
+RENDER_LEASE_SECONDS = float(os.environ.get('RENDER_LEASE_SECONDS', 600))
+# Прогрев перед готовностью (WARM_UP=0 - без него): компиляция шаблонов,
+# импорт cairosvg и загрузка шрифтов в процессах пула
+WARM_UP = os.environ.get('WARM_UP', '1') != '0'
+# Загрузка картинок по URL: одновременных загрузок, таймаут (сек), предельный
+# размер, сколько секунд кэш не перепроверяется, разрешенные хосты (через
+# запятую, пусто - любые), бюджет дискового кэша и разрешение внутренних
+# адресов (по умолчанию запрещены - защита от SSRF)
+REMOTE_IMAGE_CONCURRENCY = int(os.environ.get('REMOTE_IMAGE_CONCURRENCY', 8))
+REMOTE_IMAGE_TIMEOUT = float(os.environ.get('REMOTE_IMAGE_TIMEOUT', 10))
+REMOTE_IMAGE_MAX_BYTES = int(os.environ.get('REMOTE_IMAGE_MAX_BYTES', 20 * 1024 * 1024))
+REMOTE_IMAGE_TTL = float(os.environ.get('REMOTE_IMAGE_TTL', 3600))
+REMOTE_IMAGE_HOSTS = os.environ.get('REMOTE_IMAGE_HOSTS', '').split(',')
+REMOTE_IMAGE_CACHE_BYTES = int(os.environ.get('REMOTE_IMAGE_CACHE_BYTES', 512 * 1024 * 1024))
+REMOTE_IMAGE_ALLOW_PRIVATE = os.environ.get('REMOTE_IMAGE_ALLOW_PRIVATE', '0') == '1'
+# Очистка результатов: интервал прохода (сек), через сколько секунд без
+# обращений карусель удаляется и предельный объем файлов каруселей вместе с
+# записями кэша рендера, на которые не ссылаются слайды; 0 - выключено
+JANITOR_INTERVAL = float(os.environ.get('JANITOR_INTERVAL', 600))
+RETENTION_MAX_AGE = float(os.environ.get('RETENTION_MAX_AGE', 30 * 24 * 3600))
+OUTPUT_MAX_BYTES = int(os.environ.get('OUTPUT_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+# Повторы create-and-generate: сколько секунд действует Idempotency-Key и
+# сколько одинаковый запрос того же клиента без ключа сводится к прошлой
+# карусели (0 - нет)
+IDEMPOTENCY_KEY_TTL = float(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 3600))
+REQUEST_COALESCE_TTL = float(os.environ.get('REQUEST_COALESCE_TTL', 3600))
 
 def init_database():
-    """Инициализация базы данных с созданием всех необходимых таблиц"""
-    print("🔧 Инициализация базы данных...")
+    """Инициализация базы данных: миграции схемы и тестовые шаблоны"""
+    logger.info("Инициализация базы данных")
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Создаем таблицу templates
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS templates (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            category TEXT NOT NULL,
-            svg_content TEXT NOT NULL,
-            preview_url TEXT,
-            template_type TEXT DEFAULT 'flyer',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Создаем таблицу carousels
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS carousels (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            completed_at TIMESTAMP,
-            error_message TEXT
-        )
-    ''')
-    
-    # Создаем таблицу carousel_slides
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS carousel_slides (
-            id TEXT PRIMARY KEY,
-            carousel_id TEXT NOT NULL,
-            template_id TEXT NOT NULL,
-            replacements TEXT NOT NULL,
-            slide_order INTEGER NOT NULL,
-            output_url TEXT,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (carousel_id) REFERENCES carousels (id),
-            FOREIGN KEY (template_id) REFERENCES templates (id)
-        )
-    ''')
+    # Применяем миграции схемы
+    schema_version = migrate(conn)
+    logger.info("Версия схемы базы: %s", schema_version, extra={'schema_version': schema_version})
     
     # Проверяем есть ли уже шаблоны
     cursor.execute('SELECT COUNT(*) FROM templates')
     count = cursor.fetchone()[0]
     
     if count == 0:
-        print("📦 Добавляем тестовые шаблоны...")
+        logger.info("Добавляем тестовые шаблоны")
         
         test_templates = [
             {
@@ -122,6 +174,7 @@ def init_database():
                     <rect width="400" height="600" fill="#fff"/>
                     <rect x="50" y="50" width="300" height="200" fill="#ddd" stroke="#999"/>
                     <text x="200" y="160" text-anchor="middle" font-size="14" fill="#666">Property Photo</text>
+                    <image x="50" y="50" width="300" height="200" preserveAspectRatio="xMidYMid slice" href="{dyno.propertyphoto}"/>
                     <text x="200" y="300" text-anchor="middle" font-size="20" font-weight="bold" fill="#333">OPEN HOUSE</text>
                     <text x="200" y="350" text-anchor="middle" font-size="16" fill="#666">{dyno.propertyaddress}</text>
                     <text x="200" y="400" text-anchor="middle" font-size="14" fill="#666">Agent: {dyno.name}</text>
@@ -152,6 +205,7 @@ def init_database():
                     <rect width="400" height="600" fill="#fff"/>
                     <rect x="50" y="50" width="300" height="200" fill="#ddd" stroke="#999"/>
                     <text x="200" y="160" text-anchor="middle" font-size="14" fill="#666">Property Photo</text>
+                    <image x="50" y="50" width="300" height="200" preserveAspectRatio="xMidYMid slice" href="{dyno.propertyphoto}"/>
                     <text x="200" y="300" text-anchor="middle" font-size="24" font-weight="bold" fill="#d2691e">SOLD!</text>
                     <text x="200" y="350" text-anchor="middle" font-size="16" fill="#666">{dyno.propertyaddress}</text>
                     <text x="200" y="400" text-anchor="middle" font-size="14" fill="#666">Sold by: {dyno.name}</text>
@@ -161,76 +215,602 @@ def init_database():
         ]
         
         for template in test_templates:
+            # OR IGNORE: воркеры gunicorn могут инициализировать базу одновременно
             cursor.execute('''
-                INSERT INTO templates (id, name, category, svg_content, template_type)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT OR IGNORE INTO templates (id, name, category, svg_content, template_type, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?)
             ''', (template['id'], template['name'], template['category'], 
-                  template['svg_content'], template['template_type']))
+                  template['svg_content'], template['template_type'],
+                  content_hash(template['svg_content'])))
+        
+        bump_version(conn)
     
     conn.commit()
-    conn.close()
-    print("✅ База данных инициализирована успешно!")
+    logger.info("База данных инициализирована")
 
-def generate_png_from_svg(svg_content, output_path, width=400, height=600):
-    """Генерирует PNG изображение из SVG контента"""
+def replace_svg_placeholders(svg_content, replacements, template_id=None):
+    """Заменяет плейсхолдеры в SVG контенте через скомпилированный шаблон"""
     try:
-        print(f"🎨 Генерирую PNG: {output_path}")
+        replacements_dict = json.loads(replacements) if isinstance(replacements, str) else replacements
         
-        # Создаем директорию если не существует
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        started = time.perf_counter()
+        template = get_compiled_template(template_id, svg_content)
         
-        # Конвертируем SVG в PNG используя cairosvg
-        cairosvg.svg2png(
-            bytestring=svg_content.encode('utf-8'),
-            write_to=output_path,
-            output_width=width,
-            output_height=height
-        )
+        unknown, missing = template.check(replacements_dict)
+        if unknown:
+            logger.warning("Неизвестные плейсхолдеры", extra={'template_id': template_id, 'placeholders': unknown})
+        if missing:
+            logger.warning("Не заполнены плейсхолдеры", extra={'template_id': template_id, 'placeholders': missing})
         
-        print(f"✅ PNG сгенерирован: {output_path}")
-        return True
+        rendered = template.render(replacements_dict)
+        SUBSTITUTION_SECONDS.labels(template_id or 'unknown').observe(time.perf_counter() - started)
+        return rendered
         
     except Exception as e:
-        print(f"❌ Ошибка генерации PNG: {e}")
+        logger.error("Ошибка замены плейсхолдеров: %s", e, extra={'template_id': template_id})
+        return svg_content
+
+def image_scale(svg_content, requested_variants):
+    """Во сколько раз растр слайда больше шаблона - под него уменьшаются картинки по URL"""
+    base_width, base_height = svg_dimensions(svg_content)
+    raster_size, _ = plan_variants(base_width, base_height, requested_variants)
+    return raster_size[0] / base_width
+
+def slide_output(carousel_id, slide_order, version, extension='png'):
+    """Ключ объекта слайда в хранилище и его URL"""
+    output_key = f"{carousel_id}/slide_{slide_order}_{version}.{extension}"
+    return output_key, f"/output/{output_key}"
+
+def parse_output_request(options):
+    """Параметры кодирования из тела запроса: {"format", "quality", "colors"}.
+    
+    Незаданные поля остаются None и берутся из шаблона; ValueError при
+    неверных значениях.
+    """
+    if options is None:
+        return None, None, None
+    if not isinstance(options, dict):
+        raise ValueError('output must be an object')
+    
+    output_format = options.get('format')
+    quality = options.get('quality')
+    colors = options.get('colors')
+    
+    # Проверяем значения; формат нормализуем (jpg -> jpeg)
+    normalised_format = output_options(output_format, quality, colors)[0]
+    return (normalised_format if output_format else None), quality, colors
+
+def parse_batch_carousel(index, carousel, defaults):
+    """Карусель из тела /api/carousel/batch; ValueError с номером карусели при ошибке.
+    
+    output и variants, не заданные у карусели, берутся с уровня пачки.
+    """
+    def invalid(message):
+        return ValueError(f'carousels[{index}]: {message}')
+    
+    if not isinstance(carousel, dict):
+        raise invalid('must be an object')
+    if not isinstance(carousel.get('name'), str) or not carousel['name']:
+        raise invalid('missing required field: name')
+    slides = carousel.get('slides')
+    if not isinstance(slides, list) or not slides:
+        raise invalid('slides must be a non-empty list')
+    
+    parsed_slides = []
+    for slide in slides:
+        if not isinstance(slide, dict) or not isinstance(slide.get('templateId'), str):
+            raise invalid('every slide needs a templateId')
+        replacements = slide.get('replacements', {})
+        if not isinstance(replacements, dict):
+            raise invalid('replacements must be an object')
+        parsed_slides.append((slide['templateId'], replacements))
+    
+    try:
+        output = parse_output_request(carousel.get('output', defaults.get('output')))
+        variants = carousel.get('variants', defaults.get('variants'))
+        variants = variant_names(variants) if variants else None
+    except ValueError as e:
+        raise invalid(e)
+    
+    return {
+        'name': carousel['name'],
+        # Идентификатор клиента (например, id объявления) возвращается в результатах
+        'ref': carousel.get('ref'),
+        'slides': parsed_slides,
+        'output': output,
+        'variants': variants
+    }
+
+def public_output_url(output_url):
+    """Абсолютный URL файла для клиента"""
+    if not output_url:
+        return None
+    return f"{OUTPUT_PUBLIC_URL}/{output_url[len('/output/'):]}"
+
+def slide_event(carousel_id, slide_id, slide_order, status, output_url=None, output_format=None, output_bytes=None):
+    """Событие о готовности или ошибке слайда: (имя, данные)"""
+    name = 'slide-completed' if status == 'completed' else 'slide-error'
+    return name, {
+        'carouselId': carousel_id,
+        'slideId': slide_id,
+        'slideNumber': slide_order,
+        'status': status,
+        'imageUrl': public_output_url(output_url),
+        'format': output_format,
+        'bytes': output_bytes
+    }
+
+def carousel_event(carousel_id, status, error_message=None):
+    """Событие о завершении генерации карусели: (имя, данные)"""
+    name = 'carousel-completed' if status == 'completed' else 'carousel-failed'
+    return name, {'carouselId': carousel_id, 'status': status, 'errorMessage': error_message}
+
+def publish_carousel_failed(carousel_id, error):
+    event_broker.publish(carousel_id, *carousel_event(carousel_id, 'error', str(error)))
+
+def render_carousel_job(carousel_id):
+    """Рендерит слайды карусели в фоновом воркере, обновляя статус каждого слайда"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Ключи, которые рендерит эта карусель -> Future для других каруселей с теми же слайдами
+    claimed = {}
+    
+    try:
+        cursor.execute('''
+            UPDATE carousels 
+            SET status = 'generating' 
+            WHERE id = ?
+        ''', (carousel_id,))
+        conn.commit()
         
-        # Fallback: создаем простое изображение с текстом
-        try:
-            img = Image.new('RGB', (width, height), color='white')
-            draw = ImageDraw.Draw(img)
+        # Параметры кодирования из запроса (незаданные берутся из шаблона)
+        # и запрошенные варианты размеров
+        carousel_options = cursor.execute('''
+            SELECT output_format, output_quality, output_colors, variants
+            FROM carousels WHERE id = ?
+        ''', (carousel_id,)).fetchone() or (None, None, None, None)
+        carousel_output = carousel_options[:3]
+        requested_variants = json.loads(carousel_options[3]) if carousel_options[3] else []
+        
+        # Берем только слайды, которые еще не отрендерены; шаблоны - из
+        # каталога в памяти, а не JOIN'ом с svg_content на каждый слайд
+        templates = template_catalog.snapshot()
+        cursor.execute('''
+            SELECT id, template_id, replacements, slide_order
+            FROM carousel_slides
+            WHERE carousel_id = ? AND status = 'pending'
+            ORDER BY slide_order
+        ''', (carousel_id,))
+        
+        slides = []
+        missing_templates = []
+        for slide_id, template_id, replacements_json, slide_order in cursor.fetchall():
+            template = templates.by_id.get(template_id)
+            if template is None:
+                missing_templates.append((slide_id, slide_order, template_id))
+                continue
+            slides.append((slide_id, template_id, replacements_json, slide_order, template['svg_content'],
+                           template['output_format'], template['output_quality'], template['output_colors']))
+        
+        # События публикуются только после commit - подписчик, получивший
+        # событие, увидит те же данные и в /slides
+        pending_events = []
+        # Слайды в работе у этой карусели: аренда продлевается на каждом commit
+        leased = set()
+        
+        def commit():
+            if leased:
+                cursor.execute(f'''
+                    UPDATE carousel_slides
+                    SET claimed_at = CURRENT_TIMESTAMP
+                    WHERE id IN ({','.join('?' * len(leased))}) AND status = 'rendering'
+                ''', tuple(leased))
+            conn.commit()
+            for event in pending_events:
+                event_broker.publish(carousel_id, *event)
+            pending_events.clear()
+        
+        def finish_slide(slide_id, slide_order, output_url, rendered, encoded=None, variants=()):
+            leased.discard(slide_id)
+            if rendered:
+                encoded = encoded or {}
+                cursor.execute('''
+                    UPDATE carousel_slides 
+                    SET output_url = ?, status = 'completed',
+                        output_format = ?, output_bytes = ?, encode_ms = ?
+                    WHERE id = ?
+                ''', (output_url, encoded.get('format'), encoded.get('bytes'),
+                      encoded.get('encode_ms'), slide_id))
+                
+                cursor.execute('DELETE FROM carousel_slide_variants WHERE slide_id = ?', (slide_id,))
+                cursor.executemany('''
+                    INSERT INTO carousel_slide_variants
+                        (slide_id, name, width, height, output_url, output_bytes, encode_ms)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(slide_id, variant['name'], variant['width'], variant['height'],
+                       variant['output_url'], variant.get('bytes'), variant.get('encode_ms'))
+                      for variant in variants])
+                
+                logger.debug("Слайд сгенерирован",
+                             extra={'carousel_id': carousel_id, 'slide': slide_order, 'url': output_url})
+                pending_events.append(slide_event(carousel_id, slide_id, slide_order, 'completed', output_url,
+                                                  encoded.get('format'), encoded.get('bytes')))
+            else:
+                cursor.execute('''
+                    UPDATE carousel_slides 
+                    SET status = 'error'
+                    WHERE id = ?
+                ''', (slide_id,))
+                pending_events.append(slide_event(carousel_id, slide_id, slide_order, 'error'))
+        
+        # Шаблон слайда удален - рендерить нечего
+        for slide_id, slide_order, template_id in missing_templates:
+            logger.error("Шаблон слайда не найден",
+                         extra={'carousel_id': carousel_id, 'slide': slide_order, 'template_id': template_id})
+            finish_slide(slide_id, slide_order, None, False)
+        
+        # Картинки по URL всех слайдов начинают загружаться сразу и
+        # параллельно; каждый слайд ниже ждет только свои
+        for _, _, replacements_json, _, svg_content, *_ in slides:
+            remote_images.prefetch(svg_content, json.loads(replacements_json),
+                                   image_scale(svg_content, requested_variants))
+        
+        def cached_variants(outputs, output_format):
+            """Варианты слайда, скопированные из кэша; None, если какого-то нет"""
+            sizes = [render_cache.copy_to(cache_key, output_key) for _, cache_key, output_key, _ in outputs]
+            if not all(sizes):
+                return None
+            return [
+                {'name': name, 'width': width, 'height': height, 'format': output_format,
+                 'bytes': size, 'output_url': output_url}
+                for ((name, width, height, _), _, _, output_url), size in zip(outputs, sizes)
+            ]
+        
+        # Захватываем слайды и раздаем их пулу процессов параллельно.
+        # Слайды с одинаковыми ключами кэша ждут один общий рендер - в том
+        # числе рендер, который идет в другой карусели.
+        futures = {}
+        in_flight = {}  # ключи кэша вариантов -> (формат, шаблон, [слайды], аргументы рендера)
+        for slide_id, template_id, replacements_json, slide_order, svg_content, *template_output in slides:
+            # Захватываем слайд атомарно, чтобы он не отрендерился дважды
+            cursor.execute('''
+                UPDATE carousel_slides 
+                SET status = 'rendering', claimed_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending'
+            ''', (slide_id,))
+            
+            if cursor.rowcount == 0:
+                continue
+            leased.add(slide_id)
+            
+            try:
+                logger.debug("Генерирую слайд", extra={'carousel_id': carousel_id, 'slide': slide_order})
+                
+                # Заменяем плейсхолдеры в SVG: по строке считаются ключи кэша,
+                # а процесс пула подставляет значения прямо в разобранное дерево.
+                # URL картинок заменяются на уменьшенные копии (data: URI)
+                replacements = remote_images.embed(svg_content, json.loads(replacements_json),
+                                                   image_scale(svg_content, requested_variants))
+                processed_svg = replace_svg_placeholders(svg_content, replacements, template_id)
+                
+                # Каждый параметр: из запроса, иначе из шаблона, иначе по умолчанию
+                encoding = output_options(*(
+                    requested if requested is not None else default
+                    for requested, default in zip(carousel_output, template_output)
+                ))
+                
+                # Основной вариант - в размере шаблона, остальные - по запросу
+                raster_size, plan = plan_variants(*svg_dimensions(processed_svg), requested_variants)
+                
+                outputs = []  # (вариант, ключ кэша, ключ объекта, URL)
+                for variant in plan:
+                    name, width, height, _ = variant
+                    cache_key = RenderCache.make_key(processed_svg, width, height, *encoding)
+                    # Имя файла содержит хэш содержимого - такой URL можно кэшировать навсегда
+                    version = cache_key[:16] if name == PRIMARY_VARIANT else f"{name}_{cache_key[:16]}"
+                    outputs.append((variant, cache_key, *slide_output(carousel_id, slide_order, version, encoding[0])))
+                
+                cache_keys = tuple(output[1] for output in outputs)
+                slide = (slide_id, slide_order, outputs)
+                
+                if cache_keys in in_flight:
+                    in_flight[cache_keys][2].append(slide)
+                    continue
+                
+                variants = cached_variants(outputs, encoding[0])
+                if variants:
+                    logger.debug("Слайд взят из кэша", extra={'carousel_id': carousel_id, 'slide': slide_order})
+                    finish_slide(slide_id, slide_order, variants[0]['output_url'], True, variants[0], variants)
+                    continue
+                
+                render_args = (svg_content, replacements, raster_size, plan, *encoding)
+                in_flight[cache_keys] = (encoding[0], template_id, [slide], render_args)
+                
+                owner, shared = render_cache.begin(cache_keys)
+                if not owner:
+                    # Такой же слайд сейчас рендерит другая карусель - ждем его
+                    futures[shared] = cache_keys
+                    continue
+                claimed[cache_keys] = shared
+                
+                # Процесс пула растеризует слайд один раз в самом крупном размере,
+                # получает из растра все варианты и возвращает их байтами -
+                # они сразу уходят в хранилище
+                futures[render_pool.submit(render_variants, *render_args)] = cache_keys
+                
+            except Exception as slide_error:
+                logger.error("Ошибка генерации слайда: %s", slide_error,
+                             extra={'carousel_id': carousel_id, 'slide': slide_order})
+                finish_slide(slide_id, slide_order, None, False)
+        
+        commit()
+        
+        # Собираем результаты по мере готовности
+        for future in as_completed(futures):
+            cache_keys = futures[future]
+            output_format, template_id, waiting, render_args = in_flight[cache_keys]
+            rendered_variants = []
+            
+            if cache_keys not in claimed:
+                # Слайд отрендерила другая карусель - результат уже в кэше
+                try:
+                    future.result()
+                    joined = [cached_variants(outputs, output_format) for _, _, outputs in waiting]
+                except Exception:
+                    joined = [None]
+                if all(joined):
+                    for (slide_id, slide_order, _), variants in zip(waiting, joined):
+                        finish_slide(slide_id, slide_order, variants[0]['output_url'], True, variants[0], variants)
+                    commit()
+                    continue
+                # Тот рендер не удался или запись уже вытеснена - рендерим сами
+                future = render_pool.submit(render_variants, *render_args)
             
-            # Пытаемся загрузить шрифт
             try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 20)
-            except:
-                font = ImageFont.load_default()
+                result = future.result()
+                rendered_variants = result['variants']
+                RENDER_SECONDS.labels(template_id).observe(result['render_ms'] / 1000)
+                for index, variant in enumerate(rendered_variants):
+                    ENCODE_SECONDS.labels(output_format).observe(variant['encode_ms'] / 1000)
+                    OUTPUT_BYTES.labels(output_format, variant['name']).observe(variant['bytes'])
+                    render_cache.store(cache_keys[index], variant.pop('data'),
+                                       [slide[2][index][2] for slide in waiting], output_format)
+                rendered = True
+                render_error = None
+            except Exception as error:
+                logger.error("Ошибка генерации слайда: %s", error,
+                             extra={'carousel_id': carousel_id, 'slide': waiting[0][1]})
+                rendered = False
+                render_error = error
             
-            draw.text((width//2, height//2), "Generated Image", fill='black', font=font, anchor='mm')
-            img.save(output_path, 'PNG')
+            if cache_keys in claimed:
+                render_cache.end(cache_keys, claimed[cache_keys], render_error)
             
-            print(f"✅ Fallback PNG создан: {output_path}")
-            return True
+            for slide_id, slide_order, outputs in waiting:
+                slide_rendered = rendered
+                variants = [
+                    dict(variant, output_url=output[3])
+                    for variant, output in zip(rendered_variants, outputs)
+                ] if rendered else []
+                encoded = variants[0] if variants else None
+                output_url = encoded['output_url'] if encoded else None
+                
+                if not rendered:
+                    # SVG не отрендерился - отдаем заглушку; в кэш она не попадает
+                    # и получает имя без хэша, т.к. ее содержимое не immutable
+                    output_key, output_url = slide_output(carousel_id, slide_order, 'fallback')
+                    try:
+                        fallback = render_fallback_bytes()
+                        output_storage.put(output_key, fallback)
+                        FALLBACK_RENDERS.labels('slide').inc()
+                        encoded = {'format': 'png', 'bytes': len(fallback)}
+                        slide_rendered = True
+                    except Exception as fallback_error:
+                        logger.error("Fallback тоже не сработал: %s", fallback_error,
+                                     extra={'carousel_id': carousel_id, 'slide': slide_order})
+                finish_slide(slide_id, slide_order, output_url, slide_rendered, encoded, variants)
             
-        except Exception as fallback_error:
-            print(f"❌ Fallback тоже не сработал: {fallback_error}")
-            return False
+            # Фиксируем каждый рендер, чтобы клиенты видели прогресс
+            commit()
+        
+        # Слайды могли остаться в работе у другого воркера
+        cursor.execute('''
+            SELECT COUNT(*) FROM carousel_slides 
+            WHERE carousel_id = ? AND status IN ('pending', 'rendering')
+        ''', (carousel_id,))
+        
+        if cursor.fetchone()[0] == 0:
+            # Обновляем статус карусели на "completed"
+            cursor.execute('''
+                UPDATE carousels 
+                SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (carousel_id,))
+            # Размер файлов для квоты очистки: считается по базе, а не по хранилищу
+            update_output_bytes(conn, carousel_id)
+            pending_events.append(carousel_event(carousel_id, 'completed'))
+            commit()
+            logger.info("Карусель сгенерирована", extra={'carousel_id': carousel_id})
+    finally:
+        # Если рендер прервался, ожидающие карусели не должны зависнуть
+        for cache_keys, shared in claimed.items():
+            render_cache.end(cache_keys, shared, RuntimeError('Render was interrupted'))
+        release_db_connection()
 
-def replace_svg_placeholders(svg_content, replacements):
-    """Заменяет плейсхолдеры в SVG контенте"""
-    try:
-        replacements_dict = json.loads(replacements) if isinstance(replacements, str) else replacements
+# Хранилище, кэш отрендеренных слайдов, превью и очистка создаются в
+# start_services: хранилище создает каталоги, а кэш читает индекс с диска
+output_storage = None
+render_cache = None
+preview_store = None
+janitor = None
+
+# Картинки по URL из плейсхолдеров (сессия и потоки создаются при первой загрузке)
+remote_images = RemoteImages(IMAGE_CACHE_FOLDER, REMOTE_IMAGE_CONCURRENCY, REMOTE_IMAGE_TIMEOUT,
+                             REMOTE_IMAGE_MAX_BYTES, REMOTE_IMAGE_TTL, REMOTE_IMAGE_HOSTS,
+                             REMOTE_IMAGE_CACHE_BYTES, REMOTE_IMAGE_ALLOW_PRIVATE)
+
+# Пул процессов рендеринга (процессы создаются в start_services)
+render_pool = RenderPool(RENDER_PROCESSES)
+
+def template_listing_item(template):
+    """Элемент списка /api/templates/all-previews"""
+    return {
+        'id': template['id'],
+        'name': template['name'],
+        'category': template['category'],
+        'template_type': template['template_type'],
+        'preview_url': f"/api/templates/{template['id']}/preview",
+        'created_at': template['created_at']
+    }
+
+# Шаблоны в памяти процесса: перечитываются, когда upload/sync меняют версию
+template_catalog = TemplateCatalog(template_listing_item)
+
+# Pub/sub событий генерации для SSE и потокового архива
+event_broker = EventBroker()
+
+# Фоновые воркеры генерации
+render_queue = RenderQueue(render_carousel_job, workers=RENDER_WORKERS, on_failed=publish_carousel_failed,
+                           max_pending_slides=RENDER_MAX_PENDING_SLIDES, max_client_slides=RENDER_MAX_CLIENT_SLIDES,
+                           lease_seconds=RENDER_LEASE_SECONDS)
+
+# Запуск отделен от импорта: импорт быстрый и без побочных эффектов, а база,
+# процессы пула и потоки создаются в том процессе, который будет отвечать на
+# запросы. gunicorn вызывает start_services() в воркере после fork
+# (gunicorn.conf.py), остальные способы запуска - на первом запросе.
+# Этапы и их длительность отдаются в /health.
+startup = {
+    'stage': 'imported',  # imported -> starting -> warming -> ready
+    'import_ms': None,
+    'database_ms': None,
+    'render_pool_ms': None,
+    'warm_up_ms': None,
+    'ready_ms': None
+}
+_startup_lock = threading.Lock()
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def start_services():
+    """Хранилище, схема базы, пул рендеринга, превью и очередь; один раз на процесс"""
+    global output_storage, render_cache, preview_store, janitor
+    with _startup_lock:
+        if startup['stage'] != 'imported':
+            return
         
-        for key, value in replacements_dict.items():
-            placeholder = f"{{{key}}}"
-            svg_content = svg_content.replace(placeholder, str(value))
-            
-        return svg_content
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+        
+        output_storage = create_storage(OUTPUT_STORAGE, OUTPUT_FOLDER)
+        render_cache = RenderCache(output_storage, RENDER_CACHE_BYTES)
+        preview_store = PreviewStore(PREVIEW_FOLDER, render_pool)
+        janitor = Janitor(output_storage, JANITOR_INTERVAL, RETENTION_MAX_AGE, OUTPUT_MAX_BYTES, render_cache)
+        app.extensions['preview_store'] = preview_store
+        register_stats('render_cache', render_cache.stats,
+                       counters=('hits', 'misses', 'evictions', 'joined'),
+                       gauges=('entries', 'bytes', 'max_bytes', 'hit_ratio', 'rendering'))
+        register_stats('previews', preview_store.stats, counters=('rendered',), gauges=('in_flight',))
+        register_stats('janitor', janitor.stats,
+                       counters=('runs', 'reclaimed_bytes', 'deleted_carousels', 'orphan_rows', 'orphan_prefixes',
+                                 'cache_evictions'),
+                       gauges=('output_bytes', 'cache_bytes', 'max_bytes'))
+        # Компоненты созданы: /health может читать их статистику
+        startup['stage'] = 'starting'
+        
+        started = time.perf_counter()
+        init_database()
+        startup['database_ms'] = elapsed_ms(started)
+        
+        # Пул процессов создаем до запуска потоков, чтобы fork был безопасным
+        started = time.perf_counter()
+        render_pool.start()
+        startup['render_pool_ms'] = elapsed_ms(started)
+        
+        # Недостающие превью рендерятся в фоне (в том числе для тестовых шаблонов)
+        preview_store.refresh()
         
+        # Незавершенные задачи подхватываются из базы
+        render_queue.start()
+        janitor.start()
+        
+        if WARM_UP:
+            startup['stage'] = 'warming'
+            threading.Thread(target=run_warm_up, name='warm-up', daemon=True).start()
+        else:
+            mark_ready()
+
+def run_warm_up():
+    """Компилирует шаблоны и прогревает процессы пула; до конца /health отвечает 503"""
+    started = time.perf_counter()
+    try:
+        # Заодно загружается каталог шаблонов
+        templates = template_catalog.snapshot().templates
+        for template in templates:
+            get_compiled_template(template['id'], template['svg_content'])
+        render_pool.warm_up(warm_up_renderer, [template['svg_content'] for template in templates])
     except Exception as e:
-        print(f"❌ Ошибка замены плейсхолдеров: {e}")
-        return svg_content
+        logger.warning("Прогрев не удался: %s", e)
+    finally:
+        close_db_connection()
+    
+    startup['warm_up_ms'] = elapsed_ms(started)
+    mark_ready()
+
+def mark_ready():
+    startup['ready_ms'] = elapsed_ms(IMPORT_STARTED)
+    startup['stage'] = 'ready'
+    logger.info("Сервис готов", extra=startup)
+
+@app.before_request
+def ensure_started():
+    # Запросы во время запуска ждут его; /health отвечает сразу
+    if startup['stage'] == 'imported' or (startup['stage'] == 'starting' and request.endpoint != 'health_check'):
+        start_services()
+
+# Эндпоинты интеграции с админкой
+app.register_blueprint(integration_api)
+
+# Сжатие крупных JSON ответов (gzip/brotli)
+app.after_request(compress_json_response)
+
+# Метрики: время запросов к базе по endpoint'ам и состояние компонентов,
+# которое снимается из их stats() при сборе
+def observe_db_query(seconds):
+    endpoint = (request.endpoint or 'unmatched') if has_request_context() else 'background'
+    DB_QUERY_SECONDS.labels(endpoint).observe(seconds)
+
+observe_queries(observe_db_query)
 
-# Инициализируем базу данных при запуске
-init_database()
+register_stats('render_queue', render_queue.stats, counters=('rejected', 'reclaimed'),
+               gauges=('depth', 'workers', 'pending_slides', 'max_pending_slides', 'clients', 'slide_seconds'))
+register_stats('render_pool', render_pool.stats,
+               counters=('submitted', 'completed', 'failed'), gauges=('processes', 'active', 'utilisation'))
+register_stats('compiled_templates', compiled_template_stats,
+               counters=('hits', 'misses'), gauges=('entries', 'hit_ratio'))
+register_stats('template_catalog', template_catalog.stats, counters=('loads', 'hits'),
+               gauges=('version', 'templates'))
+register_stats('events', event_broker.stats, counters=('published',), gauges=('topics', 'subscribers'))
+register_stats('remote_images', remote_images.stats,
+               counters=('cached', 'revalidated', 'downloaded', 'failed', 'evicted'),
+               gauges=('in_flight', 'cache_bytes', 'max_cache_bytes'))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        HTTP_REQUEST_SECONDS.labels(request.endpoint or 'unmatched', request.method,
+                                    response.status_code).observe(time.perf_counter() - started)
+    return response
+
+@app.teardown_request
+def release_connection(exc):
+    """Соединение потока остается в пуле, незавершенная транзакция откатывается"""
+    release_db_connection()
 
 # ДОБАВЛЯЕМ ОБРАБОТКУ OPTIONS REQUESTS
 @app.before_request
@@ -238,7 +818,7 @@ def handle_preflight():
     if request.method == "OPTIONS":
         response = jsonify({'status': 'ok'})
         response.headers.add("Access-Control-Allow-Origin", "https://agentflow-marketing-hub.vercel.app")
-        response.headers.add('Access-Control-Allow-Headers', "Content-Type,Accept,Authorization,apikey")
+        response.headers.add('Access-Control-Allow-Headers', "Content-Type,Accept,Authorization,apikey,Idempotency-Key")
         response.headers.add('Access-Control-Allow-Methods', "GET,POST,PUT,DELETE,OPTIONS")
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
@@ -257,16 +837,17 @@ def after_request(response):
     if origin in allowed_origins:
         response.headers.add('Access-Control-Allow-Origin', origin)
     
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Accept,Authorization,apikey')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Accept,Authorization,apikey,Idempotency-Key')
     response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,OPTIONS')
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     return response
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Проверка состояния API"""
+    """Проверка состояния API; 503, пока сервис не запущен и не прогрет"""
+    ready = startup['stage'] == 'ready'
     return jsonify({
-        'status': 'healthy',
+        'status': 'healthy' if ready else 'starting',
         'message': 'SVG Template API is running',
         'timestamp': datetime.now().isoformat(),
         'cors_enabled': True,
@@ -274,41 +855,112 @@ def health_check():
             'https://agentflow-marketing-hub.vercel.app',
             'http://localhost:3000',
             'http://localhost:5173'
-        ]
-    })
+        ],
+        'render_queue': render_queue.stats(),
+        'render_pool': render_pool.stats(),
+        'render_cache': render_cache.stats(),
+        'previews': preview_store.stats(),
+        'template_catalog': template_catalog.stats(),
+        'events': event_broker.stats(),
+        'remote_images': remote_images.stats(),
+        'janitor': janitor.stats(),
+        'storage': output_storage.kind,
+        'output_formats': supported_formats(),
+        'database': db_stats(),
+        'startup': startup
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Метрики в формате Prometheus"""
+    data, content_type = render_latest()
+    return Response(data, content_type=content_type)
 
 @app.route('/api/templates/all-previews', methods=['GET'])
 def get_all_templates():
-    """Получить все шаблоны с превью"""
+    """Список шаблонов с превью: фильтры category и type, страницы по cursor и limit.
+    
+    Без limit отдается весь список. Тело страницы берется готовым из каталога
+    шаблонов в памяти.
+    """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
+        limit = request.args.get('limit')
+        if limit is not None:
+            if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+                return jsonify({
+                    'success': False,
+                    'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'
+                }), 400
+            limit = int(limit)
         
-        cursor.execute('''
-            SELECT id, name, category, template_type, created_at
-            FROM templates
-            ORDER BY created_at DESC
-        ''')
-        
-        templates = []
-        for row in cursor.fetchall():
-            template_id, name, category, template_type, created_at = row
-            templates.append({
-                'id': template_id,
-                'name': name,
-                'category': category,
-                'template_type': template_type,
-                'preview_url': f'/api/templates/{template_id}/preview',
-                'created_at': created_at
-            })
-        
-        conn.close()
+        try:
+            body, etag = template_catalog.snapshot().page(
+                category=request.args.get('category') or None,
+                template_type=request.args.get('type') or None,
+                cursor=request.args.get('cursor') or None,
+                limit=limit
+            )
+        except CursorError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        return conditional_json_body(body, etag)
         
+    except Exception as e:
         return jsonify({
-            'success': True,
-            'count': len(templates),
-            'templates': templates
-        })
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/templates/<template_id>/preview', methods=['GET'])
+def get_template_preview(template_id):
+    """Отдает заранее отрендеренное превью шаблона"""
+    try:
+        size = request.args.get('size', DEFAULT_PREVIEW_SIZE)
+        
+        if size not in PREVIEW_SIZES:
+            return jsonify({
+                'success': False,
+                'error': f'Unknown preview size: {size}',
+                'sizes': list(PREVIEW_SIZES)
+            }), 400
+        
+        template = template_catalog.get(template_id)
+        
+        if not template:
+            return jsonify({
+                'success': False,
+                'error': 'Template not found'
+            }), 404
+        
+        svg_hash = template['content_hash']
+        preview_path = preview_store.path_for(svg_hash, size)
+        
+        # Превью еще не успело отрендериться - дожидаемся его
+        if not os.path.exists(preview_path):
+            preview_path = preview_store.ensure(template['svg_content'], svg_hash, size)
+            
+            if not preview_path:
+                # Рендер не удался (или дал заглушку) - ответ не кэшируется,
+                # следующий запрос рендерит превью заново
+                response = jsonify({
+                    'success': False,
+                    'error': 'Preview rendering failed'
+                })
+                response.status_code = 503
+                response.headers['Cache-Control'] = 'no-store'
+                return response
+        
+        # Сильный ETag от хэша SVG: правка шаблона меняет ETag
+        return send_file(
+            os.path.abspath(preview_path),
+            mimetype='image/png',
+            etag=PreviewStore.etag_for(svg_hash, size),
+            conditional=True,
+            max_age=86400
+        )
         
     except Exception as e:
         return jsonify({
@@ -316,40 +968,81 @@ def get_all_templates():
             'error': str(e)
         }), 500
 
+def client_key():
+    """Клиент для допуска в очередь и честного порядка: API ключ, иначе origin, иначе адрес"""
+    api_key = request.headers.get('apikey') or request.headers.get('Authorization')
+    if api_key:
+        # Сам ключ в памяти и логах не держим
+        return 'key:' + hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:16]
+    origin = request.headers.get('Origin')
+    if origin:
+        return f'origin:{origin}'
+    return f'ip:{request.access_route[0] if request.access_route else request.remote_addr}'
+
+def queue_full_response(error, carousel_id=None):
+    """Быстрый отказ, когда очередь генерации полна: 429 и Retry-After"""
+    logger.warning("Очередь генерации полна: %s", error,
+                   extra={'carousel_id': carousel_id, 'retry_after': error.retry_after})
+    payload = {
+        'success': False,
+        'error': str(error),
+        'retryAfter': error.retry_after
+    }
+    if carousel_id:
+        # Карусель создана - генерацию можно повторить по ней
+        payload['carouselId'] = carousel_id
+    response = jsonify(payload)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def parse_carousel_request(data):
+    """Проверяет тело создания карусели; (output_format, output_quality, output_colors, variants) или ValueError"""
+    if not data or 'name' not in data or 'slides' not in data:
+        raise ValueError('Missing required fields: name, slides')
+    
+    output_format, output_quality, output_colors = parse_output_request(data.get('output'))
+    variants = variant_names(data['variants']) if data.get('variants') else None
+    return output_format, output_quality, output_colors, variants
+
+def insert_carousel(conn, carousel_id, data, options):
+    """Карусель со слайдами в статусе created (в транзакции вызывающего)"""
+    output_format, output_quality, output_colors, variants = options
+    
+    # Создаем карусель
+    conn.execute('''
+        INSERT INTO carousels (id, name, status, output_format, output_quality, output_colors, variants)
+        VALUES (?, ?, 'created', ?, ?, ?, ?)
+    ''', (carousel_id, data['name'], output_format, output_quality, output_colors,
+          json.dumps(variants) if variants else None))
+    
+    # Создаем слайды
+    for i, slide in enumerate(data['slides']):
+        slide_id = str(uuid.uuid4())
+        conn.execute('''
+            INSERT INTO carousel_slides (id, carousel_id, template_id, replacements, slide_order)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (slide_id, carousel_id, slide['templateId'], 
+              json.dumps(slide['replacements']), i + 1))
+
 @app.route('/api/carousel', methods=['POST'])
 def create_carousel():
     """Создать новую карусель"""
     try:
         data = request.get_json()
         
-        if not data or 'name' not in data or 'slides' not in data:
+        try:
+            options = parse_carousel_request(data)
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'error': 'Missing required fields: name, slides'
+                'error': str(e)
             }), 400
         
         carousel_id = str(uuid.uuid4())
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Создаем карусель
-        cursor.execute('''
-            INSERT INTO carousels (id, name, status)
-            VALUES (?, ?, 'created')
-        ''', (carousel_id, data['name']))
-        
-        # Создаем слайды
-        for i, slide in enumerate(data['slides']):
-            slide_id = str(uuid.uuid4())
-            cursor.execute('''
-                INSERT INTO carousel_slides (id, carousel_id, template_id, replacements, slide_order)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (slide_id, carousel_id, slide['templateId'], 
-                  json.dumps(slide['replacements']), i + 1))
-        
-        conn.commit()
-        conn.close()
+        with transaction() as conn:
+            insert_carousel(conn, carousel_id, data, options)
         
         return jsonify({
             'success': True,
@@ -367,19 +1060,74 @@ def create_carousel():
 # ДОБАВЛЯЕМ НЕДОСТАЮЩИЙ ENDPOINT
 @app.route('/api/carousel/create-and-generate', methods=['POST'])
 def create_and_generate_carousel():
-    """Создать карусель и сразу запустить генерацию"""
+    """Создать карусель и сразу запустить генерацию.
+    
+    Повтор запроса (тот же Idempotency-Key или то же содержимое) не создает
+    новую карусель: пока исходная генерируется, повтор присоединяется к ней,
+    а после завершения получает ее результат (заголовок Idempotent-Replayed).
+    """
     try:
-        # Сначала создаем карусель
-        create_response = create_carousel()
+        data = request.get_json()
         
-        if create_response.status_code != 200:
-            return create_response
-            
-        create_data = create_response.get_json()
-        carousel_id = create_data['carouselId']
+        idempotency_key = request.headers.get(KEY_HEADER, '').strip()
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            return jsonify({
+                'success': False,
+                'error': f'{KEY_HEADER} must be at most {MAX_KEY_LENGTH} characters'
+            }), 400
+        
+        try:
+            options = parse_carousel_request(data)
+            template_ids = sorted({slide['templateId'] for slide in data['slides']})
+        except (ValueError, TypeError, KeyError) as e:
+            return jsonify({
+                'success': False,
+                'error': str(e) if isinstance(e, ValueError) else 'Each slide needs templateId and replacements'
+            }), 400
+        
+        # Хэш учитывает содержимое шаблонов: после их обновления тот же запрос
+        # дает новую карусель
+        templates = template_catalog.snapshot().by_id
+        template_hashes = {
+            template_id: templates[template_id]['content_hash']
+            for template_id in template_ids if template_id in templates
+        }
+        client = client_key()
+        request_digest = request_hash(data, template_hashes)
+        keys = request_keys(idempotency_key, request_digest, client, IDEMPOTENCY_KEY_TTL, REQUEST_COALESCE_TTL)
+        
+        # Допуск в очередь до записи: при 429 не остается ни карусели, ни
+        # ключа повтора. Повтор существующей карусели отказом не получает
+        queue_full = None
+        try:
+            render_queue.admit(len(data['slides']), client)
+        except QueueFull as e:
+            queue_full = e
+        
+        carousel_id = str(uuid.uuid4())
+        try:
+            with transaction() as conn:
+                # Блокировка записи до поиска: одновременные повторы не создадут две карусели
+                conn.execute('BEGIN IMMEDIATE')
+                existing_id, missing_keys = find_carousel(conn, keys, request_digest)
+                if existing_id is not None:
+                    # Сведен одним ключом - остальные ключи запроса ведут туда же
+                    remember(conn, missing_keys, request_digest, existing_id)
+                elif queue_full is None:
+                    insert_carousel(conn, carousel_id, data, options)
+                    remember(conn, keys, request_digest, carousel_id)
+        except IdempotencyConflict as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 422
         
-        # Затем запускаем генерацию
-        return generate_carousel(carousel_id)
+        if existing_id is None:
+            if queue_full is not None:
+                return queue_full_response(queue_full)
+            return generate_carousel(carousel_id)
+        
+        return replay_carousel(existing_id)
         
     except Exception as e:
         return jsonify({
@@ -387,183 +1135,607 @@ def create_and_generate_carousel():
             'error': str(e)
         }), 500
 
-@app.route('/api/carousel/<carousel_id>/generate', methods=['POST'])
-def generate_carousel(carousel_id):
-    """Запустить генерацию карусели"""
+def replay_carousel(carousel_id):
+    """Ответ на повтор запроса: готовый результат, текущая генерация или перезапуск"""
+    logger.info("Повтор запроса сведен к карусели", extra={'carousel_id': carousel_id})
+    
+    result = carousel_result(carousel_id)
+    if result is not None and result['status'] == 'completed':
+        response = jsonify({
+            'success': True,
+            **result,
+            'statusUrl': f'/api/carousel/{carousel_id}/slides'
+        })
+    elif result is not None and result['status'] in ('queued', 'generating'):
+        # Присоединяемся к идущей генерации
+        response = jsonify({
+            'success': True,
+            'carouselId': carousel_id,
+            'status': result['status'],
+            'message': 'Carousel generation already in progress',
+            'statusUrl': f'/api/carousel/{carousel_id}/slides'
+        })
+        response.status_code = 202
+    else:
+        # Исходный запрос не дошел до очереди или генерация упала - запускаем заново
+        response = app.make_response(generate_carousel(carousel_id))
+    
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+@app.route('/api/carousel/batch', methods=['POST'])
+def create_carousel_batch():
+    """Создать и сгенерировать пачку каруселей одним запросом.
+    
+    Все карусели и слайды вставляются в одной транзакции, каждый шаблон
+    пачки читается и компилируется один раз, а одинаковые слайды разных
+    каруселей рендерятся один раз. Ответ - поток NDJSON: строка batch с id
+    каруселей, строка carousel на каждую карусель по мере готовности (в
+    порядке завершения, с номером index из запроса) и итоговая строка done.
+    """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
+        data = request.get_json(silent=True)
+        carousels = data.get('carousels') if isinstance(data, dict) else None
         
-        # Проверяем существование карусели
-        cursor.execute('SELECT id, name FROM carousels WHERE id = ?', (carousel_id,))
-        carousel = cursor.fetchone()
+        if not isinstance(carousels, list) or not carousels:
+            return jsonify({
+                'success': False,
+                'error': 'Missing required field: carousels'
+            }), 400
         
-        if not carousel:
+        if len(carousels) > BATCH_MAX_CAROUSELS:
             return jsonify({
                 'success': False,
-                'error': 'Carousel not found'
-            }), 404
+                'error': f'Too many carousels: {len(carousels)}, at most {BATCH_MAX_CAROUSELS} per batch'
+            }), 400
         
-        # Обновляем статус на "generating"
-        cursor.execute('''
-            UPDATE carousels 
-            SET status = 'generating' 
-            WHERE id = ?
-        ''', (carousel_id,))
+        try:
+            batch = [parse_batch_carousel(index, carousel, data) for index, carousel in enumerate(carousels)]
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
         
-        # Получаем слайды для генерации
-        cursor.execute('''
-            SELECT cs.id, cs.template_id, cs.replacements, cs.slide_order, t.svg_content
-            FROM carousel_slides cs
-            JOIN templates t ON cs.template_id = t.id
-            WHERE cs.carousel_id = ?
-            ORDER BY cs.slide_order
-        ''', (carousel_id,))
+        # Шаблоны берутся из каталога и компилируются один раз на всю пачку;
+        # скомпилированный шаблон из кэша потом берут и воркеры рендеринга
+        template_ids = sorted({template_id for carousel in batch for template_id, _ in carousel['slides']})
+        catalog = template_catalog.snapshot().by_id
+        templates = [(template_id, catalog[template_id]['svg_content'])
+                     for template_id in template_ids if template_id in catalog]
+        
+        unknown = sorted(set(template_ids) - set(catalog))
+        if unknown:
+            return jsonify({
+                'success': False,
+                'error': f"Unknown templates: {', '.join(unknown)}"
+            }), 400
         
-        slides = cursor.fetchall()
+        for template_id, svg_content in templates:
+            get_compiled_template(template_id, svg_content)
         
-        # РЕАЛЬНАЯ ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЙ
-        for slide_id, template_id, replacements_json, slide_order, svg_content in slides:
-            try:
-                print(f"🎨 Генерирую слайд {slide_order} для карусели {carousel_id}")
-                
-                # Заменяем плейсхолдеры в SVG
-                processed_svg = replace_svg_placeholders(svg_content, replacements_json)
+        # Слайды с одинаковыми шаблоном, значениями и параметрами вывода
+        # рендерятся один раз: остальные ждут этот рендер (render_cache.begin)
+        # или копируют его из кэша
+        carousel_rows = []
+        slide_rows = []
+        unique_slides = set()
+        for carousel in batch:
+            carousel['id'] = str(uuid.uuid4())
+            variants_json = json.dumps(carousel['variants']) if carousel['variants'] else None
+            carousel_rows.append((carousel['id'], carousel['name'], *carousel['output'], variants_json))
+            
+            for order, (template_id, replacements) in enumerate(carousel['slides'], start=1):
+                slide_rows.append((str(uuid.uuid4()), carousel['id'], template_id, json.dumps(replacements), order))
+                unique_slides.add((template_id, json.dumps(replacements, sort_keys=True),
+                                   carousel['output'], variants_json))
+        
+        # Пачка принимается целиком или получает 429 до записи в базу
+        client = client_key()
+        render_queue.admit(len(slide_rows), client)
+        
+        with transaction() as conn:
+            conn.executemany('''
+                INSERT INTO carousels (id, name, status, output_format, output_quality, output_colors, variants)
+                VALUES (?, ?, 'queued', ?, ?, ?, ?)
+            ''', carousel_rows)
+            conn.executemany('''
+                INSERT INTO carousel_slides (id, carousel_id, template_id, replacements, slide_order)
+                VALUES (?, ?, ?, ?, ?)
+            ''', slide_rows)
+        
+        # Подписка до постановки в очередь: завершение не потеряется
+        carousel_ids = [carousel['id'] for carousel in batch]
+        subscription = event_broker.subscribe(*carousel_ids, names=('carousel-completed', 'carousel-failed'))
+        for carousel in batch:
+            render_queue.enqueue(carousel['id'], len(carousel['slides']), client)
+        
+        logger.info("Пачка каруселей поставлена в очередь",
+                    extra={'carousels': len(batch), 'slides': len(slide_rows), 'unique_slides': len(unique_slides)})
+        
+    except QueueFull as e:
+        return queue_full_response(e)
+    
+    except Exception as e:
+        logger.error("Ошибка создания пачки каруселей: %s", e)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    
+    def stream():
+        started = time.monotonic()
+        deadline = started + BATCH_WAIT_TIMEOUT
+        pending = {carousel['id']: index for index, carousel in enumerate(batch)}
+        totals = {'completed': 0, 'error': 0}
+        
+        yield format_ndjson({
+            'type': 'batch',
+            'carousels': [
+                {'index': index, 'ref': carousel['ref'], 'carouselId': carousel['id'],
+                 'statusUrl': f"/api/carousel/{carousel['id']}/slides"}
+                for index, carousel in enumerate(batch)
+            ],
+            'slides': len(slide_rows),
+            'uniqueSlides': len(unique_slides),
+            'templates': len(template_ids)
+        })
+        
+        def finished(carousel_id, timed_out=False):
+            index = pending.pop(carousel_id)
+            result = carousel_result(carousel_id)
+            if result['status'] in totals:
+                totals[result['status']] += 1
+            return format_ndjson({'type': 'carousel', 'index': index, 'ref': batch[index]['ref'],
+                                  'timedOut': timed_out, **result})
+        
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            event = subscription.get(timeout=min(SSE_HEARTBEAT_INTERVAL, remaining))
+            if event is not None:
+                if event[2]['carouselId'] in pending:
+                    yield finished(event[2]['carouselId'])
+                continue
+            
+            # Событий давно нет - сверяемся с базой (на случай потерянного
+            # события) и отдаем прогресс, чтобы соединение не простаивало
+            done = query_all(f'''
+                SELECT id FROM carousels
+                WHERE id IN ({', '.join('?' * len(pending))}) AND status IN ('completed', 'error')
+            ''', list(pending))
+            for (carousel_id,) in done:
+                yield finished(carousel_id)
+            if not done:
+                yield format_ndjson({'type': 'progress', 'pending': len(pending),
+                                     'completed': totals['completed'], 'failed': totals['error']})
+        
+        # Не дождались - отдаем текущий статус, дальше клиент опрашивает statusUrl
+        timed_out = len(pending)
+        for carousel_id in list(pending):
+            yield finished(carousel_id, timed_out=True)
+        
+        yield format_ndjson({
+            'type': 'done',
+            'carousels': len(batch),
+            'completed': totals['completed'],
+            'failed': totals['error'],
+            'timedOut': timed_out,
+            'elapsedMs': round((time.monotonic() - started) * 1000)
+        })
+    
+    response = Response(stream(), mimetype='application/x-ndjson')
+    # Отписка и при отключении клиента, и если поток так и не начали читать
+    response.call_on_close(subscription.close)
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/carousel/<carousel_id>/generate', methods=['POST'])
+def generate_carousel(carousel_id):
+    """Поставить генерацию карусели в очередь"""
+    try:
+        client = client_key()
+        reset = False
+        with transaction() as conn:
+            # Проверяем существование карусели
+            carousel = conn.execute('SELECT id, status FROM carousels WHERE id = ?', (carousel_id,)).fetchone()
+            
+            if not carousel:
+                return jsonify({
+                    'success': False,
+                    'error': 'Carousel not found'
+                }), 404
+            
+            status = carousel['status']
+            
+            # Генерация уже идет - не запускаем повторно
+            if status not in ('queued', 'generating'):
+                slides = conn.execute('SELECT COUNT(*) FROM carousel_slides WHERE carousel_id = ?',
+                                      (carousel_id,)).fetchone()[0]
+                # Допуск до изменений: при отказе карусель остается как была
+                render_queue.admit(slides, client)
                 
-                # Создаем путь для выходного файла
-                output_dir = os.path.join(OUTPUT_FOLDER, carousel_id)
-                output_filename = f"slide_{slide_order}.png"
-                output_path = os.path.join(output_dir, output_filename)
+                conn.execute('''
+                    UPDATE carousels 
+                    SET status = 'queued', completed_at = NULL, error_message = NULL, output_bytes = 0
+                    WHERE id = ?
+                ''', (carousel_id,))
                 
-                # Генерируем PNG
-                if generate_png_from_svg(processed_svg, output_path):
-                    # Создаем URL для доступа к файлу
-                    output_url = f"/output/{carousel_id}/{output_filename}"
-                    
-                    cursor.execute('''
-                        UPDATE carousel_slides 
-                        SET output_url = ?, status = 'completed'
-                        WHERE id = ?
-                    ''', (output_url, slide_id))
-                    
-                    print(f"✅ Слайд {slide_order} сгенерирован: {output_url}")
-                else:
-                    cursor.execute('''
-                        UPDATE carousel_slides 
-                        SET status = 'error'
-                        WHERE id = ?
-                    ''', (slide_id,))
-                    
-            except Exception as slide_error:
-                print(f"❌ Ошибка генерации слайда {slide_order}: {slide_error}")
-                cursor.execute('''
+                conn.execute('''
                     UPDATE carousel_slides 
-                    SET status = 'error'
-                    WHERE id = ?
-                ''', (slide_id,))
+                    SET status = 'pending', output_url = NULL,
+                        output_format = NULL, output_bytes = NULL, encode_ms = NULL
+                    WHERE carousel_id = ?
+                ''', (carousel_id,))
+                
+                conn.execute('''
+                    DELETE FROM carousel_slide_variants
+                    WHERE slide_id IN (SELECT id FROM carousel_slides WHERE carousel_id = ?)
+                ''', (carousel_id,))
+                
+                reset = True
+                status = 'queued'
+            else:
+                slides = conn.execute('''
+                    SELECT COUNT(*) FROM carousel_slides WHERE carousel_id = ? AND status = 'pending'
+                ''', (carousel_id,)).fetchone()[0]
         
-        # Обновляем статус карусели на "completed"
-        cursor.execute('''
-            UPDATE carousels 
-            SET status = 'completed', completed_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (carousel_id,))
+        # Файлы прошлой генерации больше не нужны: у новых другие имена
+        if reset:
+            output_storage.delete_prefix(f'{carousel_id}/')
         
-        conn.commit()
-        conn.close()
+        render_queue.enqueue(carousel_id, slides, client)
         
         return jsonify({
             'success': True,
             'carouselId': carousel_id,
-            'status': 'completed',
-            'message': 'Carousel generation completed'
-        })
+            'status': status,
+            'message': 'Carousel generation queued',
+            'statusUrl': f'/api/carousel/{carousel_id}/slides'
+        }), 202
         
+    except QueueFull as e:
+        return queue_full_response(e, carousel_id)
+    
     except Exception as e:
-        print(f"❌ Ошибка генерации карусели: {e}")
+        logger.error("Ошибка постановки карусели в очередь: %s", e, extra={'carousel_id': carousel_id})
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/carousel/<carousel_id>/pin', methods=['POST', 'DELETE'])
+def pin_carousel(carousel_id):
+    """Закрепить карусель (POST) или снять закрепление (DELETE): очистка не удаляет закрепленные"""
+    try:
+        pinned = request.method == 'POST'
+        with transaction() as conn:
+            updated = conn.execute('UPDATE carousels SET pinned = ? WHERE id = ?',
+                                   (int(pinned), carousel_id)).rowcount
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE carousels 
-            SET status = 'error', error_message = ?
-            WHERE id = ?
-        ''', (str(e), carousel_id))
-        conn.commit()
-        conn.close()
+        if not updated:
+            return jsonify({
+                'success': False,
+                'error': 'Carousel not found'
+            }), 404
         
+        return jsonify({
+            'success': True,
+            'carouselId': carousel_id,
+            'pinned': pinned
+        })
+        
+    except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+def carousel_result(carousel_id):
+    """Статус карусели, прогресс и слайды с вариантами; None, если карусели нет"""
+    # Получаем информацию о карусели
+    carousel_info = query_one('''
+        SELECT id, name, status, created_at, completed_at, error_message, pinned
+        FROM carousels WHERE id = ?
+    ''', (carousel_id,))
+    
+    if not carousel_info:
+        return None
+    
+    carousel_id, name, status, created_at, completed_at, error_message, pinned = carousel_info
+    
+    # Получаем слайды
+    rows = query_all('''
+        SELECT id, template_id, output_url, status, slide_order,
+               output_format, output_bytes, encode_ms
+        FROM carousel_slides 
+        WHERE carousel_id = ?
+        ORDER BY slide_order
+    ''', (carousel_id,))
+    
+    # Варианты размеров всех слайдов одним запросом
+    variant_rows = query_all('''
+        SELECT v.slide_id, v.name, v.width, v.height, v.output_url, v.output_bytes
+        FROM carousel_slides cs
+        JOIN carousel_slide_variants v ON v.slide_id = cs.id
+        WHERE cs.carousel_id = ?
+        ORDER BY v.width
+    ''', (carousel_id,))
+    
+    variants_by_slide = {}
+    for slide_id, variant_name, width, height, variant_url, variant_bytes in variant_rows:
+        variants_by_slide.setdefault(slide_id, []).append({
+            'name': variant_name,
+            'width': width,
+            'height': height,
+            'url': public_output_url(variant_url),
+            'bytes': variant_bytes
+        })
+    
+    slides = []
+    for row in rows:
+        slide_id, template_id, output_url, slide_status, slide_order, output_format, output_bytes, encode_ms = row
+        variants = variants_by_slide.get(slide_id, [])
+        slides.append({
+            'id': slide_id,
+            'templateId': template_id,
+            'slideNumber': slide_order,
+            'imageUrl': public_output_url(output_url),
+            'status': slide_status,
+            'format': output_format,
+            'bytes': output_bytes,
+            # None - слайд взят из кэша и не кодировался заново
+            'encodeMs': encode_ms,
+            'variants': variants,
+            # srcset из масштабов шаблона (1x/2x/3x) - у них общие пропорции
+            'srcset': ', '.join(
+                f"{variant['url']} {variant['width']}w"
+                for variant in variants if 'scale' in VARIANT_PRESETS.get(variant['name'], {})
+            ) or None
+        })
+    
+    # Прогресс генерации
+    completed_count = sum(1 for slide in slides if slide['status'] == 'completed')
+    failed_count = sum(1 for slide in slides if slide['status'] == 'error')
+    total_count = len(slides)
+    
+    return {
+        'carouselId': carousel_id,
+        'name': name,
+        'status': status,
+        'progress': {
+            'total': total_count,
+            'completed': completed_count,
+            'failed': failed_count,
+            'pending': total_count - completed_count - failed_count,
+            'percent': round(100 * (completed_count + failed_count) / total_count) if total_count else 100
+        },
+        'slides': slides,
+        'totalBytes': sum(slide['bytes'] or 0 for slide in slides),
+        # Закрепленную карусель очистка не удаляет
+        'pinned': bool(pinned),
+        'createdAt': created_at,
+        'completedAt': completed_at,
+        'errorMessage': error_message
+    }
+
 @app.route('/api/carousel/<carousel_id>/slides', methods=['GET'])
 def get_carousel_slides(carousel_id):
     """Получить результаты генерации карусели"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
+        result = carousel_result(carousel_id)
         
-        # Получаем информацию о карусели
-        cursor.execute('''
-            SELECT id, name, status, created_at, completed_at, error_message
-            FROM carousels WHERE id = ?
-        ''', (carousel_id,))
+        if result is None:
+            return jsonify({
+                'success': False,
+                'error': 'Carousel not found'
+            }), 404
         
-        carousel_info = cursor.fetchone()
+        janitor.touch(carousel_id)
+        return conditional_json({'success': True, **result})
         
-        if not carousel_info:
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def iter_carousel_files(carousel_id, variant):
+    """(имя, байты) готовых слайдов по мере рендеринга, пока карусель генерируется"""
+    if variant == PRIMARY_VARIANT:
+        sql = '''
+            SELECT id, slide_order, output_url FROM carousel_slides
+            WHERE carousel_id = ? AND status = 'completed'
+            ORDER BY slide_order
+        '''
+        params = (carousel_id,)
+        suffix = ''
+    else:
+        sql = '''
+            SELECT cs.id, cs.slide_order, v.output_url
+            FROM carousel_slides cs
+            JOIN carousel_slide_variants v ON v.slide_id = cs.id AND v.name = ?
+            WHERE cs.carousel_id = ? AND cs.status = 'completed'
+            ORDER BY cs.slide_order
+        '''
+        params = (variant, carousel_id)
+        suffix = f'_{variant}'
+    
+    sent = set()
+    deadline = time.monotonic() + ARCHIVE_WAIT_TIMEOUT
+    
+    # Подписываемся до первой выборки, чтобы не пропустить событие между ними
+    with event_broker.subscribe(carousel_id) as subscription:
+        while True:
+            # Статус читаем до слайдов: если генерация уже закончилась,
+            # следующая выборка гарантированно содержит все слайды
+            carousel = query_one('SELECT status FROM carousels WHERE id = ?', (carousel_id,))
+            generating = carousel is not None and carousel['status'] in ('queued', 'generating')
+            
+            for slide_id, slide_order, output_url in query_all(sql, params):
+                if slide_id in sent or not output_url:
+                    continue
+                sent.add(slide_id)
+                
+                data = output_storage.get(output_url[len('/output/'):])
+                if data is None:
+                    logger.warning("Файл слайда не найден", extra={'carousel_id': carousel_id, 'slide': slide_order})
+                    continue
+                
+                extension = output_url.rsplit('.', 1)[-1]
+                yield f"slide_{slide_order:02d}{suffix}.{extension}", data
+            
+            if not generating:
+                break
+            
+            # Ждем следующего события генерации вместо опроса базы
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            subscription.get(timeout=remaining)
+
+@app.route('/api/carousel/<carousel_id>/archive', methods=['GET'])
+def download_carousel_archive(carousel_id):
+    """Скачать все слайды карусели одним ZIP архивом.
+    
+    Архив отдается потоково: готовые слайды уходят клиенту сразу, а
+    слайды, которые еще рендерятся, дописываются по мере готовности.
+    """
+    try:
+        variant = request.args.get('variant', PRIMARY_VARIANT)
+        
+        carousel = query_one('SELECT id, variants FROM carousels WHERE id = ?', (carousel_id,))
+        if not carousel:
             return jsonify({
                 'success': False,
                 'error': 'Carousel not found'
             }), 404
         
-        carousel_id, name, status, created_at, completed_at, error_message = carousel_info
+        requested_variants = json.loads(carousel['variants']) if carousel['variants'] else []
+        if variant != PRIMARY_VARIANT and variant not in requested_variants:
+            return jsonify({
+                'success': False,
+                'error': f'Variant {variant} was not requested for this carousel'
+            }), 400
         
-        # Получаем слайды
-        cursor.execute('''
-            SELECT id, template_id, output_url, status, slide_order
-            FROM carousel_slides 
-            WHERE carousel_id = ?
-            ORDER BY slide_order
-        ''', (carousel_id,))
+        janitor.touch(carousel_id)
         
-        slides = []
-        for row in cursor.fetchall():
-            slide_id, template_id, output_url, slide_status, slide_order = row
-            slides.append({
-                'id': slide_id,
-                'templateId': template_id,
-                'slideNumber': slide_order,
-                'imageUrl': f"https://svg-template-api-server.onrender.com{output_url}" if output_url else None,
-                'status': slide_status
-            })
-        
-        conn.close()
+        response = Response(iter_zip(iter_carousel_files(carousel_id, variant)), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="carousel-{carousel_id}.zip"'
+        # Прокси не должен буферизовать поток - клиент получает слайды сразу
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
         
+    except Exception as e:
         return jsonify({
-            'success': True,
-            'carouselId': carousel_id,
-            'name': name,
-            'status': status,
-            'slides': slides,
-            'createdAt': created_at,
-            'completedAt': completed_at,
-            'errorMessage': error_message
-        })
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/carousel/<carousel_id>/events', methods=['GET'])
+def carousel_events(carousel_id):
+    """Поток событий генерации карусели (Server-Sent Events).
+    
+    При подключении отдается текущее состояние слайдов, затем события
+    slide-completed, slide-error и carousel-completed / carousel-failed по мере
+    рендеринга. Поток питается от in-process pub/sub и базу не опрашивает.
+    """
+    # Подписка до снимка состояния: событие между ними не потеряется
+    subscription = event_broker.subscribe(carousel_id)
+    
+    try:
+        carousel = query_one('SELECT status, error_message FROM carousels WHERE id = ?', (carousel_id,))
+        if not carousel:
+            subscription.close()
+            return jsonify({
+                'success': False,
+                'error': 'Carousel not found'
+            }), 404
         
+        rows = query_all('''
+            SELECT id, slide_order, status, output_url, output_format, output_bytes
+            FROM carousel_slides 
+            WHERE carousel_id = ?
+            ORDER BY slide_order
+        ''', (carousel_id,))
     except Exception as e:
+        subscription.close()
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
+    
+    def stream():
+        # Слайд мог попасть и в снимок, и в событие - отдаем его один раз
+        sent = set()
+        
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        
+        for slide_id, slide_order, slide_status, output_url, output_format, output_bytes in rows:
+            if slide_status in ('completed', 'error'):
+                name, data = slide_event(carousel_id, slide_id, slide_order, slide_status,
+                                         output_url, output_format, output_bytes)
+                sent.add((slide_id, data['status'], data['imageUrl']))
+                yield format_sse(name, data)
+        
+        if carousel['status'] in ('completed', 'error'):
+            yield format_sse(*carousel_event(carousel_id, carousel['status'], carousel['error_message']))
+            return
+        
+        while True:
+            event = subscription.get(timeout=SSE_HEARTBEAT_INTERVAL)
+            if event is None:
+                # Комментарий держит соединение и выявляет отключившихся клиентов
+                yield ': keep-alive\n\n'
+                continue
+            
+            event_id, name, data = event
+            if name.startswith('slide-'):
+                key = (data['slideId'], data['status'], data['imageUrl'])
+                if key in sent:
+                    continue
+                sent.add(key)
+            
+            yield format_sse(name, data, event_id)
+            
+            if name.startswith('carousel-'):
+                return
+    
+    response = Response(stream(), mimetype='text/event-stream')
+    # Отписка и при отключении клиента, и если поток так и не начали читать
+    response.call_on_close(subscription.close)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 # ENDPOINT ДЛЯ СТАТИЧЕСКИХ ФАЙЛОВ С ПРАВИЛЬНЫМИ CORS
 @app.route('/output/<path:filename>')
 def serve_output_file(filename):
     """Отдает сгенерированные изображения с правильными CORS заголовками"""
     try:
-        response = send_from_directory(OUTPUT_FOLDER, filename)
+        if output_storage.local_path(filename) is not None:
+            response = send_from_directory(output_storage.root, filename)
+        else:
+            data = output_storage.get(filename)
+            if data is None:
+                raise FileNotFoundError(filename)
+            
+            response = Response(data, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.set_etag(hashlib.sha1(data).hexdigest())
+            response = response.make_conditional(request)
+        
+        # Файлы с хэшем содержимого в имени никогда не меняются
+        if is_content_hashed(filename):
+            set_immutable(response)
+        
+        # Обращение к файлам карусели продлевает ей жизнь при очистке
+        carousel_id = filename.split('/', 1)[0]
+        if carousel_id != CACHE_PREFIX:
+            janitor.touch(carousel_id)
         
         # Добавляем CORS заголовки для изображений
         response.headers.add('Access-Control-Allow-Origin', 'https://agentflow-marketing-hub.vercel.app')
@@ -577,7 +1749,10 @@ def serve_output_file(filename):
             'error': f'File not found: {filename}'
         }), 404
 
+startup['import_ms'] = elapsed_ms(IMPORT_STARTED)
+
 if __name__ == '__main__':
+    start_services()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
 
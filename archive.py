@@ -0,0 +1,47 @@
+"""
+Потоковая сборка ZIP архива.
+
+Архив отдается кусками по мере поступления файлов: zipfile пишет в объект
+без seek/tell, поэтому размеры и CRC каждого файла идут в data descriptor
+после данных, а центральный каталог - в самом конце. Ни архив целиком, ни
+временный файл не создаются.
+"""
+
+import time
+import zipfile
+
+
+class _ChunkWriter:
+    """Файловый объект только для записи: копит куски до следующего yield"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(files):
+    """Генератор байтов ZIP архива из итератора (имя, байты).
+
+    Изображения уже сжаты, поэтому файлы кладутся без сжатия (ZIP_STORED).
+    """
+    writer = _ChunkWriter()
+
+    with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, data in files:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            archive.writestr(info, data)
+            yield writer.take()
+
+    # Центральный каталог записывается при закрытии архива
+    yield writer.take()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк: пропускная способность опроса /api/carousel/<id>/slides во время
+активной генерации.
+
+Сравнивает старый доступ к базе (новое sqlite3.connect на каждый запрос,
+журнал по умолчанию) со слоем db.py (соединение на поток, WAL, PRAGMA).
+Писатель имитирует цикл рендеринга: обновляет слайд и делает commit,
+читатели выполняют те же два запроса, что и get_carousel_slides.
+
+    python benchmarks/db_polling.py --readers 8 --seconds 5
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS carousels (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        completed_at TIMESTAMP,
+        error_message TEXT
+    );
+    CREATE TABLE IF NOT EXISTS carousel_slides (
+        id TEXT PRIMARY KEY,
+        carousel_id TEXT NOT NULL,
+        template_id TEXT NOT NULL,
+        replacements TEXT NOT NULL,
+        slide_order INTEGER NOT NULL,
+        output_url TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+'''
+
+CAROUSEL_QUERY = '''
+    SELECT id, name, status, created_at, completed_at, error_message
+    FROM carousels WHERE id = ?
+'''
+
+SLIDES_QUERY = '''
+    SELECT id, template_id, output_url, status, slide_order
+    FROM carousel_slides
+    WHERE carousel_id = ?
+    ORDER BY slide_order
+'''
+
+
+def seed(path, carousels, slides_per_carousel):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    carousel_ids = []
+    for _ in range(carousels):
+        carousel_id = str(uuid.uuid4())
+        carousel_ids.append(carousel_id)
+        conn.execute("INSERT INTO carousels (id, name, status) VALUES (?, 'bench', 'generating')",
+                     (carousel_id,))
+        conn.executemany('''
+            INSERT INTO carousel_slides (id, carousel_id, template_id, replacements, slide_order)
+            VALUES (?, ?, 'sold-main', '{}', ?)
+        ''', [(str(uuid.uuid4()), carousel_id, i + 1) for i in range(slides_per_carousel)])
+    conn.commit()
+    conn.close()
+    return carousel_ids
+
+
+def legacy_poll(path, carousel_id):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute(CAROUSEL_QUERY, (carousel_id,))
+    cursor.fetchone()
+    cursor.execute(SLIDES_QUERY, (carousel_id,))
+    cursor.fetchall()
+    conn.close()
+
+
+def pooled_poll(path, carousel_id):
+    db.query_one(CAROUSEL_QUERY, (carousel_id,))
+    db.query_all(SLIDES_QUERY, (carousel_id,))
+
+
+def legacy_write(path, carousel_id, slide_order):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        UPDATE carousel_slides SET status = 'completed', output_url = '/output/x.png'
+        WHERE carousel_id = ? AND slide_order = ?
+    ''', (carousel_id, slide_order))
+    conn.commit()
+    conn.close()
+
+
+def pooled_write(path, carousel_id, slide_order):
+    db.execute('''
+        UPDATE carousel_slides SET status = 'completed', output_url = '/output/x.png'
+        WHERE carousel_id = ? AND slide_order = ?
+    ''', (carousel_id, slide_order))
+
+
+def run(mode, readers, seconds, carousels, slides_per_carousel, write_interval):
+    workdir = tempfile.mkdtemp(prefix=f'bench_{mode}_')
+    path = os.path.join(workdir, 'templates.db')
+    carousel_ids = seed(path, carousels, slides_per_carousel)
+
+    if mode == 'pooled':
+        db.configure(path)
+        poll, write = pooled_poll, pooled_write
+    else:
+        poll, write = legacy_poll, legacy_write
+
+    stop = threading.Event()
+    counts = [0] * readers
+    errors = [0] * readers
+    writes = [0]
+
+    def reader(index):
+        i = index
+        while not stop.is_set():
+            try:
+                poll(path, carousel_ids[i % len(carousel_ids)])
+                counts[index] += 1
+            except sqlite3.OperationalError:
+                errors[index] += 1
+            i += 1
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            carousel_id = carousel_ids[i % len(carousel_ids)]
+            write(path, carousel_id, i % slides_per_carousel + 1)
+            writes[0] += 1
+            i += 1
+            time.sleep(write_interval)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    total = sum(counts)
+    return {
+        'mode': mode,
+        'polls_per_sec': round(total / seconds, 1),
+        'polls': total,
+        'errors': sum(errors),
+        'writes': writes[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--carousels', type=int, default=200)
+    parser.add_argument('--slides', type=int, default=10)
+    parser.add_argument('--write-interval', type=float, default=0.005,
+                        help='пауза между записями слайдов, сек')
+    args = parser.parse_args()
+
+    results = [
+        run(mode, args.readers, args.seconds, args.carousels, args.slides, args.write_interval)
+        for mode in ('legacy', 'pooled')
+    ]
+
+    print(f"{'mode':<8} {'polls/s':>10} {'polls':>10} {'errors':>8} {'writes':>8}")
+    for result in results:
+        print(f"{result['mode']:<8} {result['polls_per_sec']:>10} {result['polls']:>10} "
+              f"{result['errors']:>8} {result['writes']:>8}")
+
+    legacy, pooled = results
+    if legacy['polls_per_sec']:
+        print(f"speedup: x{pooled['polls_per_sec'] / legacy['polls_per_sec']:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Проверка и замер загрузки картинок по URL (remote_images.py) на локальной
+HTTP заглушке.
+
+Заглушка на 127.0.0.1 отдает сгенерированную фотографию (по умолчанию
+12 Мп JPEG) с ETag и ответом 304 на If-None-Match, медленный ответ и
+ответ не-картинку, и считает запросы. Сценарии:
+
+    cold          - первая загрузка: один GET 200, уменьшенная копия размером со слот
+    warm          - повтор в пределах ttl: без запросов, из дискового кэша
+    revalidate    - ttl истек: условный запрос, ответ 304 без тела
+    etag-change   - картинка поменялась: новый ETag, новая запись кэша
+    dedup         - одна и та же картинка в нескольких слайдах: один запрос
+    concurrency   - много разных картинок: одновременных запросов не больше лимита
+    failures      - таймаут и не-картинка: прозрачный слот, без исключений
+    ssrf          - без REMOTE_IMAGE_ALLOW_PRIVATE: loopback (и HTTP:// в верхнем регистре) и
+                    169.254.169.254 не запрашиваются; file:// и пустой слот - прозрачный пиксель
+    redirect      - каждый шаг редиректа проверяется: переход на чужой хост отклоняется
+    cache-budget  - дисковый кэш не превышает max_cache_bytes, старое вытесняется
+
+Если хоть одна проверка не прошла, скрипт завершается с кодом 1. Время
+сценариев печатается рядом; при доступном cairosvg дополнительно
+сравнивается растеризация слайда с оригиналом и с уменьшенной копией.
+
+    python benchmarks/image_fetch.py
+    python benchmarks/image_fetch.py --megapixels 24 --concurrency 4
+"""
+
+import argparse
+import base64
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SLIDE = '''<svg width="400" height="600" xmlns="http://www.w3.org/2000/svg">
+    <rect width="400" height="600" fill="#fff"/>
+    <image x="50" y="50" width="300" height="200" preserveAspectRatio="xMidYMid slice" href="{dyno.propertyphoto}"/>
+    <text x="200" y="300" text-anchor="middle" font-size="20" fill="#333">{dyno.propertyaddress}</text>
+</svg>'''
+
+
+def make_photo(megapixels):
+    """JPEG размером megapixels: градиент с шумом, сжимается как фотография"""
+    from PIL import Image
+
+    width = round((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = round(width * 3 / 4)
+    noise = Image.effect_noise((width, height), 24)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', (gradient, noise, gradient.rotate(90).resize((width, height))))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=85)
+    return output.getvalue(), (width, height)
+
+
+class StandIn:
+    """Локальный HTTP сервер картинок с ETag и счетчиками запросов"""
+
+    def __init__(self, photo, slow_seconds):
+        self.photo = photo
+        self.slow_seconds = slow_seconds
+        self.version = 1
+        self.lock = threading.Lock()
+        self.requests = []  # (путь, статус)
+        self.active = 0
+        self.max_active = 0
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stand_in.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, handler):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            path = handler.path.split('?', 1)[0]
+            etag = f'"photo-v{self.version}"'
+            if path == '/slow.jpg':
+                time.sleep(self.slow_seconds)
+                status, body, content_type = 200, self.photo, 'image/jpeg'
+            elif path == '/redirect':
+                target = handler.path.split('to=', 1)[1]
+                with self.lock:
+                    self.requests.append((path, 302))
+                handler.send_response(302)
+                handler.send_header('Location', target)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            elif path == '/page.html':
+                status, body, content_type = 200, b'<html></html>', 'text/html'
+            elif path == '/photo.jpg':
+                # Немного задержки, чтобы параллельные загрузки пересекались
+                time.sleep(0.05)
+                if handler.headers.get('If-None-Match') == etag:
+                    status, body, content_type = 304, b'', None
+                else:
+                    status, body, content_type = 200, self.photo, 'image/jpeg'
+            else:
+                status, body, content_type = 404, b'', 'text/plain'
+
+            with self.lock:
+                self.requests.append((path, status))
+
+            handler.send_response(status)
+            if path == '/photo.jpg':
+                handler.send_header('ETag', etag)
+            if content_type:
+                handler.send_header('Content-Type', content_type)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            try:
+                handler.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def take(self):
+        """Запросы с прошлого вызова"""
+        with self.lock:
+            requests, self.requests = self.requests, []
+            self.max_active = 0
+            return requests
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def decode(data_uri):
+    from PIL import Image
+
+    return Image.open(io.BytesIO(base64.b64decode(data_uri.split(',', 1)[1])))
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, default=12, help='размер фотографии заглушки')
+    parser.add_argument('--concurrency', type=int, default=4, help='лимит одновременных загрузок')
+    parser.add_argument('--urls', type=int, default=16, help='разных картинок в сценарии concurrency')
+    parser.add_argument('--timeout', type=float, default=1.0, help='таймаут загрузки, сек')
+    parser.add_argument('--scale', type=float, default=2.0, help='масштаб растра слайда (2 = вариант 2x)')
+    args = parser.parse_args()
+
+    from remote_images import RemoteImages, TRANSPARENT_PIXEL
+
+    photo, photo_size = make_photo(args.megapixels)
+    stand_in = StandIn(photo, slow_seconds=args.timeout * 3)
+    cache_dir = tempfile.mkdtemp(prefix='image-cache-')
+    # Заглушка на 127.0.0.1 - внутренние адреса разрешаем явно
+    remote = RemoteImages(cache_dir, max_concurrency=args.concurrency, timeout=args.timeout, ttl=3600,
+                          allow_private=True)
+    slot = (round(300 * args.scale), round(200 * args.scale))
+    photo_url = f'{stand_in.url}/photo.jpg'
+
+    print(f'stand-in {stand_in.url}: photo {photo_size[0]}x{photo_size[1]} JPEG, {len(photo) / 1e6:.1f} MB; '
+          f'slot {slot[0]}x{slot[1]}')
+
+    rows = []
+
+    def check(name, ok, elapsed_ms, detail):
+        rows.append((name, ok, elapsed_ms, detail))
+
+    def embed(url):
+        replacements = {'dyno.propertyphoto': url, 'dyno.propertyaddress': '1 Main St'}
+        return remote.embed(SLIDE, replacements, args.scale)['dyno.propertyphoto']
+
+    try:
+        stand_in.take()
+        value, elapsed = timed(lambda: embed(photo_url))
+        requests = stand_in.take()
+        image = decode(value)
+        covers = image.width >= slot[0] and image.height >= slot[1] and min(
+            image.width - slot[0], image.height - slot[1]) <= 1
+        check('cold', requests == [('/photo.jpg', 200)] and covers, elapsed,
+              f'{requests}, embedded {image.width}x{image.height} PNG, {len(value) / 1e3:.0f} KB data URI')
+        scaled_uri = value
+
+        value, elapsed = timed(lambda: embed(photo_url))
+        requests = stand_in.take()
+        check('warm', requests == [] and value == scaled_uri, elapsed, f'{requests}')
+
+        remote.ttl = 0
+        value, elapsed = timed(lambda: embed(photo_url))
+        requests = stand_in.take()
+        check('revalidate', requests == [('/photo.jpg', 304)] and value == scaled_uri, elapsed, f'{requests}')
+
+        stand_in.version += 1
+        before = len(os.listdir(cache_dir))
+        value, elapsed = timed(lambda: embed(photo_url))
+        requests = stand_in.take()
+        new_entries = len(os.listdir(cache_dir)) - before
+        check('etag-change', requests == [('/photo.jpg', 200)] and new_entries == 2, elapsed,
+              f'{requests}, {new_entries} new cache files')
+        remote.ttl = 3600
+
+        # Один URL в нескольких слайдах карусели: загрузки объединяются
+        dedup_url = f'{photo_url}?dedup'
+        with ThreadPoolExecutor(8) as executor:
+            values, elapsed = timed(lambda: list(executor.map(lambda _: embed(dedup_url), range(8))))
+        requests = stand_in.take()
+        check('dedup', len(requests) == 1 and len(set(values)) == 1, elapsed, f'{len(requests)} request(s) for 8 slides')
+
+        # Разные картинки: загружаются параллельно, но не больше лимита
+        urls = [f'{photo_url}?n={n}' for n in range(args.urls)]
+        started = time.perf_counter()
+        futures = [remote.prefetch(SLIDE, {'dyno.propertyphoto': url}, args.scale) for url in urls]
+        values = [future.result() for slide in futures for _, future in slide]
+        elapsed = (time.perf_counter() - started) * 1000
+        max_active = stand_in.max_active
+        requests = stand_in.take()
+        check('concurrency', len(requests) == args.urls and 1 < max_active <= args.concurrency
+              and TRANSPARENT_PIXEL not in values, elapsed,
+              f'{len(requests)} requests, at most {max_active} at once (limit {args.concurrency})')
+
+        failed_before = remote.stats()['failed']
+        values, elapsed = timed(lambda: [embed(f'{stand_in.url}/slow.jpg'), embed(f'{stand_in.url}/page.html'),
+                                         embed(f'{stand_in.url}/missing.jpg')])
+        stand_in.take()
+        failed = remote.stats()['failed'] - failed_before
+        check('failures', values == [TRANSPARENT_PIXEL] * 3 and failed == 3 and elapsed < args.timeout * 2500,
+              elapsed, f'{failed} failed, transparent slots')
+
+        # Настройки по умолчанию: внутренние адреса запрещены, сеть не трогается
+        strict = RemoteImages(os.path.join(cache_dir, 'strict'), timeout=args.timeout)
+        failed_before = strict.stats()['failed']
+        values, elapsed = timed(lambda: [
+            strict.embed(SLIDE, {'dyno.propertyphoto': url}, args.scale)['dyno.propertyphoto']
+            for url in (photo_url, 'http://169.254.169.254/latest/meta-data/', 'http://[::1]/x.jpg',
+                        photo_url.replace('http://', 'HTTP://'), 'file:///etc/passwd', None)])
+        requests = stand_in.take()
+        # file:// и отсутствующее значение не загружаются вовсе - ошибкой не считаются
+        check('ssrf', values == [TRANSPARENT_PIXEL] * 6 and requests == [] and strict.stats()['failed'] - failed_before == 4,
+              elapsed, f'{len(requests)} requests reached the stand-in')
+        strict.shutdown()
+
+        # Разрешен только localhost: редирект на 127.0.0.1 отклоняется на втором шаге
+        port = stand_in.url.rsplit(':', 1)[1]
+        limited = RemoteImages(os.path.join(cache_dir, 'limited'), timeout=args.timeout, allowed_hosts=('localhost',),
+                               allow_private=True)
+        values, elapsed = timed(lambda: [
+            limited.embed(SLIDE, {'dyno.propertyphoto': f'http://localhost:{port}/redirect?to={target}'},
+                          args.scale)['dyno.propertyphoto']
+            for target in (f'http://localhost:{port}/photo.jpg?redirected', f'{stand_in.url}/photo.jpg?escaped')])
+        requests = stand_in.take()
+        check('redirect', values[0] != TRANSPARENT_PIXEL and values[1] == TRANSPARENT_PIXEL
+              and ('/photo.jpg', 200) in requests and len(requests) == 3, elapsed,
+              f'{requests}')
+        limited.shutdown()
+
+        # Бюджет кэша - примерно на три оригинала
+        budget = len(photo) * 3
+        budget_dir = os.path.join(cache_dir, 'budget')
+        budgeted = RemoteImages(budget_dir, timeout=args.timeout, max_cache_bytes=budget, allow_private=True)
+        _, elapsed = timed(lambda: [
+            budgeted.embed(SLIDE, {'dyno.propertyphoto': f'{photo_url}?budget={n}'}, args.scale)
+            for n in range(8)])
+        stand_in.take()
+        used = sum(entry.stat().st_size for entry in os.scandir(budget_dir))
+        stats = budgeted.stats()
+        check('cache-budget', used <= budget and stats['evicted'] > 0, elapsed,
+              f'{used / 1e6:.1f} MB on disk, budget {budget / 1e6:.1f} MB, {stats["evicted"]} files evicted')
+        budgeted.shutdown()
+
+        rasterise(photo, scaled_uri, rows)
+    finally:
+        remote.shutdown()
+        stand_in.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"{'scenario':<24} {'ms':>9}  {'result':<6} detail")
+    for name, ok, elapsed, detail in rows:
+        result = '-' if ok is None else ('ok' if ok else 'FAIL')
+        print(f'{name:<24} {elapsed:>9.1f}  {result:<6} {detail}')
+
+    failed = [name for name, ok, _, _ in rows if ok is False]
+    if failed:
+        print(f'{len(failed)} check(s) failed: {", ".join(failed)}')
+        return 1
+    return 0
+
+
+def rasterise(photo, scaled_uri, rows):
+    """Растеризация слайда с оригиналом и с уменьшенной копией, если есть cairosvg"""
+    try:
+        from renderer import rasterise_image
+        rasterise_image('<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"/>', 1, 1)
+    except (ImportError, OSError) as e:
+        rows.append(('rasterise', None, 0.0, f'skipped: cairosvg is not available ({str(e).splitlines()[0]})'))
+        return
+
+    original_uri = 'data:image/jpeg;base64,' + base64.b64encode(photo).decode('ascii')
+    for name, uri in (('rasterise/original', original_uri), ('rasterise/scaled', scaled_uri)):
+        svg = SLIDE.replace('{dyno.propertyphoto}', uri)
+        _, elapsed = timed(lambda: rasterise_image(svg, 800, 1200))
+        rows.append((name, None, elapsed, 'slide 800x1200'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
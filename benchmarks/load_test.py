@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест HTTP API.
+
+Поднимает сервер локально (gunicorn во временной папке со своей базой) и
+гоняет виртуальных пользователей. Каждый пользователь повторяет сценарий
+фронтенда: create-and-generate карусели со случайным шаблоном и числом
+слайдов, опрос /slides до завершения и загрузка готовых файлов из /output.
+
+По каждому endpoint'у выводятся пропускная способность, p50/p95/p99 и доля
+ошибок; строка carousel - время от создания карусели до готовности всех
+слайдов. Матрица --modes x --workers позволяет сравнить конфигурации
+сервера на одной машине:
+
+    sync     - gunicorn, синхронные воркеры (запрос на процесс)
+    gthread  - gunicorn, потоки в воркере (--threads)
+    gevent   - gunicorn, асинхронные воркеры (нужен пакет gevent)
+
+    python benchmarks/load_test.py --users 32 --duration 30
+    python benchmarks/load_test.py --modes sync,gthread --workers 1,2,4 --json results.json
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --users 8
+"""
+
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_MODES = {
+    'sync': ['--worker-class', 'sync'],
+    'gthread': ['--worker-class', 'gthread'],
+    'gevent': ['--worker-class', 'gevent'],
+}
+
+# Тестовые шаблоны из init_database и их доли в нагрузке
+TEMPLATE_MIX = {
+    'open-house-main': 4,
+    'open-house-photo': 2,
+    'sold-main': 3,
+    'sold-photo': 1,
+}
+
+# Число слайдов в карусели -> доля
+SLIDE_COUNT_MIX = {
+    1: 2,
+    3: 4,
+    5: 3,
+    10: 1,
+}
+
+REPLACEMENTS = {
+    'dyno.propertyaddress': '123 Main Street, Springfield',
+    'dyno.phone': '+1 555 0100',
+    'dyno.date': 'Saturday, May 4',
+    'dyno.time': '1-4 PM',
+}
+
+ENDPOINTS = ('create-and-generate', 'slides', 'output', 'carousel')
+
+
+def weighted_choice(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Recorder:
+    """Копит задержки и ошибки по endpoint'ам; пишут все потоки пользователей"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+        self.recording = False
+
+    def record(self, endpoint, seconds, ok):
+        if not self.recording:
+            return
+        with self._lock:
+            if ok:
+                self.latencies[endpoint].append(seconds)
+            else:
+                self.errors[endpoint] += 1
+
+    def summary(self, duration):
+        report = {}
+        for endpoint in ENDPOINTS:
+            values = sorted(self.latencies[endpoint])
+            total = len(values) + self.errors[endpoint]
+            if not total:
+                continue
+            report[endpoint] = {
+                'requests': total,
+                'throughput': round(total / duration, 2),
+                'error_rate': round(self.errors[endpoint] / total, 4),
+                'p50_ms': _ms(percentile(values, 0.50)),
+                'p95_ms': _ms(percentile(values, 0.95)),
+                'p99_ms': _ms(percentile(values, 0.99)),
+            }
+        return report
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+class VirtualUser(threading.Thread):
+    """Пользователь с собственным keep-alive соединением"""
+
+    def __init__(self, base_url, recorder, stop, args, seed):
+        super().__init__(daemon=True)
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.recorder = recorder
+        self.stop = stop
+        self.args = args
+        self.rng = random.Random(seed)
+        self.connection = None
+        self.sequence = 0
+
+    def request(self, endpoint, method, path, body=None):
+        """Выполняет запрос и пишет замер; возвращает (статус, тело) или None"""
+        headers = {'Accept': 'application/json'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        started = time.perf_counter()
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.args.request_timeout)
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+            status = response.status
+            if response.will_close:
+                self.connection.close()
+                self.connection = None
+        except (OSError, http.client.HTTPException):
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            self.recorder.record(endpoint, time.perf_counter() - started, False)
+            return None
+
+        self.recorder.record(endpoint, time.perf_counter() - started, status < 400)
+        return status, data
+
+    def run(self):
+        while not self.stop.is_set():
+            self.carousel()
+            if self.args.think_time:
+                self.stop.wait(self.rng.uniform(0, 2 * self.args.think_time))
+
+    def carousel(self):
+        template_id = weighted_choice(self.rng, TEMPLATE_MIX)
+        slide_count = weighted_choice(self.rng, SLIDE_COUNT_MIX)
+        self.sequence += 1
+        slides = [
+            {'templateId': template_id,
+             'replacements': {**REPLACEMENTS, 'dyno.name': f'Agent {self.ident} {self.sequence}-{i}'}}
+            for i in range(slide_count)
+        ]
+
+        started = time.perf_counter()
+        result = self.request('create-and-generate', 'POST', '/api/carousel/create-and-generate',
+                              {'name': 'load test', 'slides': slides})
+        if result is None or result[0] >= 400:
+            return
+        carousel_id = json.loads(result[1])['carouselId']
+
+        deadline = time.monotonic() + self.args.carousel_timeout
+        carousel = None
+        while not self.stop.is_set() and time.monotonic() < deadline:
+            result = self.request('slides', 'GET', f'/api/carousel/{carousel_id}/slides')
+            if result is not None and result[0] == 200:
+                carousel = json.loads(result[1])
+                if carousel['status'] in ('completed', 'failed'):
+                    break
+            self.stop.wait(self.args.poll_interval)
+        else:
+            if not self.stop.is_set():
+                self.recorder.record('carousel', time.perf_counter() - started, False)
+            return
+
+        self.recorder.record('carousel', time.perf_counter() - started, carousel['status'] == 'completed')
+
+        for slide in carousel.get('slides', []):
+            if self.stop.is_set():
+                return
+            if slide.get('imageUrl'):
+                self.request('output', 'GET', urlsplit(slide['imageUrl']).path)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(base_url, timeout):
+    parts = urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+class LocalServer:
+    """gunicorn с приложением во временной папке"""
+
+    def __init__(self, mode, workers, args):
+        self.mode = mode
+        self.workers = workers
+        self.args = args
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.workdir = tempfile.mkdtemp(prefix=f'load_{mode}_{workers}_')
+        self.process = None
+        self.log = None
+
+    def __enter__(self):
+        env = dict(os.environ)
+        env.update({
+            'DATABASE_PATH': os.path.join(self.workdir, 'templates.db'),
+            'OUTPUT_STORAGE': 'local',
+            'PUBLIC_BASE_URL': self.url,
+            'LOG_LEVEL': env.get('LOG_LEVEL', 'WARNING'),
+            'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')])),
+        })
+        if self.args.render_processes:
+            env['RENDER_PROCESSES'] = str(self.args.render_processes)
+
+        command = [
+            sys.executable, '-m', 'gunicorn', 'app:app',
+            '--config', os.path.join(ROOT, 'gunicorn.conf.py'),
+            '--bind', f'127.0.0.1:{self.port}',
+            '--workers', str(self.workers),
+            '--timeout', '120',
+            *SERVER_MODES[self.mode],
+        ]
+        if self.mode == 'gthread':
+            command += ['--threads', str(self.args.threads)]
+        elif self.mode == 'gevent':
+            command += ['--worker-connections', str(max(1000, self.args.users * 2))]
+
+        self.log = open(os.path.join(self.workdir, 'server.log'), 'wb')
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=env, stdout=self.log,
+                                        stderr=subprocess.STDOUT, start_new_session=True)
+        if not wait_ready(self.url, self.args.startup_timeout):
+            self.__exit__(None, None, None)
+            raise RuntimeError(f'server {self.mode} x{self.workers} did not start, see {self.workdir}/server.log')
+        return self
+
+    def __exit__(self, *exc):
+        if self.process is not None and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        if self.log is not None:
+            self.log.close()
+        if exc[0] is None and not self.args.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def run_load(base_url, args):
+    recorder = Recorder()
+    stop = threading.Event()
+    users = [VirtualUser(base_url, recorder, stop, args, seed=i) for i in range(args.users)]
+    for user in users:
+        user.start()
+
+    time.sleep(args.warmup)
+    recorder.recording = True
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    recorder.recording = False
+    duration = time.perf_counter() - started
+
+    stop.set()
+    for user in users:
+        user.join(timeout=args.request_timeout + 5)
+    return recorder.summary(duration)
+
+
+def print_report(label, report):
+    print(f'\n== {label}')
+    print(f"{'endpoint':<22} {'requests':>9} {'req/s':>8} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, row in report.items():
+        print(f"{endpoint:<22} {row['requests']:>9} {row['throughput']:>8} {row['error_rate']:>7.1%} "
+              f"{_fmt(row['p50_ms'])} {_fmt(row['p95_ms'])} {_fmt(row['p99_ms'])}")
+
+
+def _fmt(value):
+    return f"{'-' if value is None else value:>9}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='нагружать уже запущенный сервер вместо локального')
+    parser.add_argument('--modes', default='gthread', help='режимы сервера через запятую: sync,gthread,gevent')
+    parser.add_argument('--workers', default='1', help='числа воркеров gunicorn через запятую')
+    parser.add_argument('--threads', type=int, default=32, help='потоков на воркер в режиме gthread')
+    parser.add_argument('--render-processes', type=int, help='RENDER_PROCESSES для каждого воркера')
+    parser.add_argument('--users', type=int, default=16, help='одновременных пользователей')
+    parser.add_argument('--duration', type=float, default=30, help='длительность замера, сек')
+    parser.add_argument('--warmup', type=float, default=5, help='прогрев без записи результатов, сек')
+    parser.add_argument('--think-time', type=float, default=0.5,
+                        help='средняя пауза пользователя между каруселями, сек')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='интервал опроса /slides, сек')
+    parser.add_argument('--carousel-timeout', type=float, default=120)
+    parser.add_argument('--request-timeout', type=float, default=60)
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--keep', action='store_true', help='не удалять рабочие папки серверов')
+    parser.add_argument('--json', help='сохранить результаты в JSON файл')
+    args = parser.parse_args()
+
+    results = []
+    if args.url:
+        report = run_load(args.url.rstrip('/'), args)
+        print_report(args.url, report)
+        results.append({'url': args.url, 'users': args.users, 'endpoints': report})
+    else:
+        for mode in args.modes.split(','):
+            if mode not in SERVER_MODES:
+                parser.error(f'unknown mode: {mode}')
+            if mode == 'gevent' and importlib.util.find_spec('gevent') is None:
+                print('\n== gevent: skipped, package gevent is not installed')
+                continue
+            for workers in (int(value) for value in args.workers.split(',')):
+                with LocalServer(mode, workers, args) as server:
+                    report = run_load(server.url, args)
+                label = f'{mode} x{workers}' + (f' ({args.threads} threads)' if mode == 'gthread' else '')
+                print_report(label, report)
+                results.append({'mode': mode, 'workers': workers, 'users': args.users,
+                                'threads': args.threads if mode == 'gthread' else None,
+                                'endpoints': report})
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк конвейера рендеринга с проверкой регрессий.
+
+Синтетические шаблоны растущей сложности:
+
+    text          - текст как у тестовых шаблонов
+    placeholders  - сотни плейсхолдеров
+    raster        - встроенные растровые изображения (data: URI)
+    effects       - градиенты, тени и размытие (filter)
+
+Этапы: подстановка плейсхолдеров (replace_svg_placeholders), разбор SVG
+строкой против копии дерева из кэша (svg_tree.py), растеризация
+(rasterise_image), кодирование в каждый доступный формат (encode_image) и
+create-and-generate целиком через тестовый клиент Flask до завершения
+карусели. По каждому замеру берется медиана повторов.
+
+Результаты сравниваются с базовым JSON файлом: если медиана медленнее базовой
+больше чем на --threshold, скрипт завершается с кодом 1. Базовый файл
+создается при первом запуске или с --update-baseline; он зависит от машины,
+поэтому сравнивать имеет смысл только прогоны на одном окружении.
+
+    python benchmarks/render_pipeline.py
+    python benchmarks/render_pipeline.py --only e2e --threshold 0.3
+    python benchmarks/render_pipeline.py --update-baseline
+"""
+
+import argparse
+import base64
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'render_baseline.json')
+
+WIDTH = 400
+HEIGHT = 600
+
+
+def _text_template():
+    return f'''<svg width="{WIDTH}" height="{HEIGHT}" xmlns="http://www.w3.org/2000/svg">
+        <rect width="{WIDTH}" height="{HEIGHT}" fill="#ffe4e1"/>
+        <text x="200" y="100" text-anchor="middle" font-size="28" font-weight="bold" fill="#d2691e">SOLD!</text>
+        <text x="200" y="200" text-anchor="middle" font-size="18" fill="#666">{{dyno.propertyaddress}}</text>
+        <text x="200" y="300" text-anchor="middle" font-size="16" fill="#666">Sold by: {{dyno.name}}</text>
+        <text x="200" y="350" text-anchor="middle" font-size="16" fill="#666">Phone: {{dyno.phone}}</text>
+        <text x="200" y="450" text-anchor="middle" font-size="14" fill="#666">Thank you for choosing us!</text>
+    </svg>'''
+
+
+def _placeholders_template(count=300):
+    rows = []
+    for i in range(count):
+        x = 10 + (i % 3) * 130
+        y = 12 + (i // 3) * 6
+        rows.append(f'<text x="{x}" y="{y}" font-size="5" fill="#333">{{dyno.field{i}}}: {{dyno.value{i}}}</text>')
+    body = '\n        '.join(rows)
+    return f'''<svg width="{WIDTH}" height="{HEIGHT}" xmlns="http://www.w3.org/2000/svg">
+        <rect width="{WIDTH}" height="{HEIGHT}" fill="#fff"/>
+        {body}
+    </svg>'''
+
+
+def _photo_data_uri(width, height, seed):
+    """JPEG с шумом: сжимается плохо, как настоящая фотография"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    image = Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def _raster_template():
+    photo = _photo_data_uri(800, 600, seed=1)
+    logo = _photo_data_uri(160, 160, seed=2)
+    return f'''<svg width="{WIDTH}" height="{HEIGHT}" xmlns="http://www.w3.org/2000/svg"
+         xmlns:xlink="http://www.w3.org/1999/xlink">
+        <rect width="{WIDTH}" height="{HEIGHT}" fill="#fff"/>
+        <image x="0" y="0" width="400" height="300" preserveAspectRatio="xMidYMid slice" xlink:href="{photo}"/>
+        <image x="20" y="500" width="80" height="80" xlink:href="{logo}"/>
+        <text x="200" y="360" text-anchor="middle" font-size="24" font-weight="bold" fill="#333">OPEN HOUSE</text>
+        <text x="200" y="400" text-anchor="middle" font-size="16" fill="#666">{{dyno.propertyaddress}}</text>
+        <text x="200" y="430" text-anchor="middle" font-size="14" fill="#666">Agent: {{dyno.name}}</text>
+        <text x="200" y="460" text-anchor="middle" font-size="14" fill="#666">{{dyno.date}} at {{dyno.time}}</text>
+    </svg>'''
+
+
+def _effects_template():
+    return f'''<svg width="{WIDTH}" height="{HEIGHT}" xmlns="http://www.w3.org/2000/svg">
+        <defs>
+            <linearGradient id="bg" x1="0" y1="0" x2="0" y2="1">
+                <stop offset="0" stop-color="#1e3c72"/>
+                <stop offset="1" stop-color="#2a5298"/>
+            </linearGradient>
+            <radialGradient id="glow" cx="0.5" cy="0.3" r="0.6">
+                <stop offset="0" stop-color="#fff" stop-opacity="0.6"/>
+                <stop offset="1" stop-color="#fff" stop-opacity="0"/>
+            </radialGradient>
+            <filter id="shadow" x="-20%" y="-20%" width="140%" height="140%">
+                <feGaussianBlur in="SourceAlpha" stdDeviation="6"/>
+                <feOffset dx="4" dy="6" result="blur"/>
+                <feMerge><feMergeNode in="blur"/><feMergeNode in="SourceGraphic"/></feMerge>
+            </filter>
+            <filter id="blur"><feGaussianBlur stdDeviation="12"/></filter>
+        </defs>
+        <rect width="{WIDTH}" height="{HEIGHT}" fill="url(#bg)"/>
+        <circle cx="200" cy="180" r="220" fill="url(#glow)"/>
+        <circle cx="80" cy="520" r="90" fill="#f5af19" opacity="0.5" filter="url(#blur)"/>
+        <rect x="40" y="240" width="320" height="200" rx="16" fill="#fff" filter="url(#shadow)"/>
+        <text x="200" y="300" text-anchor="middle" font-size="28" font-weight="bold" fill="#1e3c72">JUST LISTED</text>
+        <text x="200" y="350" text-anchor="middle" font-size="16" fill="#666">{{dyno.propertyaddress}}</text>
+        <text x="200" y="390" text-anchor="middle" font-size="14" fill="#666">{{dyno.name}} - {{dyno.phone}}</text>
+    </svg>'''
+
+
+def build_templates():
+    """id шаблона -> (SVG, значения плейсхолдеров)"""
+    common = {
+        'dyno.propertyaddress': '123 Main Street, Springfield',
+        'dyno.name': 'Jane Doe',
+        'dyno.phone': '+1 555 0100',
+        'dyno.date': 'Saturday, May 4',
+        'dyno.time': '1-4 PM',
+    }
+    many = {f'dyno.field{i}': f'Field {i}' for i in range(300)}
+    many.update({f'dyno.value{i}': f'value & <{i}>' for i in range(300)})
+
+    def pick(*names):
+        return {f'dyno.{name}': common[f'dyno.{name}'] for name in names}
+
+    return {
+        'text': (_text_template(), pick('propertyaddress', 'name', 'phone')),
+        'placeholders': (_placeholders_template(), many),
+        'raster': (_raster_template(), pick('propertyaddress', 'name', 'date', 'time')),
+        'effects': (_effects_template(), pick('propertyaddress', 'name', 'phone')),
+    }
+
+
+def measure(func, min_runs, min_time):
+    """Медиана и p95 времени вызова (сек) после одного прогрева"""
+    func()
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < min_runs or time.perf_counter() - started < min_time:
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return {
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'runs': len(samples)
+    }
+
+
+def setup_app(workdir, templates):
+    """Импортирует приложение во временной папке и загружает шаблоны"""
+    os.chdir(workdir)
+    # Никогда не пишем в рабочую базу и бакет
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'templates.db')
+    os.environ['OUTPUT_STORAGE'] = 'local'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    import app as server
+
+    server.start_services()
+    deadline = time.monotonic() + 120
+    while server.startup['stage'] != 'ready' and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    client = server.app.test_client()
+    for template_id, (svg, _) in templates.items():
+        response = client.post('/api/templates/upload', json={
+            'id': f'bench-{template_id}',
+            'name': f'Benchmark {template_id}',
+            'category': 'benchmark',
+            'template_type': 'flyer',
+            'template_role': 'main',
+            'svg_content': svg
+        })
+        if response.status_code != 200:
+            raise RuntimeError(f'upload {template_id}: {response.get_json()}')
+
+    # Превью новых шаблонов рендерятся в фоне - ждем, чтобы не мешали замерам
+    deadline = time.monotonic() + 60
+    while server.preview_store.stats()['in_flight'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    return server, client
+
+
+def substitution_cases(server, templates):
+    for template_id, (svg, replacements) in templates.items():
+        yield f'substitution/{template_id}', (
+            lambda svg=svg, replacements=replacements, template_id=template_id:
+            server.replace_svg_placeholders(svg, replacements, f'bench-{template_id}')
+        )
+
+
+def raster_cases(server, templates):
+    import cairosvg
+    from renderer import encode_image, output_options, rasterise_image, supported_formats
+    from svg_tree import render_tree
+
+    for template_id, (svg, replacements) in templates.items():
+        rendered = server.replace_svg_placeholders(svg, replacements, f'bench-{template_id}')
+        # Разбор SVG строки против копии дерева из кэша шаблона
+        yield f'parse/{template_id}', (
+            lambda rendered=rendered: cairosvg.parser.Tree(bytestring=rendered.encode('utf-8'))
+        )
+        yield f'tree-cache/{template_id}', (
+            lambda svg=svg, replacements=replacements: render_tree(svg, replacements)
+        )
+        yield f'rasterise/{template_id}', lambda rendered=rendered: rasterise_image(rendered, WIDTH, HEIGHT)
+
+        image = rasterise_image(rendered, WIDTH, HEIGHT)
+        for output_format in supported_formats():
+            options = output_options(output_format)
+            yield f'encode/{template_id}/{output_format}', (
+                lambda image=image, options=options: encode_image(image, *options)
+            )
+
+
+def end_to_end_cases(client, templates, slides_per_carousel, timeout):
+    for template_id, (_, replacements) in templates.items():
+        counter = itertools.count()
+        varied = next(iter(replacements))
+
+        def create_and_generate(template_id=template_id, replacements=replacements, varied=varied,
+                                counter=counter):
+            # Уникальные значения, чтобы каждый прогон рендерился, а не брался из кэша
+            run = next(counter)
+            slides = [
+                {'templateId': f'bench-{template_id}',
+                 'replacements': {**replacements, varied: f'{replacements[varied]} {run}-{i}'}}
+                for i in range(slides_per_carousel)
+            ]
+            response = client.post('/api/carousel/create-and-generate',
+                                   json={'name': 'benchmark', 'slides': slides})
+            carousel_id = response.get_json()['carouselId']
+
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                status = client.get(f'/api/carousel/{carousel_id}/slides').get_json()['status']
+                if status == 'completed':
+                    return
+                if status == 'failed':
+                    raise RuntimeError(f'carousel {carousel_id} failed')
+                time.sleep(0.002)
+            raise RuntimeError(f'carousel {carousel_id} timed out')
+
+        yield f'e2e/{template_id}', create_and_generate
+
+
+def environment():
+    import cairosvg
+    import PIL
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cairosvg': cairosvg.__version__,
+        'pillow': PIL.__version__,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Строки отчета и список регрессий"""
+    rows = []
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            rows.append((name, result, None, 'new'))
+            continue
+        ratio = result['median'] / base['median'] if base['median'] else 1.0
+        verdict = 'ok'
+        if ratio > 1 + threshold:
+            verdict = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            verdict = 'faster'
+        rows.append((name, result, ratio, verdict))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='путь к базовому JSON файлу')
+    parser.add_argument('--update-baseline', action='store_true', help='перезаписать базовый файл результатами')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='допустимое замедление медианы, доля (0.2 = 20%%)')
+    parser.add_argument('--only', default='', help='запускать замеры, имя которых содержит строку')
+    parser.add_argument('--min-runs', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.5, help='минимальное время на замер, сек')
+    parser.add_argument('--slides', type=int, default=5, help='слайдов в карусели для e2e')
+    parser.add_argument('--timeout', type=float, default=120, help='таймаут генерации карусели, сек')
+    args = parser.parse_args()
+
+    baseline_path = os.path.abspath(args.baseline)
+    templates = build_templates()
+    server, client = setup_app(tempfile.mkdtemp(prefix='bench_render_'), templates)
+
+    cases = itertools.chain(
+        substitution_cases(server, templates),
+        raster_cases(server, templates),
+        end_to_end_cases(client, templates, args.slides, args.timeout),
+    )
+
+    results = {}
+    for name, func in cases:
+        if args.only in name:
+            results[name] = measure(func, args.min_runs, args.min_time)
+
+    baseline = {}
+    baseline_env = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            saved = json.load(f)
+        baseline = saved.get('results', {})
+        baseline_env = saved.get('environment')
+
+    env = environment()
+    rows, regressions = compare(results, baseline, args.threshold)
+
+    print(f"{'benchmark':<32} {'median ms':>10} {'p95 ms':>10} {'runs':>6} {'vs base':>9}  verdict")
+    for name, result, ratio, verdict in rows:
+        change = f'x{ratio:.2f}' if ratio is not None else '-'
+        print(f"{name:<32} {result['median'] * 1000:>10.2f} {result['p95'] * 1000:>10.2f} "
+              f"{result['runs']:>6} {change:>9}  {verdict}")
+
+    if baseline_env and baseline_env != env:
+        print(f'warning: baseline was recorded on a different environment: {baseline_env}')
+
+    if args.update_baseline or not baseline:
+        merged = {**baseline, **results}
+        with open(baseline_path, 'w') as f:
+            json.dump({
+                'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'environment': env,
+                'results': merged
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'baseline written: {baseline_path}')
+        return 0
+
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Планы и время горячих запросов по carousel_slides без индексов миграции 3
+и с ними.
+
+Запросы - те, что выполняет приложение: слайды и варианты в
+carousel_result (опрос /slides), выборка слайдов в render_carousel_job и
+возврат брошенных слайдов в RenderQueue. Создает базу текущей схемы с
+синтетической историей (по умолчанию миллион слайдов, у каждого варианты),
+удаляет индексы миграции 3 и замеряет запросы, затем создает индексы
+заново и замеряет снова.
+
+    python benchmarks/slides_query_plan.py --slides 1000000
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migrations import MIGRATIONS, migrate  # noqa: E402
+
+# Миграция с индексами горячих запросов
+INDEX_VERSION = 3
+INDEXES = ['idx_carousel_slides_carousel_order', 'idx_carousel_slides_rendering',
+           'idx_carousels_status_created', 'idx_templates_created']
+# Варианты каждого слайда (имя, ширина, высота)
+VARIANTS = [('original', 1080, 1350), ('thumb', 270, 338)]
+
+# Тексты запросов совпадают с app.py и render_queue.py
+QUERIES = {
+    'slides poll': '''
+        SELECT id, template_id, output_url, status, slide_order,
+               output_format, output_bytes, encode_ms
+        FROM carousel_slides
+        WHERE carousel_id = ?
+        ORDER BY slide_order
+    ''',
+    'variants': '''
+        SELECT v.slide_id, v.name, v.width, v.height, v.output_url, v.output_bytes
+        FROM carousel_slides cs
+        JOIN carousel_slide_variants v ON v.slide_id = cs.id
+        WHERE cs.carousel_id = ?
+        ORDER BY v.width
+    ''',
+    'pending slides': '''
+        SELECT id, template_id, replacements, slide_order
+        FROM carousel_slides
+        WHERE carousel_id = ? AND status = 'pending'
+        ORDER BY slide_order
+    ''',
+    'queue recovery': '''
+        SELECT carousel_id, COUNT(*) FROM carousel_slides
+        WHERE status = 'rendering'
+          AND (claimed_at IS NULL OR claimed_at < datetime('now', '-600 seconds'))
+          AND carousel_id IN (SELECT id FROM carousels WHERE status IN ('queued', 'generating'))
+        GROUP BY carousel_id
+    ''',
+}
+
+
+def seed(conn, slides, slides_per_carousel):
+    conn.execute('''
+        INSERT INTO templates (id, name, category, svg_content)
+        VALUES ('sold-main', 'Sold', 'sold', '<svg/>')
+    ''')
+
+    carousel_ids = []
+    batch = []
+    variants = []
+
+    def flush():
+        conn.executemany('''
+            INSERT INTO carousel_slides
+                (id, carousel_id, template_id, replacements, slide_order, output_url, status,
+                 output_format, output_bytes, encode_ms)
+            VALUES (?, ?, 'sold-main', ?, ?, ?, 'completed', 'png', 150000, 12.5)
+        ''', batch)
+        conn.executemany('''
+            INSERT INTO carousel_slide_variants
+                (slide_id, name, width, height, output_url, output_bytes, encode_ms)
+            VALUES (?, ?, ?, ?, ?, 150000, 12.5)
+        ''', variants)
+        batch.clear()
+        variants.clear()
+
+    for i in range(slides):
+        if i % slides_per_carousel == 0:
+            carousel_id = str(uuid.uuid4())
+            carousel_ids.append(carousel_id)
+            conn.execute("INSERT INTO carousels (id, name, status) VALUES (?, 'bench', 'completed')",
+                         (carousel_id,))
+        slide_id = str(uuid.uuid4())
+        output_url = f'/output/{carousel_id}/slide.png'
+        batch.append((slide_id, carousel_id, '{"dyno.name": "Agent"}', i % slides_per_carousel + 1, output_url))
+        variants.extend((slide_id, name, width, height, output_url) for name, width, height in VARIANTS)
+        if len(batch) >= 10000:
+            flush()
+    if batch:
+        flush()
+    conn.commit()
+    return carousel_ids
+
+
+def drop_indexes(conn):
+    for name in INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+    conn.commit()
+
+
+def create_indexes(conn):
+    apply = next(apply for version, _, apply in MIGRATIONS if version == INDEX_VERSION)
+    apply(conn)
+    conn.commit()
+
+
+def measure(conn, carousel_ids, repeats):
+    results = {}
+    for name, sql in QUERIES.items():
+        params = (carousel_ids[len(carousel_ids) // 2],) if '?' in sql else ()
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+        started = time.perf_counter()
+        for i in range(repeats):
+            if params:
+                params = (carousel_ids[(i * 7919) % len(carousel_ids)],)
+            conn.execute(sql, params).fetchall()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeats
+
+        results[name] = (plan, elapsed_ms)
+    return results
+
+
+def report(title, results):
+    print(f'\n== {title}')
+    for name, (plan, elapsed_ms) in results.items():
+        print(f'{name:<16} {elapsed_ms:10.3f} ms/query')
+        for step in plan:
+            print(f'    {step}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slides', type=int, default=1_000_000)
+    parser.add_argument('--slides-per-carousel', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_plan_'), 'templates.db')
+    conn = sqlite3.connect(path)
+
+    version = migrate(conn)
+    drop_indexes(conn)
+
+    started = time.perf_counter()
+    carousel_ids = seed(conn, args.slides, args.slides_per_carousel)
+    print(f'seeded {args.slides} slides in {time.perf_counter() - started:.1f}s')
+
+    before = measure(conn, carousel_ids, args.repeats)
+    report(f'schema v{version} without v{INDEX_VERSION} indexes', before)
+
+    started = time.perf_counter()
+    create_indexes(conn)
+    print(f'\ncreated v{INDEX_VERSION} indexes in {time.perf_counter() - started:.1f}s')
+
+    after = measure(conn, carousel_ids, args.repeats)
+    report(f'schema v{version}', after)
+
+    print()
+    for name in QUERIES:
+        speedup = before[name][1] / after[name][1] if after[name][1] else float('inf')
+        print(f'{name:<16} x{speedup:,.0f}')
+
+
+if __name__ == '__main__':
+    main()
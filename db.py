@@ -0,0 +1,171 @@
+"""
+Слой доступа к SQLite.
+
+Каждый поток получает одно долгоживущее соединение (пул по потокам) с
+включенным WAL и настроенными PRAGMA: читатели, опрашивающие статус
+карусели, не блокируются записью из фоновой генерации. sqlite3 кэширует
+подготовленные выражения на соединении, поэтому переиспользование
+соединения заодно переиспользует и prepared statements.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'templates.db')
+
+# Размер кэша подготовленных выражений на соединение
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', '5000'),
+    ('cache_size', '-16000'),  # ~16 МБ
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', str(64 * 1024 * 1024)),
+)
+
+_local = threading.local()
+_connections_lock = threading.Lock()
+_connections_opened = 0
+
+# Функция (секунды), которой сообщается время каждого запроса; None - без замеров
+_query_observer = None
+
+
+def observe_queries(observer):
+    """Включает замер времени запросов: observer(seconds) после каждого execute"""
+    global _query_observer
+    _query_observer = observer
+
+
+def _timed(method):
+    def wrapper(self, *args, **kwargs):
+        observer = _query_observer
+        if observer is None:
+            return method(self, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            observer(time.perf_counter() - started)
+    return wrapper
+
+
+class _Cursor(sqlite3.Cursor):
+    execute = _timed(sqlite3.Cursor.execute)
+    executemany = _timed(sqlite3.Cursor.executemany)
+
+
+class _Connection(sqlite3.Connection):
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    # Connection.execute создает курсор в C и минует cursor() - замеряем отдельно
+    execute = _timed(sqlite3.Connection.execute)
+    executemany = _timed(sqlite3.Connection.executemany)
+
+
+def _reset_after_fork():
+    # Соединения SQLite нельзя переносить через fork: дочерний процесс
+    # открывает свои, а унаследованные просто забывает
+    global _local
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def configure(database_path):
+    """Переключает слой на другой файл базы (соединения потоков пересоздаются)"""
+    global DATABASE_PATH
+    DATABASE_PATH = database_path
+
+
+def _connect():
+    global _connections_opened
+
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        timeout=5.0,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=_Connection
+    )
+    conn.row_factory = sqlite3.Row
+
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+
+    with _connections_lock:
+        _connections_opened += 1
+
+    return conn
+
+
+def get_db_connection():
+    """Соединение текущего потока; закрывать его не нужно"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != DATABASE_PATH:
+        if conn is not None:
+            conn.close()
+        conn = _connect()
+        _local.conn = conn
+        _local.path = DATABASE_PATH
+    return conn
+
+
+def release_db_connection():
+    """Откатывает незавершенную транзакцию потока (после запроса)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+def close_db_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction():
+    """Транзакция на соединении потока: commit при успехе, rollback при ошибке"""
+    conn = get_db_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def query_one(sql, params=()):
+    return get_db_connection().execute(sql, params).fetchone()
+
+
+def query_all(sql, params=()):
+    return get_db_connection().execute(sql, params).fetchall()
+
+
+def execute(sql, params=()):
+    """Одиночная запись с commit; возвращает количество измененных строк"""
+    with transaction() as conn:
+        return conn.execute(sql, params).rowcount
+
+
+def executemany(sql, seq_of_params):
+    with transaction() as conn:
+        return conn.executemany(sql, seq_of_params).rowcount
+
+
+def stats():
+    with _connections_lock:
+        return {
+            'path': DATABASE_PATH,
+            'connections_opened': _connections_opened
+        }
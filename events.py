@@ -0,0 +1,120 @@
+"""
+In-process pub/sub событий генерации.
+
+Рендер публикует события по теме (id карусели), подписчики - SSE потоки
+/api/carousel/<id>/events, потоковый архив и пачки /api/carousel/batch
+(одна подписка на все карусели пачки) - ждут их на своей условной
+переменной. Ожидающий подписчик не тратит ни CPU, ни запросов к базе:
+его память - очередь событий и объект Condition.
+"""
+
+import itertools
+import json
+import threading
+from collections import deque
+
+# Сколько недоставленных событий хранится у подписчика
+SUBSCRIBER_BACKLOG = 1024
+
+
+class Subscription:
+    """Подписка на темы; get() блокируется до события или таймаута"""
+
+    def __init__(self, broker, topics, names=None):
+        self.broker = broker
+        self.topics = topics
+        # Только события с этими именами (None - все)
+        self.names = names
+        self._events = deque(maxlen=SUBSCRIBER_BACKLOG)
+        self._condition = threading.Condition(threading.Lock())
+        self.closed = False
+
+    def get(self, timeout=None):
+        """Следующее событие (id, имя, данные) или None по таймауту"""
+        with self._condition:
+            if not self._events and not self.closed:
+                self._condition.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def _deliver(self, event):
+        if self.names is not None and event[1] not in self.names:
+            return
+        with self._condition:
+            self._events.append(event)
+            self._condition.notify()
+
+    def _close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EventBroker:
+    """Брокер событий внутри процесса"""
+
+    def __init__(self):
+        self._topics = {}  # тема -> set(Subscription)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self, *topics, names=None):
+        """Подписка на одну или несколько тем; names - фильтр по именам событий"""
+        subscription = Subscription(self, topics, frozenset(names) if names is not None else None)
+        with self._lock:
+            for topic in topics:
+                self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._topics[topic]
+        subscription._close()
+
+    def publish(self, topic, name, data):
+        """Рассылает событие подписчикам темы; возвращает число получателей"""
+        with self._lock:
+            event = (next(self._ids), name, data)
+            self.published += 1
+            subscribers = list(self._topics.get(topic, ()))
+
+        for subscription in subscribers:
+            subscription._deliver(event)
+        return len(subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'topics': len(self._topics),
+                'subscribers': sum(len(subscribers) for subscribers in self._topics.values()),
+                'published': self.published
+            }
+
+
+def format_sse(name, data, event_id=None):
+    """Событие в формате text/event-stream"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {name}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def format_ndjson(data):
+    """Строка NDJSON (application/x-ndjson)"""
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False) + '\n'
@@ -0,0 +1,12 @@
+"""
+Настройки gunicorn.
+
+Приложение импортируется в каждом воркере без побочных эффектов, а база,
+пул рендеринга и фоновые потоки запускаются хуком после инициализации
+воркера - до приема первого соединения и уже после fork.
+"""
+
+
+def post_worker_init(worker):
+    from app import start_services
+    start_services()
@@ -0,0 +1,93 @@
+"""
+HTTP кэширование и сжатие ответов.
+
+JSON ответы получают слабый ETag от тела и отвечают 304 на совпадающий
+If-None-Match; крупные JSON ответы сжимаются brotli или gzip. Файлы с
+хэшем содержимого в имени отдаются как immutable.
+"""
+
+import gzip
+import hashlib
+import re
+
+from flask import Response, jsonify, request
+
+# Модуль brotli импортируется при первом сжатии; False - не установлен
+_brotli = None
+
+# JSON меньше этого размера не сжимаем
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Год - максимальный срок, который имеет смысл указывать для immutable
+IMMUTABLE_MAX_AGE = 31536000
+
+# Имя файла оканчивается хэшем содержимого: slide_1_<hash>.png, _cache/ab/<hash>.png
+_HASHED_NAME = re.compile(r'(?:^|[/_])[0-9a-f]{16,64}\.[a-z0-9]+$')
+
+
+def _load_brotli():
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:  # brotli необязателен - тогда только gzip
+            _brotli = False
+    return _brotli
+
+
+def is_content_hashed(filename):
+    return bool(_HASHED_NAME.search(filename))
+
+
+def set_immutable(response):
+    response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return response
+
+
+def conditional_json(payload, status=200):
+    """JSON ответ с ETag; при совпадении If-None-Match - 304 без тела"""
+    response = jsonify(payload)
+    response.status_code = status
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest(), weak=True)
+    # Клиент может хранить ответ, но обязан перепроверять его через ETag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def conditional_json_body(body, etag, status=200):
+    """Как conditional_json, но для готового тела JSON (bytes) с заранее посчитанным ETag"""
+    response = Response(body, status=status, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def compress_json_response(response):
+    """after_request: сжимает крупные JSON ответы по Accept-Encoding"""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    accept_encodings = request.accept_encodings
+    brotli = _load_brotli() if accept_encodings['br'] else None
+    if brotli:
+        encoded, encoding = brotli.compress(data, quality=BROTLI_QUALITY), 'br'
+    elif accept_encodings['gzip']:
+        encoded, encoding = gzip.compress(data, compresslevel=GZIP_LEVEL), 'gzip'
+    else:
+        return response
+
+    response.set_data(encoded)
+    response.headers['Content-Encoding'] = encoding
+    return response
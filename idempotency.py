@@ -0,0 +1,91 @@
+"""
+Повторы запросов создания карусели.
+
+Клиент повторяет POST /api/carousel/create-and-generate по таймауту, и
+каждый повтор создавал бы новую карусель и рендерил все слайды заново.
+Запрос сводится к уже созданной карусели двумя ключами из таблицы
+carousel_requests:
+
+- key:<клиент>:<Idempotency-Key> - заголовок клиента; тот же ключ с другим
+  телом запроса - ошибка (IdempotencyConflict);
+- content:<клиент>:<хэш> - хэш тела запроса и содержимого его шаблонов:
+  одинаковый запрос без заголовка от того же клиента (client_key) тоже
+  попадает в существующую карусель.
+
+Клиент (client_key) входит в оба ключа, чтобы запросы разных клиентов не
+сталкивались и не получали и не перезапускали чужие карусели. Если запрос
+сведен к карусели одним ключом, недостающие ключи записываются на нее же:
+Idempotency-Key запроса, сведенного по содержимому, потом нельзя
+использовать с другим телом.
+
+Ключ действует ttl секунд (для content: 0 - сведение по содержимому
+выключено). Запись, карусель которой удалена очисткой, устарела или (для
+content) закончилась ошибкой, заменяется новой каруселью. Поиск и запись
+выполняются под BEGIN IMMEDIATE, поэтому одновременные повторы не создают
+две карусели.
+"""
+
+import hashlib
+import json
+
+KEY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(ValueError):
+    """Ключ уже использован с другим телом запроса"""
+
+
+def request_hash(data, template_hashes):
+    """Хэш тела запроса и content_hash шаблонов его слайдов"""
+    canonical = json.dumps({'request': data, 'templates': template_hashes},
+                           sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def request_keys(idempotency_key, content_hash, client, key_ttl, content_ttl):
+    """[(ключ, ttl)] в порядке проверки"""
+    keys = []
+    if idempotency_key:
+        keys.append((f'key:{client}:{idempotency_key}', key_ttl))
+    if content_ttl > 0:
+        keys.append((f'content:{client}:{content_hash}', content_ttl))
+    return keys
+
+
+def find_carousel(conn, keys, content_hash):
+    """(карусель, к которой сводится запрос, или None; [(ключ, ttl)] без действующей записи).
+
+    Вызывается в транзакции, открытой BEGIN IMMEDIATE, до remember().
+    """
+    carousel_id = None
+    missing = []
+    for key, ttl in keys:
+        row = conn.execute('''
+            SELECT r.request_hash, r.carousel_id, c.status,
+                   r.created_at >= datetime('now', ?) AS fresh
+            FROM carousel_requests r
+            LEFT JOIN carousels c ON c.id = r.carousel_id
+            WHERE r.key = ?
+        ''', (f'-{int(ttl)} seconds', key)).fetchone()
+        if row is None or row['status'] is None or not row['fresh']:
+            missing.append((key, ttl))
+            continue
+        if key.startswith('content:') and row['status'] == 'error':
+            missing.append((key, ttl))
+            continue
+        if carousel_id is not None:
+            # Запрос уже сведен предыдущим ключом; эта запись остается как есть
+            continue
+        if row['request_hash'] != content_hash:
+            raise IdempotencyConflict(f'{KEY_HEADER} was already used with a different request')
+        carousel_id = row['carousel_id']
+    return carousel_id, missing
+
+
+def remember(conn, keys, content_hash, carousel_id):
+    """Запоминает ключи запроса для карусели (в той же транзакции)"""
+    conn.executemany('''
+        INSERT OR REPLACE INTO carousel_requests (key, request_hash, carousel_id, created_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ''', [(key, content_hash, carousel_id) for key, _ in keys])
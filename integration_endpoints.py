@@ -2,141 +2,235 @@
 
 # НОВЫЕ ENDPOINTS ДЛЯ ИНТЕГРАЦИИ С АДМИНКОЙ
 
-@app.route('/api/templates/upload', methods=['POST'])
+import json
+import tempfile
+from flask import Blueprint, current_app, request, jsonify
+from db import transaction
+from json_stream import iter_array_items, JSONStreamError
+from renderer import output_options
+from template_catalog import bump_version
+from template_compiler import content_hash
+
+integration_api = Blueprint('integration_api', __name__)
+
+REQUIRED_FIELDS = ['id', 'name', 'category', 'template_type', 'template_role', 'svg_content']
+
+# Необязательные параметры кодирования слайдов (NULL - формат по умолчанию)
+OUTPUT_FIELDS = ['output_format', 'output_quality', 'output_colors']
+
+# Поля, изменение которых означает обновление шаблона
+COMPARED_FIELDS = ['name', 'category', 'template_type', 'template_role', 'content_hash'] + OUTPUT_FIELDS
+
+# Сколько шаблонов записывается одним executemany
+SYNC_BATCH_SIZE = 200
+
+# Проверенные шаблоны sync копятся в памяти до этого объема, дальше - во временном файле
+SYNC_SPOOL_BYTES = 16 * 1024 * 1024
+
+UPSERT_TEMPLATE_SQL = """
+    INSERT INTO templates (id, name, category, template_type, template_role, svg_content, content_hash,
+                           output_format, output_quality, output_colors)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        name = excluded.name,
+        category = excluded.category,
+        template_type = excluded.template_type,
+        template_role = excluded.template_role,
+        svg_content = excluded.svg_content,
+        content_hash = excluded.content_hash,
+        output_format = excluded.output_format,
+        output_quality = excluded.output_quality,
+        output_colors = excluded.output_colors
+"""
+
+def refresh_previews(template_ids):
+    """Перерендеривает превью созданных и измененных шаблонов в фоне"""
+    preview_store = current_app.extensions.get('preview_store')
+    if preview_store is not None and template_ids:
+        preview_store.refresh(template_ids)
+
+def validate_template(template):
+    """Возвращает текст ошибки или None"""
+    if not isinstance(template, dict):
+        return 'Template must be an object'
+    
+    for field in REQUIRED_FIELDS:
+        if field not in template:
+            return f'Missing required field: {field}'
+    
+    if not isinstance(template['svg_content'], str):
+        return 'svg_content must be a string'
+    
+    try:
+        output_options(*(template.get(field) for field in OUTPUT_FIELDS))
+    except ValueError as e:
+        return str(e)
+    
+    return None
+
+def upsert_templates(conn, templates):
+    """Записывает пачку шаблонов одним UPSERT; возвращает статус каждого"""
+    ids = list({template['id'] for template in templates})
+    placeholders = ','.join('?' * len(ids))
+    
+    # Текущее состояние всей пачки одним запросом
+    existing = {
+        row['id']: dict(row)
+        for row in conn.execute(f"""
+            SELECT id, name, category, template_type, template_role, content_hash,
+                   output_format, output_quality, output_colors
+            FROM templates WHERE id IN ({placeholders})
+        """, ids)
+    }
+    
+    rows = []
+    results = []
+    for template in templates:
+        incoming = {field: template[field] for field in REQUIRED_FIELDS if field != 'svg_content'}
+        incoming['content_hash'] = content_hash(template['svg_content'])
+        for field in OUTPUT_FIELDS:
+            incoming[field] = template.get(field)
+        if incoming['output_format']:
+            # jpg -> jpeg и т.п.
+            incoming['output_format'] = output_options(incoming['output_format'])[0]
+        
+        current = existing.get(template['id'])
+        if current is None:
+            status = 'created'
+        elif all(current[field] == incoming[field] for field in COMPARED_FIELDS):
+            results.append({'id': template['id'], 'status': 'unchanged'})
+            continue
+        else:
+            status = 'updated'
+        
+        rows.append((
+            template['id'],
+            template['name'],
+            template['category'],
+            template['template_type'],
+            template['template_role'],
+            template['svg_content'],
+            incoming['content_hash'],
+            incoming['output_format'],
+            incoming['output_quality'],
+            incoming['output_colors']
+        ))
+        # Повтор того же id в пачке сравнивается уже с новой версией
+        existing[template['id']] = incoming
+        results.append({'id': template['id'], 'status': status})
+    
+    if rows:
+        conn.executemany(UPSERT_TEMPLATE_SQL, rows)
+        # Каталоги шаблонов процессов перечитают таблицу после commit
+        bump_version(conn)
+    
+    return results
+
+@integration_api.route('/api/templates/upload', methods=['POST'])
 def upload_template():
     """Endpoint для загрузки новых шаблонов из админки"""
     try:
         data = request.get_json()
         
         # Валидация данных
-        required_fields = ['id', 'name', 'category', 'template_type', 'template_role', 'svg_content']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({
-                    'success': False,
-                    'error': f'Missing required field: {field}'
-                }), 400
+        error = validate_template(data)
+        if error:
+            return jsonify({
+                'success': False,
+                'error': error
+            }), 400
         
-        # Проверить что шаблон с таким ID не существует
-        conn = get_db_connection()
-        existing = conn.execute(
-            'SELECT id FROM templates WHERE id = ?',
-            (data['id'],)
-        ).fetchone()
+        with transaction() as conn:
+            status = upsert_templates(conn, [data])[0]['status']
         
-        if existing:
-            # Обновить существующий шаблон
-            conn.execute("""
-                UPDATE templates 
-                SET name = ?, category = ?, template_type = ?, 
-                    template_role = ?, svg_content = ?
-                WHERE id = ?
-            """, (
-                data['name'],
-                data['category'],
-                data['template_type'],
-                data['template_role'],
-                data['svg_content'],
-                data['id']
-            ))
-            message = 'Template updated successfully'
-        else:
-            # Создать новый шаблон
-            conn.execute("""
-                INSERT INTO templates (id, name, category, template_type, template_role, svg_content)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                data['id'],
-                data['name'],
-                data['category'],
-                data['template_type'],
-                data['template_role'],
-                data['svg_content']
-            ))
-            message = 'Template created successfully'
+        if status != 'unchanged':
+            refresh_previews([data['id']])
         
-        conn.commit()
-        conn.close()
+        messages = {
+            'created': 'Template created successfully',
+            'updated': 'Template updated successfully',
+            'unchanged': 'Template unchanged'
+        }
         
         return jsonify({
             'success': True,
-            'message': message,
+            'message': messages[status],
+            'status': status,
             'template_id': data['id']
         })
-        
+    
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-@app.route('/api/templates/sync', methods=['POST'])
+@integration_api.route('/api/templates/sync', methods=['POST'])
 def sync_templates():
-    """Синхронизация всех шаблонов из админки"""
+    """Синхронизация всех шаблонов из админки.
+    
+    Массив templates разбирается потоково и проверяется до транзакции:
+    проверенные шаблоны копятся во временном файле, поэтому медленная
+    загрузка клиента не держит блокировку записи. Затем они пишутся пачками
+    UPSERT в одной транзакции; в ответе - статус каждого элемента.
+    """
     try:
-        data = request.get_json()
+        items = []
+        batch = []
         
-        if 'templates' not in data:
-            return jsonify({
-                'success': False,
-                'error': 'Missing templates array'
-            }), 400
+        def flush(conn):
+            for (index, _), result in zip(batch, upsert_templates(conn, [template for _, template in batch])):
+                items.append({'index': index, **result})
+            batch.clear()
         
-        conn = get_db_connection()
-        synced_count = 0
-        
-        for template in data['templates']:
-            # Проверить обязательные поля
-            required_fields = ['id', 'name', 'category', 'template_type', 'template_role', 'svg_content']
-            if not all(field in template for field in required_fields):
-                continue
-            
-            # Проверить существование
-            existing = conn.execute(
-                'SELECT id FROM templates WHERE id = ?',
-                (template['id'],)
-            ).fetchone()
+        with tempfile.SpooledTemporaryFile(max_size=SYNC_SPOOL_BYTES) as spool:
+            for index, template in enumerate(iter_array_items(request.stream, 'templates')):
+                error = validate_template(template)
+                if error:
+                    items.append({
+                        'index': index,
+                        'id': template.get('id') if isinstance(template, dict) else None,
+                        'status': 'rejected',
+                        'error': error
+                    })
+                    continue
+                
+                spool.write(json.dumps([index, template]).encode('utf-8') + b'\n')
             
-            if existing:
-                # Обновить
-                conn.execute("""
-                    UPDATE templates 
-                    SET name = ?, category = ?, template_type = ?, 
-                        template_role = ?, svg_content = ?
-                    WHERE id = ?
-                """, (
-                    template['name'],
-                    template['category'],
-                    template['template_type'],
-                    template['template_role'],
-                    template['svg_content'],
-                    template['id']
-                ))
-            else:
-                # Создать
-                conn.execute("""
-                    INSERT INTO templates (id, name, category, template_type, template_role, svg_content)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (
-                    template['id'],
-                    template['name'],
-                    template['category'],
-                    template['template_type'],
-                    template['template_role'],
-                    template['svg_content']
-                ))
-            
-            synced_count += 1
+            spool.seek(0)
+            with transaction() as conn:
+                for line in spool:
+                    batch.append(tuple(json.loads(line)))
+                    if len(batch) >= SYNC_BATCH_SIZE:
+                        flush(conn)
+                
+                if batch:
+                    flush(conn)
+        
+        items.sort(key=lambda item: item['index'])
+        
+        refresh_previews([item['id'] for item in items if item['status'] in ('created', 'updated')])
+        
+        summary = {'created': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0}
+        for item in items:
+            summary[item['status']] += 1
         
-        conn.commit()
-        conn.close()
+        synced_count = summary['created'] + summary['updated'] + summary['unchanged']
         
         return jsonify({
             'success': True,
             'message': f'Synced {synced_count} templates',
-            'synced_count': synced_count
+            'synced_count': synced_count,
+            'summary': summary,
+            'items': items
         })
-        
+    
+    except JSONStreamError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
     except Exception as e:
         return jsonify({
             'success': False,
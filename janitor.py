@@ -0,0 +1,278 @@
+"""
+Очистка старых результатов генерации.
+
+Без нее файлы слайдов (<carousel_id>/... в хранилище) и строки carousels,
+carousel_slides и carousel_slide_variants копятся бесконечно. Фоновый поток
+раз в interval секунд:
+
+- удаляет карусели, к которым не обращались дольше max_age секунд;
+- если файлы каруселей вместе с записями кэша рендера, на которые не
+  ссылается ни один слайд, занимают больше max_bytes, удаляет сначала эти
+  записи кэша (от давно не читавшихся), затем карусели в порядке давности
+  последнего обращения (LRU), пока не уложится;
+- удаляет строки слайдов, вариантов и ключей повторов без карусели и
+  каталоги в хранилище, для которых нет карусели в базе.
+
+Закрепленные (pinned) карусели и карусели в генерации не удаляются.
+Размер файлов карусели хранится в carousels.output_bytes и пересчитывается
+при завершении генерации, поэтому квота считается по базе без обхода
+хранилища; для поиска лишних каталогов читается только верхний уровень.
+В LocalStorage файлы слайдов - жесткие ссылки на записи _cache/, поэтому
+освобожденными считаются только байты файлов, у которых не осталось других
+ссылок: удаление карусели, чьи файлы есть в кэше, места не освобождает, а
+делает эти записи кэша кандидатами на удаление.
+Обращение к результатам (accessed_at) отмечается не чаще раза в
+TOUCH_INTERVAL секунд на карусель.
+"""
+
+import logging
+import threading
+import time
+
+from db import query_all, query_one, transaction
+from migrations import CAROUSEL_OUTPUT_BYTES
+from render_cache import CACHE_PREFIX
+
+logger = logging.getLogger(__name__)
+
+TOUCH_INTERVAL = 60
+# Сколько каруселей удаляется одной транзакцией
+DELETE_BATCH_SIZE = 100
+
+# Карусели, которые можно удалять
+_REMOVABLE = "pinned = 0 AND status NOT IN ('queued', 'generating')"
+_LAST_ACCESS = 'COALESCE(accessed_at, completed_at, created_at)'
+
+
+def update_output_bytes(conn, carousel_id):
+    """Пересчитывает carousels.output_bytes по слайдам и вариантам (без commit)"""
+    conn.execute(f'''
+        UPDATE carousels SET output_bytes = ({CAROUSEL_OUTPUT_BYTES})
+        WHERE id = ?
+    ''', (carousel_id,))
+
+
+class Janitor:
+    """Фоновая очистка по возрасту, квоте и сиротам"""
+
+    def __init__(self, storage, interval=600, max_age=0, max_bytes=0, render_cache=None):
+        self.storage = storage
+        self.render_cache = render_cache
+        # 0 - соответствующее ограничение выключено
+        self.interval = float(interval)
+        self.max_age = float(max_age)
+        self.max_bytes = int(max_bytes)
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._touched = {}  # id карусели -> time.monotonic() последней отметки
+        self.runs = 0
+        self.reclaimed_bytes = 0
+        self.deleted_carousels = 0
+        self.orphan_rows = 0
+        self.orphan_prefixes = 0
+        self.cache_evictions = 0
+        self.output_bytes = 0
+        self.cache_bytes = 0
+        self.last_run = None
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._loop, name='janitor', daemon=True)
+        self._thread.start()
+        logger.info("Очистка результатов запущена",
+                    extra={'interval': self.interval, 'max_age': self.max_age, 'max_bytes': self.max_bytes})
+
+    def stop(self):
+        self._stop.set()
+
+    def touch(self, carousel_id):
+        """Отмечает обращение к результатам карусели (для LRU)"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._touched.get(carousel_id, -TOUCH_INTERVAL) < TOUCH_INTERVAL:
+                return
+            if len(self._touched) > 10000:
+                self._touched.clear()
+            self._touched[carousel_id] = now
+
+        with transaction() as conn:
+            conn.execute('UPDATE carousels SET accessed_at = CURRENT_TIMESTAMP WHERE id = ?', (carousel_id,))
+
+    def run_once(self):
+        """Один проход очистки; возвращает отчет"""
+        started = time.perf_counter()
+        report = {'expired': 0, 'evicted': 0, 'cache_evicted': 0, 'orphan_rows': 0, 'orphan_prefixes': 0,
+                  'reclaimed_bytes': 0}
+
+        if self.max_age > 0:
+            expired = query_all(f'''
+                SELECT id, output_bytes FROM carousels
+                WHERE {_REMOVABLE} AND {_LAST_ACCESS} < datetime('now', ?)
+            ''', (f'-{int(self.max_age)} seconds',))
+            deleted, reclaimed = self._delete_carousels(expired)
+            report['expired'] = deleted
+            report['reclaimed_bytes'] += reclaimed
+
+        if self.max_bytes > 0:
+            while True:
+                output_bytes = query_one('SELECT COALESCE(SUM(output_bytes), 0) FROM carousels')[0]
+                unshared = self.render_cache.unshared() if self.render_cache is not None else []
+                excess = output_bytes + sum(size for _, size in unshared) - self.max_bytes
+                if excess <= 0:
+                    break
+
+                # Записи кэша без слайдов - первыми: они нужны только для будущих попаданий
+                selected = []
+                for key, size in unshared:
+                    if excess <= 0:
+                        break
+                    selected.append(key)
+                    excess -= size
+                if selected:
+                    report['cache_evicted'] += len(selected)
+                    report['reclaimed_bytes'] += self.render_cache.discard(selected)
+                if excess <= 0:
+                    break
+
+                # Самые давно не читавшиеся - первыми (индекс idx_carousels_lru)
+                candidates = query_all(f'''
+                    SELECT id, output_bytes FROM carousels
+                    WHERE {_REMOVABLE}
+                    ORDER BY {_LAST_ACCESS}
+                    LIMIT ?
+                ''', (DELETE_BATCH_SIZE,))
+                if not candidates:
+                    logger.warning("Квота результатов превышена, но удалять нечего",
+                                   extra={'output_bytes': output_bytes, 'max_bytes': self.max_bytes})
+                    break
+
+                selected = []
+                for carousel_id, carousel_bytes in candidates:
+                    selected.append((carousel_id, carousel_bytes))
+                    excess -= carousel_bytes
+                    if excess <= 0:
+                        break
+
+                # Файлы, общие с кэшем, станут записями без слайдов и удалятся
+                # на следующем круге
+                deleted, reclaimed = self._delete_carousels(selected)
+                report['evicted'] += deleted
+                report['reclaimed_bytes'] += reclaimed
+                if not deleted:
+                    break
+
+        report['orphan_rows'] = self._delete_orphan_rows()
+        orphan_prefixes, orphan_bytes = self._delete_orphan_prefixes()
+        report['orphan_prefixes'] = orphan_prefixes
+        report['reclaimed_bytes'] += orphan_bytes
+
+        report['output_bytes'] = query_one('SELECT COALESCE(SUM(output_bytes), 0) FROM carousels')[0]
+        # Обход кэша нужен только для квоты
+        report['cache_bytes'] = (sum(size for _, size in self.render_cache.unshared())
+                                 if self.render_cache is not None and self.max_bytes > 0 else 0)
+        report['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+        with self._lock:
+            self.runs += 1
+            self.reclaimed_bytes += report['reclaimed_bytes']
+            self.deleted_carousels += report['expired'] + report['evicted']
+            self.orphan_rows += report['orphan_rows']
+            self.orphan_prefixes += report['orphan_prefixes']
+            self.cache_evictions += report['cache_evicted']
+            self.output_bytes = report['output_bytes']
+            self.cache_bytes = report['cache_bytes']
+            self.last_run = report
+
+        if report['reclaimed_bytes'] or report['orphan_rows']:
+            logger.info("Очистка результатов", extra=report)
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'max_age': self.max_age,
+                'max_bytes': self.max_bytes,
+                'output_bytes': self.output_bytes,
+                'cache_bytes': self.cache_bytes,
+                'runs': self.runs,
+                'reclaimed_bytes': self.reclaimed_bytes,
+                'deleted_carousels': self.deleted_carousels,
+                'orphan_rows': self.orphan_rows,
+                'orphan_prefixes': self.orphan_prefixes,
+                'cache_evictions': self.cache_evictions,
+                'last_run': self.last_run
+            }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Ошибка очистки результатов: %s", e)
+            self._stop.wait(self.interval)
+
+    def _delete_carousels(self, carousels):
+        """Удаляет строки, затем файлы; (удалено каруселей, освобождено байт).
+
+        Освобожденные байты считает хранилище: файлы, общие с кэшем, в них не входят.
+
+        Условие повторяется в DELETE: карусель, которую успели закрепить или
+        запустить заново после выборки, остается. Если процесс упадет между
+        строками и файлами, каталог удалится как сирота при следующем проходе.
+        """
+        deleted = []
+        for start in range(0, len(carousels), DELETE_BATCH_SIZE):
+            with transaction() as conn:
+                for carousel_id, output_bytes in carousels[start:start + DELETE_BATCH_SIZE]:
+                    removed = conn.execute(f'DELETE FROM carousels WHERE id = ? AND {_REMOVABLE}',
+                                           (carousel_id,)).rowcount
+                    if not removed:
+                        continue
+                    conn.execute('''
+                        DELETE FROM carousel_slide_variants
+                        WHERE slide_id IN (SELECT id FROM carousel_slides WHERE carousel_id = ?)
+                    ''', (carousel_id,))
+                    conn.execute('DELETE FROM carousel_slides WHERE carousel_id = ?', (carousel_id,))
+                    deleted.append((carousel_id, output_bytes))
+
+        reclaimed = 0
+        for carousel_id, _ in deleted:
+            reclaimed += self.storage.delete_prefix(f'{carousel_id}/')
+            with self._lock:
+                self._touched.pop(carousel_id, None)
+
+        return len(deleted), reclaimed
+
+    def _delete_orphan_rows(self):
+        with transaction() as conn:
+            slides = conn.execute('''
+                DELETE FROM carousel_slides
+                WHERE NOT EXISTS (SELECT 1 FROM carousels c WHERE c.id = carousel_slides.carousel_id)
+            ''').rowcount
+            variants = conn.execute('''
+                DELETE FROM carousel_slide_variants
+                WHERE NOT EXISTS (SELECT 1 FROM carousel_slides cs WHERE cs.id = carousel_slide_variants.slide_id)
+            ''').rowcount
+            requests = conn.execute('''
+                DELETE FROM carousel_requests
+                WHERE NOT EXISTS (SELECT 1 FROM carousels c WHERE c.id = carousel_requests.carousel_id)
+            ''').rowcount
+        return slides + variants + requests
+
+    def _delete_orphan_prefixes(self):
+        """Каталоги хранилища без карусели в базе; (сколько, байт)"""
+        names = [name for name in self.storage.list_prefixes() if name != CACHE_PREFIX]
+        known = set()
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            known.update(row[0] for row in query_all(
+                f"SELECT id FROM carousels WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+
+        orphans = [name for name in names if name not in known]
+        reclaimed = 0
+        for name in orphans:
+            reclaimed += self.storage.delete_prefix(f'{name}/')
+        return len(orphans), reclaimed
@@ -0,0 +1,144 @@
+"""
+Потоковый разбор JSON тела запроса.
+
+Для тел вида {"templates": [ {...}, {...} ]} отдает элементы массива по
+одному, читая поток кусками, - весь каталог шаблонов в память не грузится.
+Кодировка (UTF-8, UTF-16, UTF-32) определяется по первым байтам, как в
+json.loads. После ошибки разбора поток дальше не читается.
+"""
+
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+# Хвост буфера, в котором может оборваться литерал (false) или \uXXXX
+_TRUNCATED_TAIL = 6
+
+
+class JSONStreamError(ValueError):
+    """Некорректный JSON или отсутствует нужный ключ"""
+
+
+class _Reader:
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = None
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, at_least):
+        """Дочитывает поток; False, если данных больше нет"""
+        if self.eof:
+            return False
+
+        # Отбрасываем уже разобранное начало буфера
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+
+        chunk = self.stream.read(max(self.chunk_size, at_least))
+        try:
+            if self.decoder is None:
+                # Для определения кодировки нужны первые 4 байта
+                while chunk and len(chunk) < 4:
+                    more = self.stream.read(self.chunk_size)
+                    if not more:
+                        break
+                    chunk += more
+                self.decoder = codecs.getincrementaldecoder(json.detect_encoding(chunk))()
+            if not chunk:
+                self.buffer += self.decoder.decode(b'', final=True)
+                self.eof = True
+                return False
+
+            self.buffer += self.decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            self.eof = True
+            raise JSONStreamError(f'Invalid {e.encoding} in request body')
+        return True
+
+    def peek(self):
+        """Следующий значимый символ (пробелы пропускаются) или '' в конце"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(0):
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise JSONStreamError(f'Expected {char!r} at position {self.pos}')
+        self.pos += 1
+
+    def value(self):
+        """Разбирает одно JSON значение, дочитывая поток при необходимости"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # Значение могло оборваться на границе куска - читаем больше
+                # (удваивая порцию, чтобы большие SVG не разбирались заново много раз).
+                # Ошибка в середине буфера - не обрыв, остаток тела не читаем
+                truncated = (e.msg.startswith('Unterminated string')
+                             or len(self.buffer) - e.pos <= _TRUNCATED_TAIL)
+                if truncated and self._fill(len(self.buffer)):
+                    continue
+                self.eof = True
+                raise JSONStreamError(f'Invalid JSON: {e}')
+
+            # Число в конце буфера могло быть обрезано
+            if end == len(self.buffer) and not self.eof and isinstance(value, (int, float)):
+                if self._fill(0):
+                    continue
+
+            self.pos = end
+            return value
+
+
+def iter_array_items(stream, key, chunk_size=CHUNK_SIZE):
+    """Отдает элементы массива body[key] по одному.
+
+    Остальные ключи верхнего уровня разбираются и отбрасываются. Если ключа
+    нет, выбрасывается JSONStreamError.
+    """
+    reader = _Reader(stream, chunk_size)
+    reader.expect('{')
+
+    if reader.peek() == '}':
+        raise JSONStreamError(f'Missing {key} array')
+
+    while True:
+        name = reader.value()
+        reader.expect(':')
+
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == ',':
+                        reader.pos += 1
+                        continue
+                    reader.expect(']')
+                    break
+            return
+
+        reader.value()
+
+        if reader.peek() == ',':
+            reader.pos += 1
+            continue
+
+        reader.expect('}')
+        raise JSONStreamError(f'Missing {key} array')
@@ -0,0 +1,126 @@
+"""
+Структурированное логирование.
+
+Записи кладутся в очередь, а в stderr их пишет отдельный поток, поэтому
+рендер и обработчики запросов не ждут вывода. Поток запускается при первой
+записи, а не при настройке: импорт приложения потоков не создает. Формат - JSON строка на
+запись (LOG_FORMAT=json, по умолчанию) или текст (LOG_FORMAT=text), уровень -
+LOG_LEVEL (по умолчанию INFO). Вызов ниже уровня стоит одной проверки:
+сообщение форматируется лениво, только если запись будет выведена.
+
+Контекст передается полями: logger.info('Слайд сгенерирован',
+extra={'carousel_id': ..., 'slide': 1}).
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+
+# Атрибуты LogRecord, которые не являются полями контекста
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+_listener_started = False
+_listener_lock = threading.Lock()
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RESERVED}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON строка на запись: время, уровень, логгер, сообщение и поля"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(_fields(record))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Человекочитаемый вывод для локальной разработки"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь, подставив аргументы в сообщение.
+
+    Очередь внутри процесса, поэтому exc_info передается как есть и
+    трассировка форматируется уже в потоке-писателе.
+    """
+
+    def enqueue(self, record):
+        if not _listener_started:
+            _start_listener()
+        super().enqueue(record)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _stream_handler(log_format):
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(TextFormatter() if log_format == 'text' else JsonFormatter())
+    return handler
+
+
+def _start_listener():
+    global _listener_started
+    with _listener_lock:
+        if not _listener_started:
+            _listener.start()
+            atexit.register(_listener.stop)
+            _listener_started = True
+
+
+def configure_logging(level=None, log_format=None):
+    """Настраивает корневой логгер (повторный вызов ничего не делает)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    level = level or LOG_LEVEL
+    log_format = log_format or LOG_FORMAT
+
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, _stream_handler(log_format),
+                                               respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_QueueHandler(records)]
+    root.setLevel(level)
+
+    def use_direct_handler():
+        # В дочернем процессе пула нет потока-писателя: пишем напрямую
+        root.handlers[:] = [_stream_handler(log_format)]
+
+    os.register_at_fork(after_in_child=use_direct_handler)
@@ -0,0 +1,113 @@
+"""
+Метрики Prometheus.
+
+Гистограммы времени рендеринга, подстановки плейсхолдеров, запросов к
+базе и HTTP запросов, размеры выходных файлов и счетчики fallback
+рендеров. Состояние очереди, пула и кэшей снимается в момент сбора из их
+stats(), поэтому на горячем пути эти метрики ничего не стоят. Отдаются
+endpoint'ом /metrics.
+
+prometheus_client импортируется при первом наблюдении или сборе, а не при
+импорте модуля: метрики и коллекторы регистрируются в этот момент.
+"""
+
+import threading
+
+# Корзины для операций от десятков микросекунд до секунд
+_FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+_RENDER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_BYTES_BUCKETS = (4096, 16384, 65536, 131072, 262144, 524288, 1048576, 2097152, 4194304)
+
+_lock = threading.Lock()
+_metrics = []  # все _Metric модуля
+_collectors = []  # StatsCollector, ожидающие регистрации
+_registered = False
+
+
+class _Metric:
+    """Counter или Histogram prometheus_client, созданный при первом обращении"""
+
+    def __init__(self, kind, name, documentation, labelnames, **kwargs):
+        self._args = (kind, name, documentation, labelnames, kwargs)
+        self._metric = None
+        _metrics.append(self)
+
+    def labels(self, *values):
+        if self._metric is None:
+            _register()
+        return self._metric.labels(*values)
+
+
+def _register():
+    """Импортирует prometheus_client и регистрирует метрики и коллекторы"""
+    global _registered
+    with _lock:
+        import prometheus_client
+        for metric in _metrics:
+            if metric._metric is None:
+                kind, name, documentation, labelnames, kwargs = metric._args
+                metric._metric = getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+        while _collectors:
+            prometheus_client.REGISTRY.register(_collectors.pop(0))
+        _registered = True
+
+
+RENDER_SECONDS = _Metric(
+    'Histogram', 'svg_render_seconds', 'Время растеризации SVG слайда', ['template_id'],
+    buckets=_RENDER_BUCKETS
+)
+ENCODE_SECONDS = _Metric(
+    'Histogram', 'image_encode_seconds', 'Время кодирования изображения', ['format'],
+    buckets=_RENDER_BUCKETS
+)
+SUBSTITUTION_SECONDS = _Metric(
+    'Histogram', 'placeholder_substitution_seconds', 'Время подстановки плейсхолдеров', ['template_id'],
+    buckets=_FAST_BUCKETS
+)
+DB_QUERY_SECONDS = _Metric(
+    'Histogram', 'db_query_seconds', 'Время запроса к SQLite', ['endpoint'],
+    buckets=_FAST_BUCKETS
+)
+HTTP_REQUEST_SECONDS = _Metric(
+    'Histogram', 'http_request_duration_seconds', 'Время обработки HTTP запроса', ['endpoint', 'method', 'status'],
+    buckets=_RENDER_BUCKETS
+)
+OUTPUT_BYTES = _Metric(
+    'Histogram', 'slide_output_bytes', 'Размер сгенерированного изображения', ['format', 'variant'],
+    buckets=_BYTES_BUCKETS
+)
+FALLBACK_RENDERS = _Metric(
+    'Counter', 'fallback_renders', 'Заглушки вместо изображения, которое не удалось отрендерить', ['kind']
+)
+
+
+class StatsCollector:
+    """Превращает словарь stats() компонента в метрики в момент сбора"""
+
+    def __init__(self, prefix, stats, counters=(), gauges=()):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = counters
+        self.gauges = gauges
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+        values = self.stats()
+        for name in self.counters:
+            yield CounterMetricFamily(f'{self.prefix}_{name}', f'{self.prefix}: {name}', value=values[name])
+        for name in self.gauges:
+            yield GaugeMetricFamily(f'{self.prefix}_{name}', f'{self.prefix}: {name}', value=values[name])
+
+
+def register_stats(prefix, stats, counters=(), gauges=()):
+    with _lock:
+        _collectors.append(StatsCollector(prefix, stats, counters, gauges))
+    if _registered:
+        _register()
+
+
+def render_latest():
+    """Текст метрик и его Content-Type"""
+    _register()
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
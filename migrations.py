@@ -0,0 +1,245 @@
+"""
+Версионные миграции схемы базы.
+
+Текущая версия схемы хранится в PRAGMA user_version. Каждая миграция
+выполняется в своей транзакции (BEGIN IMMEDIATE), поэтому несколько
+процессов, стартующих одновременно, не применят ее дважды.
+"""
+
+import logging
+
+from db import get_db_connection
+from template_compiler import content_hash
+
+logger = logging.getLogger(__name__)
+
+
+def _initial_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS templates (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            svg_content TEXT NOT NULL,
+            preview_url TEXT,
+            template_type TEXT DEFAULT 'flyer',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS carousels (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            error_message TEXT
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS carousel_slides (
+            id TEXT PRIMARY KEY,
+            carousel_id TEXT NOT NULL,
+            template_id TEXT NOT NULL,
+            replacements TEXT NOT NULL,
+            slide_order INTEGER NOT NULL,
+            output_url TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (carousel_id) REFERENCES carousels (id),
+            FOREIGN KEY (template_id) REFERENCES templates (id)
+        )
+    ''')
+
+
+def _template_role(conn):
+    # Колонку пишут /api/templates/upload и /api/templates/sync
+    add_column(conn, 'templates', 'template_role', 'TEXT')
+
+
+def _carousel_indexes(conn):
+    # Покрывающий индекс для опроса слайдов: выборка по карусели в порядке
+    # слайдов без обращения к таблице. Префикс (carousel_id, slide_order)
+    # обслуживает и выборку слайдов в render_carousel_job.
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_carousel_slides_carousel_order
+        ON carousel_slides (carousel_id, slide_order, status, template_id, output_url, id)
+    ''')
+
+    # Восстановление очереди при старте
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_carousel_slides_rendering
+        ON carousel_slides (status) WHERE status = 'rendering'
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_carousels_status_created
+        ON carousels (status, created_at)
+    ''')
+
+    # Список шаблонов сортируется по дате создания
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_templates_created
+        ON templates (created_at)
+    ''')
+
+
+def _template_content_hash(conn):
+    # Хэш SVG позволяет пропускать неизмененные шаблоны при синхронизации
+    add_column(conn, 'templates', 'content_hash', 'TEXT')
+
+    rows = conn.execute('SELECT id, svg_content FROM templates').fetchall()
+    conn.executemany(
+        'UPDATE templates SET content_hash = ? WHERE id = ?',
+        [(content_hash(svg_content), template_id) for template_id, svg_content in rows]
+    )
+
+
+def _output_options(conn):
+    # Формат вывода задается шаблоном и переопределяется запросом карусели;
+    # NULL - значение по умолчанию
+    for table in ('templates', 'carousels'):
+        add_column(conn, table, 'output_format', 'TEXT')
+        add_column(conn, table, 'output_quality', 'INTEGER')
+        add_column(conn, table, 'output_colors', 'INTEGER')
+
+    # Результат кодирования каждого слайда
+    add_column(conn, 'carousel_slides', 'output_format', 'TEXT')
+    add_column(conn, 'carousel_slides', 'output_bytes', 'INTEGER')
+    add_column(conn, 'carousel_slides', 'encode_ms', 'REAL')
+
+
+def _slide_variants(conn):
+    # Запрошенные варианты размеров (JSON список имен); NULL - только основной
+    add_column(conn, 'carousels', 'variants', 'TEXT')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS carousel_slide_variants (
+            slide_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            output_url TEXT NOT NULL,
+            output_bytes INTEGER,
+            encode_ms REAL,
+            PRIMARY KEY (slide_id, name),
+            FOREIGN KEY (slide_id) REFERENCES carousel_slides (id)
+        ) WITHOUT ROWID
+    ''')
+
+
+# Размер файлов карусели carousels.id: варианты слайдов, а для слайдов без
+# вариантов (заглушки) - сам слайд
+CAROUSEL_OUTPUT_BYTES = '''
+    SELECT COALESCE(SUM(COALESCE(
+        (SELECT SUM(v.output_bytes) FROM carousel_slide_variants v WHERE v.slide_id = cs.id),
+        cs.output_bytes
+    )), 0)
+    FROM carousel_slides cs
+    WHERE cs.carousel_id = carousels.id
+'''
+
+
+def _retention(conn):
+    # Размер файлов карусели (сумма по слайдам и вариантам) - janitor следит
+    # за квотой по базе, не обходя хранилище; время последнего обращения -
+    # порядок вытеснения (LRU); закрепленные карусели не удаляются
+    add_column(conn, 'carousels', 'output_bytes', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'carousels', 'accessed_at', 'TIMESTAMP')
+    add_column(conn, 'carousels', 'pinned', 'INTEGER NOT NULL DEFAULT 0')
+
+    conn.execute(f'''
+        UPDATE carousels SET output_bytes = ({CAROUSEL_OUTPUT_BYTES})
+    ''')
+
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_carousels_lru
+        ON carousels (COALESCE(accessed_at, completed_at, created_at)) WHERE pinned = 0
+    ''')
+
+
+def _carousel_requests(conn):
+    # Ключи повторов create-and-generate (idempotency.py): Idempotency-Key
+    # клиента и хэш содержимого запроса -> созданная карусель
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS carousel_requests (
+            key TEXT PRIMARY KEY,
+            request_hash TEXT NOT NULL,
+            carousel_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+
+
+def _template_catalog(conn):
+    # Версия шаблонов для каталога в памяти (template_catalog.py): запись
+    # шаблонов увеличивает ее, и процессы перечитывают таблицу templates
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS template_catalog (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO template_catalog (id, version) VALUES (1, 1)')
+
+
+def _slide_lease(conn):
+    # Время захвата слайда воркером (продлевается по ходу рендеринга): после
+    # перезапуска в очередь возвращаются только слайды с истекшей арендой,
+    # а не те, что сейчас рендерит другой процесс gunicorn
+    add_column(conn, 'carousel_slides', 'claimed_at', 'TIMESTAMP')
+
+
+# (версия, описание, функция) - версии идут подряд, начиная с 1
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'templates.template_role', _template_role),
+    (3, 'indexes for carousel hot queries', _carousel_indexes),
+    (4, 'templates.content_hash', _template_content_hash),
+    (5, 'output format options and encode stats', _output_options),
+    (6, 'carousel_slide_variants', _slide_variants),
+    (7, 'carousel retention: output_bytes, accessed_at, pinned', _retention),
+    (8, 'carousel_requests', _carousel_requests),
+    (9, 'template_catalog version', _template_catalog),
+    (10, 'carousel_slides.claimed_at', _slide_lease),
+]
+
+
+def add_column(conn, table, column, definition):
+    """ALTER TABLE ADD COLUMN, если колонки еще нет"""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def schema_version(conn=None):
+    conn = conn or get_db_connection()
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn=None, target=None):
+    """Применяет недостающие миграции (до версии target); возвращает итоговую версию"""
+    conn = conn or get_db_connection()
+    target = MIGRATIONS[-1][0] if target is None else target
+
+    for version, description, apply in MIGRATIONS:
+        if version > target:
+            break
+
+        if schema_version(conn) >= version:
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Другой процесс мог успеть применить миграцию, пока мы ждали блокировку
+            if schema_version(conn) < version:
+                logger.info("Миграция %s: %s", version, description, extra={'schema_version': version})
+                apply(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    return schema_version(conn)
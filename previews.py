@@ -0,0 +1,164 @@
+"""
+Превью шаблонов, отрендеренные заранее.
+
+Превью рендерятся в пуле процессов при загрузке, синхронизации и старте
+приложения в нескольких размерах. Имя файла - хэш SVG и размер, поэтому
+правка шаблона автоматически дает новые файлы и новый ETag, а отдача
+превью в галерее не требует рендеринга.
+"""
+
+import logging
+import os
+import threading
+import uuid
+
+from db import query_all
+from metrics import FALLBACK_RENDERS
+from renderer import generate_png_from_svg, svg_dimensions
+
+logger = logging.getLogger(__name__)
+
+# Ширина превью в пикселях; высота - по пропорциям шаблона
+PREVIEW_SIZES = {
+    'small': 160,
+    'medium': 320,
+    'large': 640,
+}
+
+DEFAULT_PREVIEW_SIZE = 'medium'
+
+
+class PreviewStore:
+    """Хранилище превью, адресуемых хэшем SVG"""
+
+    def __init__(self, folder, pool):
+        self.folder = folder
+        self.pool = pool
+        self._in_flight = {}  # (хэш, размер) -> Future
+        self._lock = threading.Lock()
+        self.rendered = 0
+
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def etag_for(svg_hash, size):
+        return f'{svg_hash}-{size}'
+
+    def path_for(self, svg_hash, size):
+        return os.path.join(self.folder, f'{svg_hash}_{size}.png')
+
+    def schedule(self, svg_content, svg_hash):
+        """Ставит в пул рендеринг недостающих размеров превью"""
+        futures = []
+        width, height = svg_dimensions(svg_content)
+
+        for size, preview_width in PREVIEW_SIZES.items():
+            key = (svg_hash, size)
+            path = self.path_for(svg_hash, size)
+
+            with self._lock:
+                if key in self._in_flight:
+                    futures.append(self._in_flight[key])
+                    continue
+                if os.path.exists(path):
+                    continue
+
+                preview_height = max(1, round(preview_width * height / width))
+                temp_path = os.path.join(self.folder, f'.{uuid.uuid4().hex}.png')
+                future = self.pool.submit(generate_png_from_svg, svg_content, temp_path,
+                                          preview_width, preview_height)
+                self._in_flight[key] = future
+
+            future.add_done_callback(
+                lambda done, key=key, temp_path=temp_path, path=path: self._finish(done, key, temp_path, path)
+            )
+            futures.append(future)
+
+        return futures
+
+    def ensure(self, svg_content, svg_hash, size):
+        """Путь к превью; если его еще нет - дожидается рендеринга"""
+        path = self.path_for(svg_hash, size)
+        if os.path.exists(path):
+            return path
+
+        for future in self.schedule(svg_content, svg_hash):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("Ошибка рендеринга превью: %s", e, extra={'template_hash': svg_hash, 'size': size})
+
+        return path if os.path.exists(path) else None
+
+    def refresh(self, template_ids=None, background=True):
+        """Рендерит недостающие превью шаблонов (всех, если template_ids не задан)"""
+        if background:
+            thread = threading.Thread(target=self.refresh, args=(template_ids, False),
+                                      name='preview-refresh', daemon=True)
+            thread.start()
+            return thread
+
+        try:
+            if template_ids is None:
+                rows = query_all('SELECT svg_content, content_hash FROM templates')
+                self._prune({row['content_hash'] for row in rows})
+            else:
+                ids = list(template_ids)
+                rows = []
+                # Ограничение SQLite на число параметров
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    rows.extend(query_all(f'''
+                        SELECT svg_content, content_hash FROM templates
+                        WHERE id IN ({','.join('?' * len(chunk))})
+                    ''', chunk))
+
+            scheduled = 0
+            for row in rows:
+                if row['content_hash']:
+                    scheduled += len(self.schedule(row['svg_content'], row['content_hash']))
+
+            if scheduled:
+                logger.info("Запланировано превью", extra={'previews': scheduled})
+        except Exception:
+            logger.exception("Ошибка обновления превью")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sizes': PREVIEW_SIZES,
+                'in_flight': len(self._in_flight),
+                'rendered': self.rendered
+            }
+
+    def _finish(self, future, key, temp_path, path):
+        try:
+            result = None if future.cancelled() or future.exception() is not None else future.result()
+            if result == 'fallback':
+                # Заглушку под именем с хэшем не сохраняем: ее отдавали бы с
+                # сильным ETag, а schedule() больше не перерендерил бы превью
+                FALLBACK_RENDERS.labels('preview').inc()
+                logger.warning("Превью отрендерено заглушкой и не сохранено", extra={'path': path})
+            if result and result != 'fallback':
+                os.replace(temp_path, path)
+                with self._lock:
+                    self.rendered += 1
+            elif os.path.exists(temp_path):
+                os.remove(temp_path)
+        except OSError as e:
+            logger.error("Ошибка сохранения превью: %s", e, extra={'path': path})
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _prune(self, live_hashes):
+        """Удаляет превью шаблонов, которых больше нет или которые изменились"""
+        for entry in os.scandir(self.folder):
+            if entry.name.startswith('.'):
+                continue
+            svg_hash = entry.name.split('_', 1)[0]
+            if svg_hash not in live_hashes:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
@@ -0,0 +1,489 @@
+"""
+Изображения по URL в плейсхолдерах.
+
+Плейсхолдер, который целиком занимает href элемента <image>
+(<image href="{dyno.photo}" width="300" height="200"/>), принимает URL
+картинки. Перед рендером она скачивается, уменьшается до размера слота
+в пикселях растра и подставляется как data: URI с PNG. Так cairosvg не
+декодирует 12-мегапиксельную фотографию (и не перекодирует ее в PNG) на
+каждый рендер ради прямоугольника 300x200. Любое другое значение такого
+плейсхолдера (нет в запросе, пустое, не http(s) URL) заменяется прозрачным
+пикселем, а cairosvg загружает только data: URI (url_fetcher в renderer.py),
+поэтому ссылки в шаблоне не приводят к чтению файлов и запросам в сеть.
+
+- Загрузка идет через общую сессию requests с пулом соединений, не
+  больше max_concurrency загрузок одновременно, с таймаутами и
+  ограничением размера ответа.
+- Оригиналы лежат в дисковом кэше под ключом из URL и ETag, уменьшенные
+  копии - рядом, под ключом оригинала и размера слота. Пока запись свежая
+  (ttl), сеть не нужна; после этого она перепроверяется условным запросом
+  (If-None-Match / If-Modified-Since), и ответ 304 обходится без загрузки.
+- Одинаковые загрузки слайдов одной и разных каруселей объединяются.
+- Ошибка загрузки не роняет слайд: слот остается прозрачным.
+- Адреса из плейсхолдеров присылает клиент, поэтому по умолчанию запросы
+  к внутренним адресам (loopback, частные сети, link-local вроде
+  169.254.169.254, зарезервированные и multicast) запрещены: проверяются
+  все адреса хоста перед каждым запросом, каждый шаг редиректа и адрес,
+  к которому соединение подключилось на самом деле.
+- Дисковый кэш ограничен max_cache_bytes: сверх него удаляются файлы,
+  которые дольше всех не читались (время изменения обновляется при
+  чтении).
+"""
+
+import base64
+import hashlib
+import io
+import ipaddress
+import json
+import logging
+import math
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from renderer import MAX_RASTER_SIDE, svg_dimensions
+from template_compiler import content_hash
+
+logger = logging.getLogger(__name__)
+
+SLOTS_CACHE_SIZE = 256
+MAX_REDIRECTS = 5
+# После превышения бюджета кэш чистится до этой доли от него
+CACHE_TRIM_RATIO = 0.9
+
+# Прозрачный PNG 1x1 на месте картинки, которую не удалось загрузить
+TRANSPARENT_PIXEL = ('data:image/png;base64,'
+                     'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNgYGBgAAAABQABeqhXUAAAAABJRU5ErkJggg==')
+
+_IMAGE_TAG = re.compile(r'<(?:[A-Za-z_][\w.\-]*:)?image\b[^>]*>')
+_HREF_PLACEHOLDER = re.compile(r'\s(?:xlink:)?href\s*=\s*(["\'])\s*\{([A-Za-z_][A-Za-z0-9_.\-]*)\}\s*\1')
+_DIMENSION = r'\s{}\s*=\s*["\']\s*([0-9.]+)\s*(?:px)?\s*["\']'
+
+
+def is_remote(value):
+    """Значение плейсхолдера - http(s) URL картинки, которую нужно загрузить"""
+    if not isinstance(value, str):
+        return False
+    try:
+        # urlsplit приводит схему к нижнему регистру: HTTP:// - тоже http
+        return urlsplit(value.strip()).scheme in ('http', 'https')
+    except ValueError:
+        return False
+
+
+def image_slots(svg_content):
+    """Плейсхолдеры в href элементов <image> и размер слота в единицах шаблона.
+
+    Размер берется из атрибутов width/height элемента; если их нет или они
+    не в пикселях - размер слайда. Плейсхолдер в нескольких слотах получает
+    наибольший размер.
+    """
+    slots = {}
+    slide_width, slide_height = svg_dimensions(svg_content)
+
+    for tag in _IMAGE_TAG.finditer(svg_content):
+        tag = tag.group(0)
+        href = _HREF_PLACEHOLDER.search(tag)
+        if href is None:
+            continue
+
+        size = []
+        for attribute, default in (('width', slide_width), ('height', slide_height)):
+            match = re.search(_DIMENSION.format(attribute), tag)
+            try:
+                size.append(float(match.group(1)) if match and float(match.group(1)) > 0 else default)
+            except ValueError:
+                size.append(default)
+
+        width, height = slots.get(href.group(2), (0, 0))
+        slots[href.group(2)] = (max(width, size[0]), max(height, size[1]))
+
+    return slots
+
+
+def is_public_address(address):
+    """Адрес в интернете, а не loopback, частная сеть, link-local, зарезервированный или multicast"""
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not (ip.is_private or ip.is_loopback or ip.is_link_local
+                                 or ip.is_reserved or ip.is_multicast or ip.is_unspecified)
+
+
+class RemoteImages:
+    """Загрузка, дисковый кэш и уменьшение картинок для плейсхолдеров"""
+
+    def __init__(self, cache_dir, max_concurrency=8, timeout=10, max_bytes=20 * 1024 * 1024,
+                 ttl=3600, allowed_hosts=(), max_cache_bytes=512 * 1024 * 1024, allow_private=False):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.timeout = float(timeout)
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        # Пустой список - любые хосты
+        self.allowed_hosts = tuple(host.strip().lower() for host in allowed_hosts if host.strip())
+        # True - разрешить внутренние адреса (локальная заглушка, закрытая сеть)
+        self.allow_private = bool(allow_private)
+        # 0 - без ограничения
+        self.max_cache_bytes = int(max_cache_bytes)
+
+        # Сессия и потоки создаются при первой загрузке - после fork пула рендеринга
+        self._session = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = {}  # (URL, ширина, высота) -> Future
+        self._slots = OrderedDict()  # хэш шаблона -> image_slots()
+        self._trim_lock = threading.Lock()
+        self._cache_bytes = None  # считается обходом каталога при первой записи
+        self.cached = 0
+        self.revalidated = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.evicted = 0
+
+    def prefetch(self, svg_content, replacements, scale=1):
+        """Запускает загрузку картинок слайда; [(плейсхолдер, Future с data: URI)].
+
+        scale - во сколько раз растр слайда больше шаблона.
+        """
+        futures = []
+        if not isinstance(replacements, dict):
+            return futures
+        for name, (width, height) in self.slots(svg_content).items():
+            url = replacements.get(name)
+            if not is_remote(url):
+                continue
+            size = tuple(min(MAX_RASTER_SIDE, max(1, math.ceil(side * scale))) for side in (width, height))
+            futures.append((name, self._submit(url, size)))
+        return futures
+
+    def embed(self, svg_content, replacements, scale=1):
+        """Значения плейсхолдеров, где URL картинок заменены на data: URI.
+
+        Слот без http(s) URL (значения нет, оно пустое или другой схемы)
+        получает прозрачный пиксель: иначе в SVG останется ссылка, которую
+        cairosvg не загрузит, и слайд отрендерится заглушкой.
+        """
+        if not isinstance(replacements, dict):
+            return replacements
+        slots = self.slots(svg_content)
+        if not slots:
+            return replacements
+
+        embedded = dict(replacements)
+        for name in slots:
+            if not is_remote(embedded.get(name)):
+                embedded[name] = TRANSPARENT_PIXEL
+        for name, future in self.prefetch(svg_content, replacements, scale):
+            embedded[name] = future.result()
+        return embedded
+
+    def slots(self, svg_content):
+        """image_slots() шаблона из кэша по хэшу содержимого"""
+        key = content_hash(svg_content)
+        with self._lock:
+            if key in self._slots:
+                self._slots.move_to_end(key)
+                return self._slots[key]
+
+        slots = image_slots(svg_content)
+
+        with self._lock:
+            self._slots[key] = slots
+            while len(self._slots) > SLOTS_CACHE_SIZE:
+                self._slots.popitem(last=False)
+        return slots
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': self.cached,
+                'revalidated': self.revalidated,
+                'downloaded': self.downloaded,
+                'failed': self.failed,
+                'in_flight': len(self._in_flight),
+                'cache_bytes': self._cache_bytes or 0,
+                'max_cache_bytes': self.max_cache_bytes,
+                'evicted': self.evicted
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _submit(self, url, size):
+        key = (url, *size)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                    thread_name_prefix='remote-image')
+            future = self._executor.submit(self._resolve, url, *size)
+            self._in_flight[key] = future
+
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _resolve(self, url, width, height):
+        try:
+            try:
+                source = self._source(url)
+                data = self._scaled(source, width, height)
+            except FileNotFoundError:
+                # Оригинал удалили при чистке кэша между проверкой и чтением
+                source = self._source(url)
+                data = self._scaled(source, width, height)
+        except Exception as e:
+            logger.warning("Не удалось загрузить изображение: %s", e, extra={'url': url})
+            self._count('failed')
+            return TRANSPARENT_PIXEL
+        return 'data:image/png;base64,' + base64.b64encode(data).decode('ascii')
+
+    def _source(self, url):
+        """Ключ оригинала в кэше; загружает или перепроверяет его при необходимости"""
+        meta_path = self._path(hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+        meta = self._read_meta(meta_path)
+        if meta is not None and not os.path.exists(self._path(meta['source'])):
+            meta = None
+
+        if meta is not None and time.time() - meta['checked_at'] < self.ttl:
+            self._touch(meta_path, self._path(meta['source']))
+            self._count('cached')
+            return meta['source']
+
+        headers = {}
+        if meta is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        # Таймаут на соединение и на каждое чтение; тело целиком - не дольше timeout
+        deadline = time.monotonic() + self.timeout
+        with self._get(url, headers) as response:
+            if response.status_code == 304 and meta is not None:
+                meta['checked_at'] = time.time()
+                self._write(meta_path, json.dumps(meta).encode('utf-8'))
+                self._count('revalidated')
+                return meta['source']
+
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '')
+            if not content_type.startswith('image/'):
+                raise ValueError(f'not an image: {content_type or "no Content-Type"}')
+
+            declared = response.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                raise ValueError(f'image is larger than {self.max_bytes} bytes')
+
+            chunks = []
+            received = 0
+            for chunk in response.iter_content(64 * 1024):
+                received += len(chunk)
+                if received > self.max_bytes:
+                    raise ValueError(f'image is larger than {self.max_bytes} bytes')
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'download took longer than {self.timeout:g}s')
+                chunks.append(chunk)
+            data = b''.join(chunks)
+
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        # Ключ - URL и ETag; без ETag вместо него хэш содержимого
+        version = etag or hashlib.sha1(data).hexdigest()
+        source = hashlib.sha1(f'{url}\n{version}'.encode('utf-8')).hexdigest()
+        if not os.path.exists(self._path(source)):
+            self._write(self._path(source), data)
+        self._write(meta_path, json.dumps({
+            'url': url, 'etag': etag, 'last_modified': last_modified,
+            'source': source, 'checked_at': time.time()
+        }).encode('utf-8'))
+        self._count('downloaded')
+        return source
+
+    def _scaled(self, source, width, height):
+        """PNG оригинала, уменьшенный так, чтобы покрыть слот width x height"""
+        path = self._path(f'{source}_{width}x{height}.png')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            self._touch(path)
+            return data
+        except FileNotFoundError:
+            pass
+
+        from PIL import Image, ImageOps
+
+        with Image.open(self._path(source)) as image:
+            # JPEG декодируется сразу в уменьшенном масштабе (DCT scaling);
+            # квадрат - потому что EXIF поворот может поменять стороны местами
+            side = max(width, height)
+            image.draft('RGB', (side, side))
+            image = ImageOps.exif_transpose(image)
+
+            # Покрываем слот целиком (как preserveAspectRatio slice) и никогда не увеличиваем
+            factor = min(1.0, max(width / image.width, height / image.height))
+            target = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+            if target != image.size:
+                image = image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+
+            output = io.BytesIO()
+            image.save(output, 'PNG', compress_level=1)
+            data = output.getvalue()
+
+        self._write(path, data)
+        return data
+
+    def _get(self, url, headers):
+        """Потоковый ответ; редиректы проходятся вручную с проверкой каждого адреса"""
+        session = self._get_session()
+        for _ in range(MAX_REDIRECTS + 1):
+            self._check_host(url)
+            response = session.get(url, headers=headers, stream=True, allow_redirects=False,
+                                   timeout=(self.timeout, self.timeout))
+            try:
+                self._check_peer(url, response)
+            except Exception:
+                response.close()
+                raise
+            if not response.is_redirect:
+                return response
+            url = urljoin(url, response.headers['Location'])
+            response.close()
+        raise ValueError(f'more than {MAX_REDIRECTS} redirects')
+
+    def _check_host(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'unsupported URL scheme: {parts.scheme}')
+        host = (parts.hostname or '').lower()
+        if self.allowed_hosts and not any(host == allowed or host.endswith('.' + allowed)
+                                          for allowed in self.allowed_hosts):
+            raise ValueError(f'host is not allowed: {host}')
+        if self.allow_private:
+            return
+
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or 80, type=socket.SOCK_STREAM)}
+        except (socket.gaierror, UnicodeError) as e:
+            raise ValueError(f'cannot resolve host {host}: {e}')
+        for address in addresses:
+            if not is_public_address(address):
+                raise ValueError(f'host {host} resolves to a non-public address {address}')
+
+    def _check_peer(self, url, response):
+        """Адрес, к которому подключились: DNS мог ответить иначе, чем при проверке"""
+        if self.allow_private:
+            return
+        import requests
+
+        # Через прокси подключение идет к нему, а не к хосту картинки
+        if requests.utils.get_environ_proxies(url):
+            return
+        sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+        if sock is None:
+            return
+        address = sock.getpeername()[0]
+        if not is_public_address(address):
+            raise ValueError(f'connected to a non-public address {address}')
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                # requests нужен только при загрузке картинок - не замедляем им старт
+                import requests
+
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_concurrency,
+                                                        pool_maxsize=self.max_concurrency)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['User-Agent'] = 'svg-template-api'
+                self._session = session
+            return self._session
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _read_meta(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Пишем рядом и переименовываем, чтобы параллельные читатели не видели недописанный файл
+        partial_path = f'{path}.{uuid.uuid4().hex}.part'
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        os.replace(partial_path, path)
+        self._trim(len(data))
+
+    def _touch(self, *paths):
+        """Отмечает чтение файлов кэша: чистка удаляет давно не читавшиеся"""
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    def _trim(self, added):
+        """Держит кэш в пределах max_cache_bytes (перезапись учитывается с запасом до обхода)"""
+        if self.max_cache_bytes <= 0:
+            return
+        with self._trim_lock:
+            if self._cache_bytes is not None:
+                self._cache_bytes += added
+                if self._cache_bytes <= self.max_cache_bytes:
+                    return
+
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.part') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_cache_bytes:
+                entries.sort()
+                target = self.max_cache_bytes * CACHE_TRIM_RATIO
+                evicted = 0
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    evicted += 1
+                with self._lock:
+                    self.evicted += evicted
+            self._cache_bytes = total
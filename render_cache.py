@@ -0,0 +1,199 @@
+"""
+Контентно-адресуемый кэш отрендеренных изображений.
+
+Ключ - хэш от (SVG после подстановки, ширина, высота, параметры кодирования).
+Один и тот же слайд рендерится один раз: запись кэша лежит в хранилище под
+_cache/, а объекты слайдов - ее копии средствами хранилища (жесткая ссылка
+на диске, общий объект bytes в памяти, копирование на стороне сервера в S3).
+Поэтому вытеснение записи по LRU не ломает уже выданные слайды.
+
+Запись, на файл которой не ссылается ни один слайд (одна жесткая ссылка),
+занимает место только ради будущих попаданий: очистка (janitor.py) считает
+такие записи в квоте результатов и удаляет их первыми (unshared, discard).
+
+Пока слайд рендерится, его ключи отмечены как занятые (begin/end): слайд с
+теми же ключами из другой карусели (например, из той же пачки) ждет этот
+рендер и берет результат из кэша, а не рендерит его второй раз.
+"""
+
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+CACHE_PREFIX = '_cache'
+
+
+class RenderCache:
+    """Кэш изображений с бюджетом в байтах и вытеснением по LRU"""
+
+    def __init__(self, storage, max_bytes):
+        self.storage = storage
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()  # ключ кэша -> (ключ объекта, размер)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._rendering = {}  # ключи вариантов слайда -> Future, завершится после store
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.joined = 0
+
+        self._load()
+
+    @staticmethod
+    def make_key(svg_content, width, height, output_format='png', quality=None, colors=None):
+        """Ключ кэша для отрендеренного слайда"""
+        digest = hashlib.sha256()
+        digest.update(f'{width}x{height}:{output_format}:q{quality}:c{colors}:'.encode('utf-8'))
+        digest.update(svg_content.encode('utf-8'))
+        return digest.hexdigest()
+
+    def copy_to(self, key, dest_key):
+        """Копирует запись кэша в объект слайда; размер записи или None при промахе"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        # Копирование (в S3 - запрос) идет без блокировки: другие слайды не ждут
+        if not self.storage.copy(entry[0], dest_key):
+            with self._lock:
+                # Объект удалили мимо кэша или вытеснили - забываем запись
+                if self._entries.get(key) == entry:
+                    self._forget(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return entry[1]
+
+    def store(self, key, data, dest_keys=(), output_format='png'):
+        """Кладет свежий рендер в кэш и копирует его в объекты слайдов"""
+        object_key = self._object_key(key, output_format)
+        content_type = mimetypes.guess_type(object_key)[0] or 'application/octet-stream'
+        self.storage.put(object_key, data, content_type)
+
+        # Слайды получают файл до записи в индекс: запись без ссылок из
+        # слайдов (unshared) видна только после копирования
+        for dest_key in dest_keys:
+            if not self.storage.copy(object_key, dest_key):
+                self.storage.put(dest_key, data, content_type)
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries[key][1]
+            self._entries[key] = (object_key, len(data))
+            self._entries.move_to_end(key)
+            self._total_bytes += len(data)
+            evicted = self._evict()
+
+        self._delete(evicted)
+        return object_key
+
+    def begin(self, keys):
+        """Отмечает рендер ключей как идущий.
+
+        Возвращает (True, Future), если рендерит вызывающий - тогда он обязан
+        вызвать end, или (False, Future) рендера, который уже идет в другом
+        месте; Future завершится после записи результата в кэш.
+        """
+        with self._lock:
+            future = self._rendering.get(keys)
+            if future is not None:
+                self.joined += 1
+                return False, future
+            future = self._rendering[keys] = Future()
+            return True, future
+
+    def end(self, keys, future, error=None):
+        """Завершает рендер, начатый begin; повторный вызов ничего не делает"""
+        with self._lock:
+            if self._rendering.get(keys) is future:
+                del self._rendering[keys]
+        if future.done():
+            return
+        if error is None:
+            future.set_result(keys)
+        else:
+            future.set_exception(error)
+
+    def unshared(self):
+        """[(ключ, размер)] записей без ссылок из слайдов, от давно не читавшихся"""
+        with self._lock:
+            entries = [(key, object_key, size) for key, (object_key, size) in self._entries.items()]
+        # Файлы проверяются без блокировки: рендер не ждет обхода кэша
+        return [(key, size) for key, object_key, size in entries if self.storage.link_count(object_key) <= 1]
+
+    def discard(self, keys):
+        """Удаляет записи из кэша и хранилища; освобожденные байты"""
+        removed = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._forget(key)
+                    self.evictions += 1
+                    removed.append(entry)
+
+        freed = 0
+        for object_key, size in removed:
+            # Пока запись ждала удаления, слайд мог успеть сослаться на файл
+            if self.storage.link_count(object_key) <= 1:
+                freed += size
+            self.storage.delete(object_key)
+        return freed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'rendering': len(self._rendering),
+                'joined': self.joined
+            }
+
+    @staticmethod
+    def _object_key(key, output_format):
+        return f'{CACHE_PREFIX}/{key[:2]}/{key}.{output_format}'
+
+    def _evict(self):
+        """Вытесняет записи из индекса (под блокировкой); ключи объектов для _delete"""
+        evicted = []
+        # Самую свежую запись не вытесняем, даже если она одна больше бюджета
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            evicted.append(self._entries[key][0])
+            self._forget(key)
+            self.evictions += 1
+        return evicted
+
+    def _delete(self, object_keys):
+        # Удаление из хранилища - без блокировки
+        for object_key in object_keys:
+            self.storage.delete(object_key)
+
+    def _forget(self, key):
+        _, size = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def _load(self):
+        """Восстанавливает индекс кэша из хранилища"""
+        for object_key, size in self.storage.list(f'{CACHE_PREFIX}/'):
+            key = object_key.rsplit('/', 1)[-1].split('.', 1)[0]
+            self._entries[key] = (object_key, size)
+            self._total_bytes += size
+
+        with self._lock:
+            evicted = self._evict()
+        self._delete(evicted)
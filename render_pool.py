@@ -0,0 +1,114 @@
+"""
+Пул процессов для параллельного рендеринга слайдов.
+
+cairosvg нагружает CPU и держит GIL, поэтому слайды одной карусели
+рендерятся в отдельных процессах. Процессы создаются один раз при старте
+и переиспользуются между запросами.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+
+class RenderPool:
+    """Пул процессов рендеринга с учетом загрузки"""
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        # processes = 0 - рендеринг прямо в вызывающем потоке, без пула
+        self.processes = max(0, int(processes))
+        self._executor = None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+
+    def start(self):
+        """Создает процессы пула.
+
+        Вызывать до запуска фоновых потоков: при fork дочерние процессы
+        копируются из однопоточного родителя. Процессы создаются сразу все
+        (с fork - на первой задаче), тяжелые импорты они делают сами при
+        прогреве или первом рендере.
+        """
+        if self.processes == 0 or self._executor is not None:
+            return
+
+        self._executor = ProcessPoolExecutor(max_workers=self.processes)
+        self._executor.submit(os.getpid).result()
+        logger.info("Пул рендеринга запущен", extra={'processes': self.processes})
+
+    def warm_up(self, fn, *args):
+        """Выполняет fn(*args) по разу на процесс пула и ждет результатов.
+
+        Задачи раздаются свободным процессам, поэтому попадание в каждый
+        процесс не гарантировано, но при одновременной отправке вероятно.
+        """
+        if self._executor is None:
+            return [fn(*args)]
+        futures = [self._executor.submit(fn, *args) for _ in range(self.processes)]
+        return [future.result() for future in futures]
+
+    def submit(self, fn, *args, **kwargs):
+        """Отправляет задачу в пул и возвращает Future"""
+        with self._lock:
+            self._active += 1
+            self._submitted += 1
+
+        if self._executor is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            try:
+                future = self._executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                # Дочерний процесс упал (например, в нативном коде cairo) - пересоздаем пул
+                logger.warning("Пул рендеринга поврежден, пересоздаю процессы")
+                self._restart()
+                future = self._executor.submit(fn, *args, **kwargs)
+
+        future.add_done_callback(self._on_done)
+        return future
+
+    def stats(self):
+        """Размер пула и текущая загрузка"""
+        with self._lock:
+            workers = self.processes or 1
+            return {
+                'processes': self.processes,
+                'active': self._active,
+                'utilisation': round(min(self._active, workers) / workers, 3),
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _restart(self):
+        with self._lock:
+            old_executor = self._executor
+            self._executor = ProcessPoolExecutor(max_workers=self.processes)
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    def _on_done(self, future):
+        with self._lock:
+            self._active -= 1
+            if future.cancelled() or future.exception() is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
@@ -0,0 +1,291 @@
+"""
+Фоновая очередь рендеринга каруселей.
+
+Очередь персистентная: её состояние хранится в таблицах carousels и
+carousel_slides. Карусель в статусе 'queued' ждёт воркера, в статусе
+'generating' — обрабатывается. In-memory очередь нужна только для того,
+чтобы будить воркеров; после перезапуска всё незавершённое
+восстанавливается из базы в recover().
+
+Слайд в работе ('rendering') помечен временем захвата claimed_at, которое
+воркер продлевает, пока рендерит карусель. Процессов gunicorn может быть
+несколько, и каждый вызывает recover() при старте, поэтому в очередь
+возвращаются только слайды с истекшей арендой (lease_seconds): их процесс
+остановился. Те же слайды периодически подбирает поток render-reclaim.
+
+Допуск в очередь ограничен числом слайдов в очереди и в работе
+(max_pending_slides) и числом слайдов одного клиента (max_client_slides):
+admit() до постановки бросает QueueFull со временем, через которое стоит
+повторить (по средней скорости рендеринга слайда). Очередь пустая для
+запроса (или для клиента) принимает его любого размера. Воркеры берут
+карусели честно по клиентам (API ключ или origin): следующей идет карусель
+клиента, которому отрендерено меньше всего слайдов, поэтому клиент с
+большой пачкой не задерживает остальных дольше, чем на одну карусель.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from db import execute, transaction
+
+logger = logging.getLogger(__name__)
+
+# Клиент задач без запроса (восстановление после перезапуска)
+DEFAULT_CLIENT = 'default'
+# Аренда слайда по умолчанию, секунды
+LEASE_SECONDS = 600
+# Оценка времени слайда, пока нет замеров, и пределы Retry-After, секунды
+INITIAL_SLIDE_SECONDS = 0.5
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 300
+
+
+class QueueFull(Exception):
+    """Очередь не принимает задачу; retry_after - через сколько секунд повторить"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RenderQueue:
+    """Пул фоновых потоков, которые разбирают очередь генерации каруселей"""
+
+    def __init__(self, handler, workers=2, on_failed=None, max_pending_slides=0, max_client_slides=0,
+                 lease_seconds=LEASE_SECONDS):
+        self.handler = handler
+        # Вызывается с (carousel_id, ошибка), когда обработчик упал
+        self.on_failed = on_failed
+        self.workers = max(1, int(workers))
+        # 0 - без ограничения
+        self.max_pending_slides = int(max_pending_slides)
+        self.max_client_slides = int(max_client_slides)
+        self.lease_seconds = float(lease_seconds)
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._waiting = {}  # клиент -> deque[(id карусели, слайдов)] в порядке постановки
+        self._served = {}  # клиент -> отрендерено слайдов, пока он в очереди
+        self._queued_ids = {}  # id карусели -> (клиент, слайдов)
+        self._pending = {}  # клиент -> слайдов в очереди и в работе
+        self._pending_slides = 0
+        self._running = 0
+        # Скользящее среднее времени слайда на одном воркере
+        self._slide_seconds = INITIAL_SLIDE_SECONDS
+        self.rejected = 0
+        self.reclaimed = 0
+        self._threads = []
+
+    def start(self):
+        """Восстанавливает незавершённые задачи и запускает воркеров"""
+        if self._threads:
+            return
+
+        self.recover()
+
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker_loop,
+                name=f'render-worker-{i + 1}',
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        if self.lease_seconds > 0:
+            thread = threading.Thread(target=self._reclaim_loop, name='render-reclaim', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info("Запущены воркеры рендеринга", extra={'workers': self.workers})
+
+    def recover(self):
+        """Возвращает в очередь карусели, оставшиеся с прошлого запуска"""
+        with transaction() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # Слайды, которые рендерились в момент остановки, начинаем заново;
+            # слайды с живой арендой рендерит другой процесс
+            self._reclaim(conn)
+
+            rows = conn.execute('''
+                SELECT c.id,
+                       (SELECT COUNT(*) FROM carousel_slides cs
+                        WHERE cs.carousel_id = c.id AND cs.status = 'pending')
+                FROM carousels c
+                WHERE c.status IN ('queued', 'generating')
+                ORDER BY c.created_at
+            ''').fetchall()
+            carousel_ids = [row[0] for row in rows]
+
+        # Восстановленные задачи принимаются без проверки допуска
+        for carousel_id, slides in rows:
+            self.enqueue(carousel_id, slides)
+
+        if carousel_ids:
+            logger.info("Восстановлены задачи генерации", extra={'carousels': len(carousel_ids)})
+
+        return len(carousel_ids)
+
+    def reclaim(self):
+        """Возвращает в очередь карусели, слайды которых бросил остановившийся процесс"""
+        with transaction() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = self._reclaim(conn)
+
+        for carousel_id, slides in rows:
+            self.enqueue(carousel_id, slides)
+
+        if rows:
+            logger.warning("Возвращены слайды с истекшей арендой",
+                           extra={'carousels': len(rows), 'slides': sum(slides for _, slides in rows)})
+        return len(rows)
+
+    def _reclaim(self, conn):
+        """Слайды с истекшей арендой -> 'pending'; [(id карусели, слайдов)]"""
+        expired = '''
+            status = 'rendering'
+            AND (claimed_at IS NULL OR claimed_at < datetime('now', ?))
+            AND carousel_id IN (SELECT id FROM carousels WHERE status IN ('queued', 'generating'))
+        '''
+        params = (f'-{self.lease_seconds} seconds',)
+        rows = conn.execute(f'''
+            SELECT carousel_id, COUNT(*) FROM carousel_slides
+            WHERE {expired}
+            GROUP BY carousel_id
+        ''', params).fetchall()
+        if rows:
+            conn.execute(f'''
+                UPDATE carousel_slides
+                SET status = 'pending', claimed_at = NULL
+                WHERE {expired}
+            ''', params)
+            with self._lock:
+                self.reclaimed += sum(slides for _, slides in rows)
+        return rows
+
+    def _reclaim_loop(self):
+        # Чаще срока аренды, чтобы брошенный слайд ждал не больше полутора сроков
+        while True:
+            time.sleep(self.lease_seconds / 2)
+            try:
+                self.reclaim()
+            except Exception as e:
+                logger.error("Не удалось вернуть брошенные слайды: %s", e)
+
+    def admit(self, slides, client=DEFAULT_CLIENT):
+        """Проверяет, примет ли очередь slides слайдов клиента; иначе QueueFull.
+
+        Проверка отдельна от enqueue(), чтобы отказать до записи в базу;
+        одновременные запросы могут немного превысить предел.
+        """
+        with self._lock:
+            client_pending = self._pending.get(client, 0)
+            if (self.max_client_slides and client_pending
+                    and client_pending + slides > self.max_client_slides):
+                message = 'Too many slides queued for this client'
+                excess = client_pending + slides - self.max_client_slides
+            elif (self.max_pending_slides and self._pending_slides
+                    and self._pending_slides + slides > self.max_pending_slides):
+                message = 'Render queue is full'
+                excess = self._pending_slides + slides - self.max_pending_slides
+            else:
+                return
+
+            self.rejected += 1
+            # Столько слайдов должно отрендериться, чтобы задача поместилась
+            seconds = excess * self._slide_seconds / self.workers
+            retry_after = min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, math.ceil(seconds)))
+
+        raise QueueFull(message, retry_after)
+
+    def enqueue(self, carousel_id, slides=1, client=DEFAULT_CLIENT):
+        """Ставит карусель в очередь; повторная постановка игнорируется"""
+        with self._condition:
+            if carousel_id in self._queued_ids:
+                return False
+            self._queued_ids[carousel_id] = (client, slides)
+
+            waiting = self._waiting.get(client)
+            if waiting is None:
+                # Вернувшийся клиент не копит очередь: начинает наравне с
+                # наименее обслуженным из ждущих
+                waiting = self._waiting[client] = deque()
+                self._served[client] = min(self._served.values(), default=0)
+            waiting.append((carousel_id, slides))
+
+            self._pending[client] = self._pending.get(client, 0) + slides
+            self._pending_slides += slides
+            self._condition.notify()
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'depth': len(self._queued_ids) + self._running,
+                'pending_slides': self._pending_slides,
+                'max_pending_slides': self.max_pending_slides,
+                'max_client_slides': self.max_client_slides,
+                'clients': len(self._pending),
+                'slide_seconds': round(self._slide_seconds, 3),
+                'rejected': self.rejected,
+                'reclaimed': self.reclaimed
+            }
+
+    def _next(self):
+        """Карусель наименее обслуженного клиента (под блокировкой)"""
+        client = min(self._waiting, key=self._served.__getitem__)
+        waiting = self._waiting[client]
+        carousel_id, slides = waiting.popleft()
+        self._served[client] += slides
+        if not waiting:
+            del self._waiting[client]
+            del self._served[client]
+        return carousel_id, client, slides
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while not self._waiting:
+                    self._condition.wait()
+                carousel_id, client, slides = self._next()
+                # Снимаем отметку до начала работы: повторный запуск генерации,
+                # пришедший во время рендеринга, должен снова попасть в очередь
+                del self._queued_ids[carousel_id]
+                self._running += 1
+
+            started = time.monotonic()
+            try:
+                self.handler(carousel_id)
+            except Exception as e:
+                logger.exception("Ошибка фоновой генерации карусели", extra={'carousel_id': carousel_id})
+                self._mark_failed(carousel_id, e)
+            finally:
+                elapsed = time.monotonic() - started
+                with self._lock:
+                    self._running -= 1
+                    self._pending_slides -= slides
+                    self._pending[client] -= slides
+                    if self._pending[client] <= 0:
+                        del self._pending[client]
+                    if slides:
+                        self._slide_seconds += 0.2 * (elapsed / slides - self._slide_seconds)
+
+    def _mark_failed(self, carousel_id, error):
+        try:
+            execute('''
+                UPDATE carousels
+                SET status = 'error', error_message = ?
+                WHERE id = ?
+            ''', (str(error), carousel_id))
+        except Exception as db_error:
+            logger.error("Не удалось сохранить ошибку карусели: %s", db_error, extra={'carousel_id': carousel_id})
+
+        if self.on_failed is not None:
+            try:
+                self.on_failed(carousel_id, error)
+            except Exception as callback_error:
+                logger.error("Ошибка обработчика сбоя карусели: %s", callback_error,
+                             extra={'carousel_id': carousel_id})
@@ -0,0 +1,362 @@
+"""
+Растеризация SVG и кодирование изображений.
+
+Модуль не зависит от Flask и базы данных, чтобы его функции можно было
+выполнять в дочерних процессах пула рендеринга (см. render_pool.py).
+cairosvg и Pillow импортируются при первом использовании: они тяжелые, а
+основному процессу при работе через пул нужны только для fallback и
+поддерживаемых форматов.
+
+Все разборы SVG получают url_fetcher=safe_fetch: cairosvg загружает только
+data: URI, а ссылки на файлы и http(s) заменяет пустой картинкой. Значения
+плейсхолдеров присылает клиент, поэтому иначе шаблон мог бы читать
+локальные файлы или ходить во внутреннюю сеть.
+"""
+
+import io
+import logging
+import mimetypes
+import os
+import re
+import sys
+import time
+
+from template_compiler import get_compiled_template
+
+logger = logging.getLogger(__name__)
+
+_avif_checked = False
+
+DEFAULT_WIDTH = 400
+DEFAULT_HEIGHT = 600
+
+# Формат вывода -> (имя формата Pillow, MIME тип)
+OUTPUT_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'avif': ('AVIF', 'image/avif'),
+}
+
+DEFAULT_FORMAT = 'png'
+# Качество для форматов с потерями, если не задано запросом или шаблоном
+DEFAULT_QUALITY = 85
+
+for _name, (_, _mime) in OUTPUT_FORMATS.items():
+    mimetypes.add_type(_mime, f'.{_name}')
+
+# Варианты слайда: масштаб от размера шаблона или кадр с обрезкой по центру
+VARIANT_PRESETS = {
+    '1x': {'scale': 1},
+    '2x': {'scale': 2},
+    '3x': {'scale': 3},
+    'square': {'size': (1080, 1080)},    # лента Instagram
+    'portrait': {'size': (1080, 1350)},  # Instagram 4:5
+    'story': {'size': (1080, 1920)},     # Stories 9:16
+}
+
+# Основной вариант - размер шаблона; его URL отдается как imageUrl
+PRIMARY_VARIANT = '1x'
+
+# Ограничение стороны растра, чтобы крупные шаблоны не съели память
+MAX_RASTER_SIDE = 4096
+
+# Короткий текст для прогрева: первая растеризация текста загружает шрифты
+WARM_UP_SVG = ('<svg xmlns="http://www.w3.org/2000/svg" width="64" height="32">'
+               '<text x="2" y="20" font-size="16" font-weight="bold">Aa</text>'
+               '<text x="2" y="30" font-size="8">Aa</text></svg>')
+
+_SVG_TAG = re.compile(r'<svg\b[^>]*>', re.IGNORECASE)
+_DIMENSION = r'\b{}\s*=\s*["\']\s*([0-9.]+)\s*(?:px)?\s*["\']'
+
+def _pillow():
+    """Модуль PIL.Image; при первом вызове регистрирует AVIF, если он есть"""
+    global _avif_checked
+    from PIL import Image
+    if not _avif_checked:
+        try:
+            import pillow_avif  # noqa: F401 - регистрирует AVIF в Pillow < 11
+        except ImportError:  # AVIF необязателен
+            pass
+        _avif_checked = True
+    return Image
+
+def supported_formats():
+    """Форматы вывода, которые умеет кодировать установленный Pillow"""
+    Image = _pillow()
+    Image.init()
+    return [name for name, (pil_format, _) in OUTPUT_FORMATS.items() if pil_format in Image.SAVE]
+
+def output_options(output_format=None, quality=None, colors=None):
+    """Проверяет и нормализует параметры кодирования.
+    
+    Возвращает (формат, качество, число цветов палитры); параметры, которые
+    к формату не относятся, сбрасываются в None, чтобы не дробить кэш.
+    Бросает ValueError при неверных значениях.
+    """
+    output_format = (output_format or DEFAULT_FORMAT).lower()
+    if output_format == 'jpg':
+        output_format = 'jpeg'
+    
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unsupported output format: {output_format}')
+    if output_format not in supported_formats():
+        raise ValueError(f'Output format {output_format} is not available on this server')
+    
+    if quality is not None:
+        if isinstance(quality, bool) or not isinstance(quality, int) or not 1 <= quality <= 100:
+            raise ValueError('quality must be an integer between 1 and 100')
+    if colors is not None:
+        if isinstance(colors, bool) or not isinstance(colors, int) or not 2 <= colors <= 256:
+            raise ValueError('colors must be an integer between 2 and 256')
+    
+    if output_format == 'png':
+        # PNG без потерь: качество не применяется, палитра - по желанию
+        return output_format, None, colors
+    
+    return output_format, quality or DEFAULT_QUALITY, None
+
+def rasterise_svg(svg_content, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """Рендерит SVG в PNG и возвращает байты; ошибки не перехватываются"""
+    import cairosvg
+    from cairosvg.url import safe_fetch
+    # svg2png не принимает url_fetcher, поэтому через PNGSurface.convert
+    return cairosvg.surface.PNGSurface.convert(
+        bytestring=svg_content.encode('utf-8'),
+        output_width=width,
+        output_height=height,
+        url_fetcher=safe_fetch
+    )
+
+def svg_dimensions(svg_content):
+    """Ширина и высота корневого <svg>; по умолчанию размер слайда"""
+    match = _SVG_TAG.search(svg_content)
+    if match:
+        width = re.search(_DIMENSION.format('width'), match.group(0))
+        height = re.search(_DIMENSION.format('height'), match.group(0))
+        try:
+            if width and height and float(width.group(1)) > 0 and float(height.group(1)) > 0:
+                return float(width.group(1)), float(height.group(1))
+        except ValueError:
+            pass
+    return DEFAULT_WIDTH, DEFAULT_HEIGHT
+
+def variant_names(names):
+    """Проверяет список вариантов из запроса; ValueError при неизвестном имени"""
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError('variants must be a list of names')
+    
+    unknown = [name for name in names if name not in VARIANT_PRESETS]
+    if unknown:
+        raise ValueError(f"Unknown variants: {', '.join(unknown)}; available: {', '.join(VARIANT_PRESETS)}")
+    
+    return list(dict.fromkeys(names))
+
+def plan_variants(base_width, base_height, names=()):
+    """Размеры вариантов и общий размер растра для них.
+    
+    Возвращает ((ширина, высота) растра, [(имя, ширина, высота, обрезка)]);
+    основной вариант идет первым. Растр - самый крупный из нужных масштабов
+    шаблона, остальные варианты получаются из него уменьшением.
+    """
+    variants = []
+    raster_scale = 1
+    
+    for name in dict.fromkeys([PRIMARY_VARIANT, *names]):
+        preset = VARIANT_PRESETS[name]
+        if 'scale' in preset:
+            scale = preset['scale']
+            width, height = round(base_width * scale), round(base_height * scale)
+            crop = False
+        else:
+            width, height = preset['size']
+            # Кадр заполняется целиком (cover), лишнее обрезается
+            scale = max(width / base_width, height / base_height)
+            crop = True
+        
+        raster_scale = max(raster_scale, scale)
+        variants.append((name, max(1, width), max(1, height), crop))
+    
+    raster_scale = min(raster_scale, MAX_RASTER_SIDE / max(base_width, base_height))
+    raster_size = (max(1, round(base_width * raster_scale)), max(1, round(base_height * raster_scale)))
+    return raster_size, variants
+
+def rasterise_image(svg_content, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """Рендерит SVG в изображение Pillow прямо из буфера cairo, без PNG"""
+    import cairosvg
+    from cairosvg.url import safe_fetch
+    tree = cairosvg.parser.Tree(bytestring=svg_content.encode('utf-8'), url_fetcher=safe_fetch)
+    return rasterise_tree(tree, width, height)
+
+def rasterise_tree(tree, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """Рендерит разобранное дерево cairosvg в изображение Pillow"""
+    import cairosvg
+    Image = _pillow()
+    surface = cairosvg.surface.PNGSurface(tree, None, 96, output_width=width, output_height=height)
+    
+    cairo_surface = surface.cairo
+    cairo_surface.flush()
+    # ARGB32 в cairo - это BGRA с предумноженной альфой (на little-endian)
+    raw_mode = 'BGRa' if sys.byteorder == 'little' else 'aRGB'
+    image = Image.frombuffer(
+        'RGBA', (cairo_surface.get_width(), cairo_surface.get_height()),
+        bytes(cairo_surface.get_data()), 'raw', raw_mode, cairo_surface.get_stride(), 1
+    )
+    surface.finish()
+    return image
+
+def encode_image(image, output_format=DEFAULT_FORMAT, quality=None, colors=None):
+    """Кодирует изображение Pillow в заданный формат и возвращает байты"""
+    Image = _pillow()
+    pil_format = OUTPUT_FORMATS[output_format][0]
+    
+    if colors:
+        # Палитра: быстрый octree работает и для изображений с альфой
+        image = image.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+    
+    if output_format == 'jpeg' and image.mode != 'RGB':
+        # В JPEG нет прозрачности - кладем изображение на белый фон
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A') if image.mode == 'RGBA' else None)
+        image = background
+    
+    options = {}
+    if output_format == 'png':
+        options = {'optimize': bool(colors), 'compress_level': 6}
+    elif output_format == 'jpeg':
+        options = {'quality': quality, 'optimize': True, 'progressive': True}
+    elif output_format == 'webp':
+        options = {'quality': quality, 'method': 4}
+    elif output_format == 'avif':
+        options = {'quality': quality}
+    
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+def render_variants(svg_content, replacements, raster_size, variants,
+                    output_format=DEFAULT_FORMAT, quality=None, colors=None):
+    """Растеризует слайд один раз и кодирует из растра все варианты.
+    
+    svg_content - шаблон с плейсхолдерами, variants - список из plan_variants.
+    Разобранное дерево шаблона берется из кэша процесса (svg_tree.py), и
+    значения подставляются прямо в узлы; если шаблон для этого не подходит,
+    SVG собирается строкой и разбирается как обычно. Возвращает время
+    растеризации и по каждому варианту байты изображения и статистику
+    кодирования; ошибки не перехватываются.
+    """
+    from svg_tree import render_tree
+    
+    started = time.perf_counter()
+    tree = render_tree(svg_content, replacements)
+    if tree is not None:
+        raster = rasterise_tree(tree, *raster_size)
+    else:
+        processed_svg = get_compiled_template(None, svg_content).render(replacements)
+        raster = rasterise_image(processed_svg, *raster_size)
+    render_ms = round((time.perf_counter() - started) * 1000, 2)
+    
+    return {'render_ms': render_ms, 'variants': encode_variants(raster, variants, output_format, quality, colors)}
+
+def encode_variants(raster, variants, output_format=DEFAULT_FORMAT, quality=None, colors=None):
+    """Получает из растра все варианты и кодирует каждый"""
+    from PIL import ImageOps
+    Image = _pillow()
+    results = []
+    for name, width, height, crop in variants:
+        started = time.perf_counter()
+        
+        if crop:
+            image = ImageOps.fit(raster, (width, height), Image.Resampling.LANCZOS)
+        elif raster.size != (width, height):
+            image = raster.resize((width, height), Image.Resampling.LANCZOS)
+        else:
+            image = raster
+        
+        data = encode_image(image, output_format, quality, colors)
+        results.append({
+            'name': name,
+            'width': width,
+            'height': height,
+            'format': output_format,
+            'data': data,
+            'bytes': len(data),
+            'encode_ms': round((time.perf_counter() - started) * 1000, 2)
+        })
+    
+    return results
+
+def warm_up(templates=()):
+    """Прогрев процесса рендеринга перед приемом работы.
+    
+    Импортирует cairosvg и кодеки Pillow, рендерит короткий текст (cairo
+    загружает шрифты и кэш fontconfig) и разбирает шаблоны (сначала
+    новые, сколько помещается) в кэш деревьев.
+    Возвращает pid процесса.
+    """
+    from svg_tree import TREE_CACHE_SIZE, get_template_tree
+    
+    supported_formats()
+    try:
+        rasterise_image(WARM_UP_SVG, 64, 32)
+        for svg_content in templates[:TREE_CACHE_SIZE]:
+            get_template_tree(svg_content)
+    except Exception as e:
+        logger.warning("Прогрев рендеринга не удался: %s", e)
+    return os.getpid()
+
+def render_fallback_bytes(width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """Fallback: простое изображение с текстом"""
+    from PIL import Image, ImageDraw, ImageFont
+    img = Image.new('RGB', (width, height), color='white')
+    draw = ImageDraw.Draw(img)
+    
+    # Пытаемся загрузить шрифт
+    try:
+        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 20)
+    except:
+        font = ImageFont.load_default()
+    
+    draw.text((width//2, height//2), "Generated Image", fill='black', font=font, anchor='mm')
+    
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def generate_png_from_svg(svg_content, output_path, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """Генерирует PNG изображение из SVG контента.
+    
+    Возвращает 'rendered', 'fallback' (записана заглушка) или None.
+    """
+    try:
+        logger.debug("Генерирую PNG", extra={'path': output_path})
+        
+        # Создаем директорию если не существует
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        
+        # Конвертируем SVG в PNG используя cairosvg
+        data = rasterise_svg(svg_content, width, height)
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        
+        logger.debug("PNG сгенерирован", extra={'path': output_path})
+        return 'rendered'
+        
+    except Exception as e:
+        logger.error("Ошибка генерации PNG: %s", e, extra={'path': output_path})
+        return 'fallback' if render_fallback_png(output_path, width, height) else None
+
+def render_fallback_png(output_path, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """Fallback: сохраняет заглушку в файл"""
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        
+        with open(output_path, 'wb') as f:
+            f.write(render_fallback_bytes(width, height))
+        
+        logger.info("Fallback PNG создан", extra={'path': output_path})
+        return True
+        
+    except Exception as fallback_error:
+        logger.error("Fallback тоже не сработал: %s", fallback_error, extra={'path': output_path})
+        return False
@@ -0,0 +1,419 @@
+"""
+Хранилища сгенерированных файлов.
+
+Ключ объекта - путь относительно /output, например
+'<carousel_id>/slide_1_<hash>.png'. Бэкенды:
+
+- LocalStorage - каталог на диске (по умолчанию output/);
+- MemoryStorage - память процесса с ограничением по байтам (LRU);
+- S3Storage - любой S3-совместимый API (AWS, MinIO, локальная заглушка),
+  подписи SigV4 через requests.
+"""
+
+import datetime
+import hashlib
+import hmac
+import os
+import shutil
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from urllib.parse import quote, urlsplit
+
+_S3_NAMESPACE = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+
+
+class StorageError(Exception):
+    """Ошибка бэкенда хранилища"""
+
+
+class LocalStorage:
+    """Файлы в локальном каталоге"""
+
+    kind = 'local'
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def local_path(self, key):
+        """Путь к файлу объекта (с защитой от выхода за пределы каталога)"""
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f'Invalid key: {key}')
+        return path
+
+    def put(self, key, data, content_type='image/png'):
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишем рядом и переименовываем, чтобы читатели не видели недописанный файл
+        partial_path = f'{path}.{uuid.uuid4().hex}.part'
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        os.replace(partial_path, path)
+
+    def get(self, key):
+        try:
+            with open(self.local_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def copy(self, src_key, dst_key):
+        """Жесткая ссылка на тот же файл; False, если исходного объекта нет"""
+        src_path = self.local_path(src_key)
+        dst_path = self.local_path(dst_key)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        try:
+            if os.path.lexists(dst_path):
+                os.remove(dst_path)
+            os.link(src_path, dst_path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # Файловая система без жестких ссылок
+            try:
+                shutil.copyfile(src_path, dst_path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def link_count(self, key):
+        """Сколько имен у файла объекта (жесткие ссылки); 0, если его нет"""
+        try:
+            return os.stat(self.local_path(key)).st_nlink
+        except FileNotFoundError:
+            return 0
+
+    def delete_prefix(self, prefix):
+        """Удаляет все объекты с префиксом '<каталог>/' вместе с каталогом.
+
+        Возвращает освобожденные байты: файл, у которого остается другая
+        жесткая ссылка (например, из _cache), места не освобождает.
+        """
+        base = self.local_path(prefix.rstrip('/'))
+        freed = 0
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                try:
+                    stat = os.lstat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                if stat.st_nlink <= 1:
+                    freed += stat.st_size
+        shutil.rmtree(base, ignore_errors=True)
+        return freed
+
+    def list_prefixes(self):
+        """Имена верхнего уровня (каталоги каруселей, _cache) без обхода вглубь"""
+        try:
+            with os.scandir(self.root) as entries:
+                return [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            return []
+
+    def list(self, prefix=''):
+        """(ключ, размер) всех объектов с префиксом"""
+        base = self.root if not prefix else self.local_path(prefix.rstrip('/'))
+        if not os.path.isdir(base):
+            return
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, '/'), size
+
+
+class MemoryStorage:
+    """Объекты в памяти процесса; при превышении бюджета вытесняются по LRU"""
+
+    kind = 'memory'
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._objects = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def local_path(self, key):
+        return None
+
+    def put(self, key, data, content_type='image/png'):
+        data = bytes(data)
+        with self._lock:
+            self._set(key, data)
+
+    def get(self, key):
+        with self._lock:
+            data = self._objects.get(key)
+            if data is not None:
+                self._objects.move_to_end(key)
+            return data
+
+    def copy(self, src_key, dst_key):
+        """Копия разделяет тот же объект bytes - память не дублируется"""
+        with self._lock:
+            data = self._objects.get(src_key)
+            if data is None:
+                return False
+            self._set(dst_key, data)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            data = self._objects.pop(key, None)
+            if data is not None:
+                self._total_bytes -= len(data)
+
+    def exists(self, key):
+        with self._lock:
+            return key in self._objects
+
+    def link_count(self, key):
+        with self._lock:
+            return 1 if key in self._objects else 0
+
+    def delete_prefix(self, prefix):
+        freed = 0
+        with self._lock:
+            for key in [key for key in self._objects if key.startswith(prefix)]:
+                size = len(self._objects.pop(key))
+                self._total_bytes -= size
+                freed += size
+        return freed
+
+    def list_prefixes(self):
+        with self._lock:
+            return sorted({key.split('/', 1)[0] for key in self._objects if '/' in key})
+
+    def list(self, prefix=''):
+        with self._lock:
+            items = [(key, len(data)) for key, data in self._objects.items() if key.startswith(prefix)]
+        return iter(items)
+
+    def _set(self, key, data):
+        previous = self._objects.pop(key, None)
+        if previous is not None:
+            self._total_bytes -= len(previous)
+        self._objects[key] = data
+        self._total_bytes += len(data)
+
+        while self._total_bytes > self.max_bytes and len(self._objects) > 1:
+            _, evicted = self._objects.popitem(last=False)
+            self._total_bytes -= len(evicted)
+
+
+class S3Storage:
+    """S3-совместимое хранилище (path-style адресация, подпись SigV4)"""
+
+    kind = 's3'
+
+    def __init__(self, bucket, endpoint_url, access_key, secret_key, region='us-east-1',
+                 prefix='', timeout=30):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url.rstrip('/')
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip('/')
+        self.timeout = timeout
+        self.host = urlsplit(self.endpoint_url).netloc
+
+        # requests нужен только этому бэкенду - не замедляем им старт остальных
+        import requests
+        
+        # Пул соединений к хранилищу переиспользуется между запросами
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def local_path(self, key):
+        return None
+
+    def put(self, key, data, content_type='image/png'):
+        response = self._request('PUT', self._object_path(key), data=bytes(data),
+                                 headers={'Content-Type': content_type})
+        self._check(response, key)
+
+    def get(self, key):
+        response = self._request('GET', self._object_path(key))
+        if response.status_code == 404:
+            return None
+        self._check(response, key)
+        return response.content
+
+    def copy(self, src_key, dst_key):
+        """Копирование на стороне сервера, без передачи содержимого"""
+        source = quote(f'/{self.bucket}/{self._full_key(src_key)}', safe='/-_.~')
+        response = self._request('PUT', self._object_path(dst_key),
+                                 headers={'x-amz-copy-source': source})
+        if response.status_code == 404:
+            return False
+        self._check(response, dst_key)
+        return True
+
+    def delete(self, key):
+        response = self._request('DELETE', self._object_path(key))
+        if response.status_code not in (200, 204, 404):
+            self._check(response, key)
+
+    def exists(self, key):
+        response = self._request('HEAD', self._object_path(key))
+        return response.status_code == 200
+
+    def link_count(self, key):
+        """Копии в S3 - отдельные объекты: ссылка всегда одна (без запроса к API)"""
+        return 1
+
+    def delete_prefix(self, prefix):
+        """S3 не умеет удалять по префиксу - удаляем найденные объекты по одному"""
+        freed = 0
+        for key, size in list(self.list(prefix)):
+            self.delete(key)
+            freed += size
+        return freed
+
+    def list_prefixes(self):
+        """Имена верхнего уровня через delimiter, без перечисления объектов"""
+        names = []
+        for root in self._list_pages(f'{self.prefix}/' if self.prefix else '', delimiter='/'):
+            for item in root.findall('s3:CommonPrefixes', _S3_NAMESPACE):
+                name = item.find('s3:Prefix', _S3_NAMESPACE).text.rstrip('/')
+                names.append(name[len(self.prefix) + 1:] if self.prefix else name)
+        return names
+
+    def list(self, prefix=''):
+        full_prefix = self._full_key(prefix) if prefix else (f'{self.prefix}/' if self.prefix else '')
+        for root in self._list_pages(full_prefix):
+            for item in root.findall('s3:Contents', _S3_NAMESPACE):
+                key = item.find('s3:Key', _S3_NAMESPACE).text
+                size = int(item.find('s3:Size', _S3_NAMESPACE).text)
+                if self.prefix:
+                    key = key[len(self.prefix) + 1:]
+                yield key, size
+
+    def _list_pages(self, full_prefix, delimiter=None):
+        """Страницы ответа ListObjectsV2 (XML) с учетом continuation-token"""
+        token = None
+
+        while True:
+            query = {'list-type': '2', 'prefix': full_prefix}
+            if delimiter:
+                query['delimiter'] = delimiter
+            if token:
+                query['continuation-token'] = token
+            response = self._request('GET', f'/{self.bucket}', query=query)
+            self._check(response, full_prefix)
+
+            root = ET.fromstring(response.content)
+            yield root
+
+            truncated = root.find('s3:IsTruncated', _S3_NAMESPACE)
+            token_node = root.find('s3:NextContinuationToken', _S3_NAMESPACE)
+            if truncated is None or truncated.text != 'true' or token_node is None:
+                break
+            token = token_node.text
+
+    def _full_key(self, key):
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def _object_path(self, key):
+        return f'/{self.bucket}/{self._full_key(key)}'
+
+    def _check(self, response, key):
+        if response.status_code >= 300:
+            raise StorageError(f'S3 {response.request.method} {key}: HTTP {response.status_code}')
+
+    def _request(self, method, path, query=None, data=b'', headers=None):
+        headers = dict(headers or {})
+        canonical_uri, canonical_query = self._canonical(path, query or {})
+
+        headers['host'] = self.host
+        self._sign(method, canonical_uri, canonical_query, headers,
+                   hashlib.sha256(data).hexdigest(), datetime.datetime.now(datetime.timezone.utc))
+        del headers['host']
+
+        url = f'{self.endpoint_url}{canonical_uri}'
+        if canonical_query:
+            url = f'{url}?{canonical_query}'
+
+        return self.session.request(method, url, data=data or None, headers=headers, timeout=self.timeout)
+
+    @staticmethod
+    def _canonical(path, query):
+        """(путь, query) в кодировке SigV4; в таком же виде они уходят в URL"""
+        canonical_uri = quote(path, safe='/-_.~')
+        canonical_query = '&'.join(
+            f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}"
+            for name, value in sorted(query.items())
+        )
+        return canonical_uri, canonical_query
+
+    def _sign(self, method, canonical_uri, canonical_query, headers, payload_hash, now):
+        """Добавляет в headers подпись AWS Signature Version 4"""
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date_stamp = now.strftime('%Y%m%d')
+
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+
+        lowered = sorted((name.lower(), str(value).strip()) for name, value in headers.items())
+        canonical_headers = ''.join(f'{name}:{value}\n' for name, value in lowered)
+        signed_headers = ';'.join(name for name, _ in lowered)
+
+        canonical_request = '\n'.join([
+            method, canonical_uri, canonical_query, canonical_headers, signed_headers, payload_hash
+        ])
+        scope = f'{date_stamp}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        ])
+
+        signing_key = f'AWS4{self.secret_key}'.encode('utf-8')
+        for part in (date_stamp, self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+        headers['Authorization'] = (
+            f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+            f'SignedHeaders={signed_headers}, Signature={signature}'
+        )
+
+
+def create_storage(kind, local_root):
+    """Хранилище по имени бэкенда; параметры S3 и памяти - из окружения"""
+    if kind == 'local':
+        return LocalStorage(local_root)
+
+    if kind == 'memory':
+        return MemoryStorage(int(os.environ.get('OUTPUT_MEMORY_BYTES', 128 * 1024 * 1024)))
+
+    if kind == 's3':
+        region = os.environ.get('S3_REGION', 'us-east-1')
+        return S3Storage(
+            bucket=os.environ['S3_BUCKET'],
+            endpoint_url=os.environ.get('S3_ENDPOINT_URL', f'https://s3.{region}.amazonaws.com'),
+            access_key=os.environ.get('S3_ACCESS_KEY_ID', os.environ.get('AWS_ACCESS_KEY_ID', '')),
+            secret_key=os.environ.get('S3_SECRET_ACCESS_KEY', os.environ.get('AWS_SECRET_ACCESS_KEY', '')),
+            region=region,
+            prefix=os.environ.get('S3_PREFIX', '')
+        )
+
+    raise ValueError(f'Unknown output storage: {kind}')
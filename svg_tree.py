@@ -0,0 +1,169 @@
+"""
+Кэш разобранных деревьев SVG шаблонов.
+
+cairosvg разбирает SVG в дерево узлов (XML парсинг, сопоставление CSS,
+наследование атрибутов), и для крупных шаблонов это заметная часть
+рендера. Слайды одного шаблона отличаются только значениями плейсхолдеров,
+поэтому шаблон с плейсхолдерами как есть разбирается один раз на процесс
+пула, а для каждого слайда дерево копируется и значения подставляются
+прямо в текст и атрибуты узлов - без сборки и повторного разбора строки.
+
+Шаблоны, где подстановка на уровне узлов может разойтись со строковой
+(плейсхолдеры в CSS, ссылки <use>/<tref>, которые cairosvg заново строит
+из XML), сюда не попадают: render_tree возвращает None, и рендер идет
+через строку.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from cairosvg.parser import Tree, handle_white_spaces
+from cairosvg.url import safe_fetch
+
+from template_compiler import PLACEHOLDER_PATTERN, content_hash
+
+TREE_CACHE_SIZE = 32
+
+# Элементы, которые cairosvg при отрисовке строит заново из XML
+_REBUILT_FROM_XML = re.compile(r'<(?:[A-Za-z_][\w.\-]*:)?(?:use|tref)\b')
+
+_XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+
+class TemplateTree:
+    """Разобранный шаблон и узлы, в которых есть плейсхолдеры"""
+
+    __slots__ = ('tree', 'bindings')
+
+    def __init__(self, tree):
+        self.tree = tree
+        # id(узла) -> (есть ли плейсхолдеры в тексте, [атрибуты с плейсхолдерами])
+        self.bindings = {}
+        self._bind(tree)
+
+    def _bind(self, node):
+        text = _split(node.text) if node.text else None
+        attributes = [
+            (name, _split(value)) for name, value in node.items()
+            if isinstance(value, str) and '{' in value
+        ]
+        attributes = [(name, parts) for name, parts in attributes if parts is not None]
+        if text is not None or attributes:
+            self.bindings[id(node)] = (text, attributes)
+        for child in node.children:
+            self._bind(child)
+
+    def render(self, replacements):
+        """Копия дерева с подставленными значениями"""
+        return self._clone(self.tree, None, replacements)
+
+    def _clone(self, node, parent, replacements):
+        copy = dict.__new__(type(node))
+        dict.update(copy, node)
+        copy.__dict__.update(node.__dict__)
+        if parent is not None:
+            copy.parent = parent
+
+        binding = self.bindings.get(id(node))
+        if binding is not None:
+            text, attributes = binding
+            if text is not None:
+                preserve = copy.get(_XML_SPACE) == 'preserve'
+                copy.text = _join(text, replacements, lambda value: _text_value(value, preserve))
+            for name, parts in attributes:
+                copy[name] = _join(parts, replacements, str)
+
+        copy.children = [self._clone(child, copy, replacements) for child in node.children]
+        return copy
+
+
+def _split(value):
+    """Литералы на четных местах, имена плейсхолдеров на нечетных; None без плейсхолдеров"""
+    parts = PLACEHOLDER_PATTERN.split(value)
+    return parts if len(parts) > 1 else None
+
+
+def _text_value(value, preserve):
+    """Значение в тексте нормализуется по пробелам так же, как при разборе"""
+    if '\n' in value or '\r' in value or '\t' in value or (not preserve and '  ' in value):
+        return handle_white_spaces(value, preserve)
+    return value
+
+
+def _join(parts, replacements, convert):
+    result = list(parts)
+    for index in range(1, len(parts), 2):
+        name = parts[index]
+        result[index] = convert(str(replacements[name])) if name in replacements else f'{{{name}}}'
+    return ''.join(result)
+
+
+def _node_level_safe(svg_content, tree):
+    """Совпадет ли подстановка в узлы со строковой подстановкой"""
+    if _REBUILT_FROM_XML.search(svg_content):
+        return False
+    for element in tree.xml_tree.iter():
+        # Значения из CSS нормализуются (регистр и т.п.) - плейсхолдер может не найтись
+        if not isinstance(element.tag, str):
+            continue
+        if element.tag.rsplit('}', 1)[-1] == 'style' and PLACEHOLDER_PATTERN.search(element.text or ''):
+            return False
+        if PLACEHOLDER_PATTERN.search(element.get('style', '')):
+            return False
+    return True
+
+
+_tree_cache = OrderedDict()
+_tree_lock = threading.Lock()
+_tree_hits = 0
+_tree_misses = 0
+
+
+def get_template_tree(svg_content):
+    """Разобранный шаблон из кэша по хэшу содержимого; None, если не подходит"""
+    global _tree_hits, _tree_misses
+    key = content_hash(svg_content)
+
+    with _tree_lock:
+        if key in _tree_cache:
+            _tree_cache.move_to_end(key)
+            _tree_hits += 1
+            return _tree_cache[key]
+        _tree_misses += 1
+
+    try:
+        # Только data: URI - см. renderer.py
+        tree = Tree(bytestring=svg_content.encode('utf-8'), url_fetcher=safe_fetch)
+    except Exception:
+        # Шаблон без значений может не быть валидным XML (плейсхолдер в разметке)
+        template_tree = None
+    else:
+        template_tree = TemplateTree(tree) if _node_level_safe(svg_content, tree) else None
+
+    with _tree_lock:
+        _tree_cache[key] = template_tree
+        while len(_tree_cache) > TREE_CACHE_SIZE:
+            _tree_cache.popitem(last=False)
+
+    return template_tree
+
+
+def render_tree(svg_content, replacements):
+    """Дерево слайда из кэша шаблона или None, если нужен рендер через строку"""
+    template_tree = get_template_tree(svg_content)
+    if template_tree is None:
+        return None
+    return template_tree.render(replacements)
+
+
+def stats():
+    """Размер и попадания кэша деревьев (в текущем процессе)"""
+    with _tree_lock:
+        lookups = _tree_hits + _tree_misses
+        return {
+            'entries': len(_tree_cache),
+            'hits': _tree_hits,
+            'misses': _tree_misses,
+            'hit_ratio': round(_tree_hits / lookups, 3) if lookups else 0.0
+        }
@@ -0,0 +1,185 @@
+"""
+Каталог шаблонов в памяти процесса.
+
+Шаблоны меняются редко (upload и sync из админки), а читаются на каждом
+запросе списка и на каждом слайде генерации. Каталог загружает таблицу
+templates один раз и держит снимок: список в порядке created_at DESC, id
+DESC и словарь по id. Запись шаблонов увеличивает счетчик версии в таблице
+template_catalog в той же транзакции (bump_version); при обращении каталог
+сверяет версию одним запросом по первичному ключу и перечитывает таблицу,
+только если она изменилась - в том числе в другом процессе gunicorn.
+
+Для списка шаблонов JSON каждого элемента кодируется при загрузке снимка, а
+готовые страницы (фильтры, курсор, размер) с ETag кэшируются в снимке,
+поэтому повторный запрос не кодирует JSON заново. Курсор - позиция
+(created_at, id) последнего отданного шаблона: страницы не сдвигаются, если
+между запросами добавился шаблон.
+"""
+
+import base64
+import binascii
+import bisect
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from db import query_all, query_one
+
+TEMPLATE_FIELDS = ('id', 'name', 'category', 'template_type', 'template_role', 'svg_content', 'content_hash',
+                   'output_format', 'output_quality', 'output_colors', 'created_at')
+
+MAX_PAGE_SIZE = 500
+# Сколько готовых страниц списка хранится в снимке
+PAGE_CACHE_SIZE = 256
+
+
+class CursorError(ValueError):
+    """Курсор страницы не разбирается"""
+
+
+def bump_version(conn):
+    """Отмечает изменение шаблонов (в транзакции записи): каталоги всех процессов перечитают их"""
+    conn.execute('UPDATE template_catalog SET version = version + 1')
+
+
+def _sort_key(template):
+    return (template['created_at'] or '', template['id'])
+
+
+def encode_cursor(template):
+    raw = json.dumps(_sort_key(template), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, template_id = json.loads(raw)
+        if not isinstance(created_at, str) or not isinstance(template_id, str):
+            raise ValueError
+    except (ValueError, TypeError, binascii.Error):
+        raise CursorError('Invalid cursor')
+    return created_at, template_id
+
+
+class Snapshot:
+    """Шаблоны одной версии каталога; не изменяется после загрузки"""
+
+    def __init__(self, version, rows, listing_item):
+        self.version = version
+        self.templates = [dict(row) for row in rows]
+        self.by_id = {template['id']: template for template in self.templates}
+        # JSON элемента списка, закодированный один раз на снимок
+        self._encoded = [
+            json.dumps(listing_item(template), sort_keys=True, separators=(',', ':'))
+            for template in self.templates
+        ]
+        self._categories = {template['category'] for template in self.templates}
+        self._types = {template['template_type'] for template in self.templates}
+        self._filtered = {}  # (category, template_type) -> (позиции в templates, ключи по возрастанию)
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(self, category=None, template_type=None, cursor=None, limit=None):
+        """(тело JSON, ETag) страницы списка; CursorError при плохом курсоре"""
+        key = (category, template_type, cursor, limit)
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is not None:
+                self._pages.move_to_end(key)
+                return cached
+
+        positions, ascending_keys = self._filter(category, template_type)
+
+        start = 0
+        if cursor:
+            # Список идет по убыванию: пропускаем все, что не меньше курсора
+            start = len(positions) - bisect.bisect_left(ascending_keys, decode_cursor(cursor))
+
+        end = len(positions) if limit is None else min(len(positions), start + limit)
+        selected = positions[start:end]
+        next_cursor = encode_cursor(self.templates[selected[-1]]) if selected and end < len(positions) else None
+
+        body = ''.join((
+            '{"count":', str(len(selected)),
+            ',"nextCursor":', json.dumps(next_cursor),
+            ',"success":true',
+            ',"templates":[', ','.join(self._encoded[position] for position in selected), ']',
+            ',"total":', str(len(positions)),
+            ',"version":', str(self.version),
+            '}\n'
+        )).encode('utf-8')
+        result = body, hashlib.sha1(body).hexdigest()
+
+        with self._lock:
+            self._pages[key] = result
+            while len(self._pages) > PAGE_CACHE_SIZE:
+                self._pages.popitem(last=False)
+        return result
+
+    def _filter(self, category, template_type):
+        if ((category is not None and category not in self._categories)
+                or (template_type is not None and template_type not in self._types)):
+            # Неизвестное значение фильтра не кэшируется: ключи из запроса не растят словарь
+            return [], []
+
+        key = (category, template_type)
+        filtered = self._filtered.get(key)
+        if filtered is None:
+            positions = [
+                position for position, template in enumerate(self.templates)
+                if (category is None or template['category'] == category)
+                and (template_type is None or template['template_type'] == template_type)
+            ]
+            ascending_keys = [_sort_key(self.templates[position]) for position in reversed(positions)]
+            filtered = positions, ascending_keys
+            with self._lock:
+                # Сочетаний фильтров не больше, чем пар известных значений
+                self._filtered[key] = filtered
+        return filtered
+
+
+class TemplateCatalog:
+    """Снимок таблицы templates, который перечитывается при смене версии"""
+
+    def __init__(self, listing_item):
+        # listing_item(template) -> dict элемента списка шаблонов
+        self._listing_item = listing_item
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.hits = 0
+
+    def snapshot(self):
+        """Актуальный снимок; версия сверяется с базой на каждом вызове"""
+        version = query_one('SELECT version FROM template_catalog')[0]
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            self.hits += 1
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != version:
+                # Версию читаем до строк: если шаблоны успели поменяться
+                # между запросами, следующий вызов просто перечитает их еще раз
+                rows = query_all(f'''
+                    SELECT {', '.join(TEMPLATE_FIELDS)} FROM templates
+                    ORDER BY created_at DESC, id DESC
+                ''')
+                self._snapshot = Snapshot(version, rows, self._listing_item)
+                self.loads += 1
+            return self._snapshot
+
+    def get(self, template_id):
+        """Шаблон (dict) или None"""
+        return self.snapshot().by_id.get(template_id)
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            'version': snapshot.version if snapshot else 0,
+            'templates': len(snapshot.templates) if snapshot else 0,
+            'loads': self.loads,
+            'hits': self.hits
+        }
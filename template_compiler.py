@@ -0,0 +1,118 @@
+"""
+Компиляция SVG шаблонов с плейсхолдерами вида {dyno.name}.
+
+Шаблон один раз разбивается на список сегментов: литеральные куски текста
+и слоты плейсхолдеров. Подстановка значений после этого - один join,
+без повторных проходов str.replace по всему шаблону.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+PLACEHOLDER_PATTERN = re.compile(r'\{([A-Za-z_][A-Za-z0-9_.\-]*)\}')
+
+# Значения попадают и в текст, и в атрибуты - экранируем кавычки тоже
+XML_ENTITIES = {'"': '&quot;', "'": '&apos;'}
+
+COMPILED_CACHE_SIZE = 256
+
+
+def content_hash(svg_content):
+    """Хэш содержимого шаблона"""
+    return hashlib.sha1(svg_content.encode('utf-8')).hexdigest()
+
+
+def escape_value(value):
+    """XML-экранирование подставляемого значения"""
+    return escape(str(value), XML_ENTITIES)
+
+
+class CompiledTemplate:
+    """Шаблон, разобранный на литералы и слоты плейсхолдеров"""
+
+    __slots__ = ('segments', 'slots', 'placeholders', 'content_hash')
+
+    def __init__(self, segments, slots, svg_hash):
+        self.segments = segments
+        self.slots = slots
+        self.placeholders = frozenset(name for _, name in slots)
+        self.content_hash = svg_hash
+
+    def render(self, replacements):
+        """Подставляет значения; плейсхолдеры без значения остаются как есть"""
+        parts = list(self.segments)
+        for index, name in self.slots:
+            if name in replacements:
+                parts[index] = escape_value(replacements[name])
+        return ''.join(parts)
+
+    def check(self, replacements):
+        """Возвращает (unknown, missing): лишние ключи и незаполненные плейсхолдеры"""
+        keys = set(replacements)
+        unknown = sorted(keys - self.placeholders)
+        missing = sorted(self.placeholders - keys)
+        return unknown, missing
+
+
+def compile_template(svg_content):
+    """Разбирает SVG на сегменты"""
+    segments = []
+    slots = []
+    position = 0
+
+    for match in PLACEHOLDER_PATTERN.finditer(svg_content):
+        if match.start() > position:
+            segments.append(svg_content[position:match.start()])
+        # В слоте по умолчанию лежит исходный текст плейсхолдера
+        slots.append((len(segments), match.group(1)))
+        segments.append(match.group(0))
+        position = match.end()
+
+    if position < len(svg_content):
+        segments.append(svg_content[position:])
+
+    return CompiledTemplate(segments, slots, content_hash(svg_content))
+
+
+_compiled_cache = OrderedDict()
+_compiled_lock = threading.Lock()
+_compiled_hits = 0
+_compiled_misses = 0
+
+
+def get_compiled_template(template_id, svg_content):
+    """Скомпилированный шаблон из кэша по (id шаблона, хэш содержимого)"""
+    global _compiled_hits, _compiled_misses
+    key = (template_id, content_hash(svg_content))
+
+    with _compiled_lock:
+        compiled = _compiled_cache.get(key)
+        if compiled is not None:
+            _compiled_cache.move_to_end(key)
+            _compiled_hits += 1
+            return compiled
+        _compiled_misses += 1
+
+    compiled = compile_template(svg_content)
+
+    with _compiled_lock:
+        _compiled_cache[key] = compiled
+        while len(_compiled_cache) > COMPILED_CACHE_SIZE:
+            _compiled_cache.popitem(last=False)
+
+    return compiled
+
+
+def stats():
+    """Размер и попадания кэша скомпилированных шаблонов"""
+    with _compiled_lock:
+        lookups = _compiled_hits + _compiled_misses
+        return {
+            'entries': len(_compiled_cache),
+            'hits': _compiled_hits,
+            'misses': _compiled_misses,
+            'hit_ratio': round(_compiled_hits / lookups, 3) if lookups else 0.0
+        }